@@ -0,0 +1,173 @@
+import array
+import threading
+import time
+
+from clockalign import FrameClock
+from events import EventStream, ProximityFilter
+from plusmaze import PlusMaze
+from util import *
+
+class SampleRing(object):
+    '''
+    Preallocated ring buffer of maze samples. There is a single writer (the
+    acquisition thread), and any number of readers that poll it without
+    locking. Samples are numbered by a running sequence number; the writer
+    publishes a sample by incrementing `count` only after it is stored
+    '''
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.times = array.array('d', [0.0]) * capacity
+        self.raws = array.array('L', [0]) * capacity
+        self.frames = array.array('L', [0]) * capacity
+        self.count = 0 # Total number of samples written
+
+    def append(self, state):
+        i = self.count % self.capacity
+        self.times[i] = state.time
+        self.raws[i] = state.raw
+        self.frames[i] = state.frame
+        self.count += 1
+
+    def _get(self, seq):
+        i = seq % self.capacity
+        return PlusMaze.decode_state(self.times[i], self.raws[i], self.frames[i])
+
+    def time_of(self, seq):
+        # Host time of a sample that is still in the ring
+        return self.times[seq % self.capacity]
+
+    def latest(self):
+        count = self.count
+        if (count == 0):
+            return None
+        return self._get(count-1)
+
+    def read(self, seq):
+        '''
+        Returns the samples from sequence number `seq` onwards, and the
+        sequence number to pass on the next read. Samples that were already
+        overwritten by the writer are skipped
+        '''
+        count = self.count
+        seq = max(seq, count - self.capacity + 1)
+        samples = [self._get(s) for s in xrange(seq, count)]
+
+        # Drop any samples whose slots the writer reused (or may be in the
+        # middle of reusing) while we were copying
+        overwritten = (self.count - self.capacity + 1) - seq
+        if (overwritten > 0):
+            samples = samples[overwritten:]
+        return samples, count
+
+class SampleReader(object):
+    '''
+    Cursor into a SampleRing, for a consumer that needs every sample
+    '''
+    def __init__(self, ring):
+        self.ring = ring
+        self.seq = ring.count
+
+    def read(self):
+        samples, self.seq = self.ring.read(self.seq)
+        return samples
+
+    def skip(self):
+        # Discard any samples that have not been read yet
+        self.seq = self.ring.count
+
+class Acquisition(threading.Thread):
+    '''
+    Samples the maze at a fixed rate on a dedicated thread, so that polling
+    is not paced (or stalled) by the GUI. Once started, this is the only
+    thread that reads the maze state over USB; everyone else reads the
+    sample ring or subscribes to the event stream. Every sample also feeds
+    the frame clock, which maps host time to miniscope frames. The ring
+    keeps the raw samples; arm entries in the event stream are debounced
+    by a ProximityFilter
+    '''
+    DEFAULT_RATE = 1000 # Hz
+    DEFAULT_CAPACITY = 1 << 16 # Samples
+    MAX_SLEEP = 0.005 # s, so that a faster rate takes effect promptly
+
+    def __init__(self, maze, rate=DEFAULT_RATE, capacity=DEFAULT_CAPACITY):
+        threading.Thread.__init__(self, name='PlusMazeAcquisition')
+        self.daemon = True
+
+        self.maze = maze
+        self.ring = SampleRing(capacity)
+        self.events = EventStream(ProximityFilter())
+        self.clock = FrameClock()
+        self.period = 1.0 / rate
+        self.num_overruns = 0 # Samples that could not be taken on schedule
+
+        self._running = False
+        self._next_time = None
+
+    def set_rate(self, rate):
+        '''
+        Change the sampling rate, e.g. by protocol phase. The next sample
+        is taken within one new period
+        '''
+        period = 1.0 / rate
+        if (period == self.period):
+            return
+        self.period = period
+        print_msg("Sampling maze at {:.0f} Hz".format(rate), 'debug')
+        next_time = self._next_time
+        if next_time is not None:
+            # Races with the update in run at worst delay a single sample
+            self._next_time = min(next_time, monotonic() + period)
+
+    def reader(self):
+        return SampleReader(self.ring)
+
+    def latest(self):
+        '''
+        Most recent sample, or a fresh snapshot if none has been taken yet
+        '''
+        state = self.ring.latest()
+        if state is None:
+            state = self.maze.snapshot()
+        return state
+
+    def position(self):
+        '''
+        Arm the mouse is in, as accepted by the proximity filter of the
+        events, i.e. without detector glitches
+        '''
+        prox_filter = self.events.filter
+        if (prox_filter is None) or (prox_filter.pos is None):
+            return self.latest().pos
+        return prox_filter.pos
+
+    def start(self):
+        self._running = True
+        threading.Thread.start(self)
+        print_msg("Started maze acquisition at {:.0f} Hz".format(1.0/self.period))
+
+    def stop(self):
+        self._running = False
+        if self.is_alive():
+            self.join()
+        print_msg("Stopped maze acquisition ({} samples, {} overruns)".format(
+                    self.ring.count, self.num_overruns))
+
+    def run(self):
+        self._next_time = monotonic()
+        while self._running:
+            state = self.maze.snapshot()
+            self.ring.append(state)
+            self.clock.update(state.time, state.frame)
+            self.events.update(state)
+
+            self._next_time += self.period
+            delay = self._next_time - monotonic()
+            if (delay > 0):
+                # In short steps, in case set_rate moves the next sample up
+                while (delay > 0) and self._running:
+                    time.sleep(min(delay, Acquisition.MAX_SLEEP))
+                    delay = self._next_time - monotonic()
+            else:
+                # Fell behind (e.g. slow USB transaction). Don't try to catch up
+                self.num_overruns += 1
+                self._next_time = monotonic()
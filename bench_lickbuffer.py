@@ -0,0 +1,59 @@
+'''
+Micro-benchmark of the lickometer buffer decoders, on a synthetic buffer
+the size of the FPGA lickometer BRAM.
+
+Usage: python bench_lickbuffer.py [num_repeats]
+'''
+import random
+import sys
+import timeit
+
+from lickbuffer import LickBuffer
+from plusmaze import PlusMaze
+
+def decode_legacy(bin_buf):
+    # Decoder used by PlusMaze.pull_lick_buffer prior to LickBuffer
+    num_bytes = len(bin_buf)
+    buf = [False,]*(8*num_bytes)
+    for i in xrange(num_bytes):
+        bin_byte = bin_buf[i]
+        for j in xrange(8):
+            ind = 8*i + j
+            buf[ind] = ((1<<j) & bin_byte == (1<<j))
+    return buf
+
+def make_buffer(num_bytes, lick_prob=0.05, seed=0):
+    rng = random.Random(seed)
+    buf = bytearray(num_bytes)
+    for i in xrange(num_bytes):
+        for j in xrange(8):
+            if (rng.random() < lick_prob):
+                buf[i] |= (1<<j)
+    return buf
+
+def best_of(stmt, repeats):
+    return min(timeit.repeat(stmt, number=1, repeat=repeats))
+
+if (__name__ == '__main__'):
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    bin_buf = make_buffer(PlusMaze.lick_settings['BUFFER_LENGTH_IN_BYTES'])
+    num_frames = 8*len(bin_buf)
+
+    assert LickBuffer(bin_buf).to_list() == decode_legacy(bin_buf)
+
+    results = [
+        ('legacy list decode',    lambda: decode_legacy(bin_buf)),
+        ('LickBuffer()',          lambda: LickBuffer(bin_buf)),
+        ('LickBuffer.count()',    lambda: LickBuffer(bin_buf).count()),
+        ('LickBuffer[i] (x1000)', lambda: [LickBuffer(bin_buf)[i] for i in xrange(0, num_frames, num_frames//1000)]),
+        ('LickBuffer slice',      lambda: LickBuffer(bin_buf)[12345:num_frames-12345]),
+        ('LickBuffer.to_list()',  lambda: LickBuffer(bin_buf).to_list()),
+    ]
+
+    print "Decoding {} bytes ({} frames), best of {}".format(len(bin_buf), num_frames, repeats)
+    for name, stmt in results:
+        print "  {:<24} {:10.3f} ms".format(name, 1e3*best_of(stmt, repeats))
+
+    list_size = sys.getsizeof(decode_legacy(bin_buf))
+    print "Memory: list of bools {:.1f} MB (pointers only), LickBuffer {:.1f} kB".format(
+            list_size/1e6, sys.getsizeof(bin_buf)/1e3)
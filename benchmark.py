@@ -0,0 +1,238 @@
+'''
+Benchmarks of the maze control loop, run headless against the simulated
+FPGA (simdevice.py). Results are written as JSON, so that runs before and
+after a change can be compared.
+
+Usage: python benchmark.py [-o results.json] [--duration 2] [--latency 250e-6]
+'''
+from __future__ import division
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import results
+from acquisition import Acquisition
+from bench_lickbuffer import decode_legacy, make_buffer
+from engine import AutoReward, EgoTraining
+from events import ArmEntered
+from lickbuffer import LickBuffer
+from plusmaze import PlusMaze
+from results import Trial
+from scheduler import ActionScheduler
+from simdevice import SimFrontPanel, VirtualMouse
+from util import *
+
+def summarize(values):
+    '''
+    Summary statistics of a list of durations in seconds, reported in ms
+    '''
+    if not values:
+        return {'n': 0}
+    v = sorted(values)
+    pct = lambda p: v[min(len(v)-1, int(p*len(v)))]
+    return {'n': len(v),
+            'mean_ms': 1e3*sum(v)/len(v),
+            'min_ms': 1e3*v[0],
+            'p50_ms': 1e3*pct(0.50),
+            'p95_ms': 1e3*pct(0.95),
+            'max_ms': 1e3*v[-1]}
+
+def make_maze(args, mouse=None):
+    sim = SimFrontPanel(mouse=mouse, latency=args.latency, jitter=args.jitter, seed=args.seed)
+    return PlusMaze(xem=sim), sim
+
+def bench_getters(args):
+    maze, sim = make_maze(args)
+    getters = [('snapshot', maze.snapshot),
+               ('get_last_detected_pos', maze.get_last_detected_pos),
+               ('get_lick_state', maze.get_lick_state),
+               ('get_frame_count', maze.get_frame_count)]
+
+    out = {}
+    for name, getter in getters:
+        durations = []
+        t_end = monotonic() + args.duration
+        while (monotonic() < t_end):
+            t0 = monotonic()
+            getter()
+            durations.append(monotonic() - t0)
+        out[name] = summarize(durations)
+        out[name]['calls_per_sec'] = len(durations) / sum(durations)
+    return out
+
+# Consumers of arm entries, mirroring the reward logic of the engine, for
+# the timer-paced baseline
+#------------------------------------------------------------
+def ego_training(maze, turn):
+    # RunEgoTraining._monitor_training
+    def handle(event):
+        if (event.turn == turn):
+            maze.dose(event.to_arm)
+        if event.turn in PlusMaze.turn_compensation:
+            maze.compensate_turn(event.turn)
+    return handle
+
+def autoreward(maze, rng):
+    # PlusMazeController.default_polling, rewarding every arm entry
+    def handle(event):
+        maze.dose(event.to_arm)
+        if event.turn in PlusMaze.turn_compensation:
+            maze.rotate('center ccw' if rng.randint(0,1) else 'center cw')
+    return handle
+
+def reward_latencies(log):
+    # Pair each arm entry with the first dose that follows it
+    latencies = []
+    entry_time = None
+    for t, what, detail in log:
+        if (what == 'enter'):
+            entry_time = t
+        elif (what == 'dose') and (entry_time is not None):
+            latencies.append(t - entry_time)
+            entry_time = None
+    return latencies
+
+def bench_reward_latency(args, logic, consumer):
+    '''
+    consumer is 'timer' (events drained every PlusMaze.POLL_PERIOD, as the
+    wx dialogs used to) or 'callback' (the protocol engine, which handles
+    events on the acquisition thread)
+    '''
+    mouse = VirtualMouse(start='east', dwell=(0.3, 0.6), seed=args.seed)
+    maze, sim = make_maze(args, mouse)
+    rng = random.Random(args.seed)
+
+    acq = Acquisition(maze, rate=args.rate)
+    stop = threading.Event()
+    engine = None
+    if (consumer == 'callback'):
+        # Sample at args.rate throughout, as the timer consumer does
+        periods = (acq.period, acq.period)
+        if (logic == 'ego'):
+            engine = EgoTraining(maze, acq, mouse.pos, turn='left', num_trials=10**6,
+                                 poll_periods=periods)
+        else:
+            scheduler = ActionScheduler()
+            scheduler.start()
+            engine = AutoReward(maze, acq, scheduler, mode='every', poll_periods=periods)
+        engine.start()
+    else:
+        handle = ego_training(maze, 'left') if (logic == 'ego') else autoreward(maze, rng)
+        listener = acq.events.listen(ArmEntered)
+        def poll():
+            while not stop.is_set():
+                time.sleep(PlusMaze.POLL_PERIOD / 1000)
+                for event in listener.poll():
+                    handle(event)
+        poller = threading.Thread(target=poll)
+        poller.daemon = True
+        poller.start()
+
+    acq.start()
+    time.sleep(args.duration * 5)
+    stop.set()
+    if engine is not None:
+        engine.close()
+        if engine.scheduler is not None:
+            engine.scheduler.stop()
+    acq.stop()
+
+    out = summarize(reward_latencies(sim.log))
+    out['overruns'] = acq.num_overruns
+    out['samples'] = acq.ring.count
+    return out
+
+def bench_lick_buffer(args):
+    maze, sim = make_maze(args)
+    t0 = monotonic()
+    maze.pull_lick_buffer()
+    pull = monotonic() - t0
+
+    bin_buf = make_buffer(PlusMaze.lick_settings['BUFFER_LENGTH_IN_BYTES'], seed=args.seed)
+    def timed(func):
+        t0 = monotonic()
+        func()
+        return monotonic() - t0
+    return {'pull_lick_buffer_ms': 1e3*pull,
+            'decode_legacy_ms': 1e3*timed(lambda: decode_legacy(bin_buf)),
+            'decode_ms': 1e3*timed(lambda: LickBuffer(bin_buf)),
+            'count_ms': 1e3*timed(lambda: LickBuffer(bin_buf).count()),
+            'to_list_ms': 1e3*timed(lambda: LickBuffer(bin_buf).to_list())}
+
+def bench_save_result(args):
+    rng = random.Random(args.seed)
+    trials = []
+    for i in xrange(args.num_trials):
+        start, goal = rng.sample(PlusMaze.ordered_dirs, 2)
+        trials.append(Trial(start=start, block=start, goal=goal, result=goal,
+                            time=30.0, reward_delay=2.0, start_frame=600*i,
+                            open_frame=600*i+100, close_frame=600*i+200,
+                            end_frame=600*i+300))
+    licks = LickBuffer(make_buffer(PlusMaze.lick_settings['BUFFER_LENGTH_IN_BYTES'], seed=args.seed))
+    num_frames = len(licks)
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        output_file = os.path.join(tmp_dir, 'bench.txt')
+        t0 = monotonic()
+        results.save_trials(output_file, trials)
+        t1 = monotonic()
+        results.save_licks(results.lick_file_name(output_file), licks, num_frames)
+        t2 = monotonic()
+    finally:
+        shutil.rmtree(tmp_dir)
+    return {'num_trials': len(trials),
+            'num_frames': num_frames,
+            'save_trials_ms': 1e3*(t1-t0),
+            'save_licks_ms': 1e3*(t2-t1)}
+
+if (__name__ == '__main__'):
+    parser = argparse.ArgumentParser(description='Benchmark the maze control loop')
+    parser.add_argument('-o', '--output', help='JSON output file (default: stdout)')
+    parser.add_argument('--duration', type=float, default=2.0,
+                        help='seconds per getter benchmark (x5 for reward latency)')
+    parser.add_argument('--latency', type=float, default=250e-6, help='USB latency, s')
+    parser.add_argument('--jitter', type=float, default=50e-6, help='USB jitter, s')
+    parser.add_argument('--rate', type=float, default=Acquisition.DEFAULT_RATE,
+                        help='acquisition rate, Hz')
+    parser.add_argument('--num-trials', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    report = {'meta': {'time': get_time(),
+                       'python': sys.version.split()[0],
+                       'platform': platform.platform(),
+                       'args': vars(args)}}
+
+    # Without an output file, stdout is for the JSON only, and the
+    # messages of the runs go to stderr
+    stdout = sys.stdout
+    if not args.output:
+        sys.stdout = sys.stderr
+    try:
+        report['getters'] = bench_getters(args)
+        report['reward_latency'] = {}
+        for logic in ['ego', 'autoreward']:
+            for consumer in ['timer', 'callback']:
+                key = '{}_{}'.format(logic, consumer)
+                report['reward_latency'][key] = bench_reward_latency(args, logic, consumer)
+        report['lick_buffer'] = bench_lick_buffer(args)
+        report['save_result'] = bench_save_result(args)
+    finally:
+        sys.stdout = stdout
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+        print_msg("Wrote benchmark results to {}".format(args.output))
+    else:
+        print output
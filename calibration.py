@@ -0,0 +1,198 @@
+'''
+Hardware calibration of each rig. The servo positions of the gates and the
+volume and repetitions of each dose differ between rigs, so they are kept
+in a profile per board serial, calibration/<serial>.json next to this
+module (wherever the programs are run from), which overrides fields of PlusMaze.gate_settings and dose_settings:
+
+    {"gates": {"north": {"cl": 510, "op": 1120}},
+     "doses": {"east": {"dose_vol": 15500, "dose_rep": 3}}}
+
+When the maze is opened, its profile is checked and compiled into
+RegisterTables, so that every command is one lookup of a precomputed
+(endpoint, value) pair.
+
+Usage: python calibration.py SERIAL [--init]
+'''
+import collections
+import json
+import os
+
+import plusmaze # Which imports this module, so only use it at call time
+from util import *
+
+CALIBRATION_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'calibration')
+
+WIRE_IN_RANGE = (0x00, 0x1F)
+TRIGGER_IN_RANGE = (0x40, 0x5F)
+SERVO_RANGE = (0, 0xFFFF) # Pulse width wire-in
+REPS_BITS = 4 # Each dose's repetitions take a nibble of the reps word
+
+# Flat command tables of one rig:
+#   gate_writes       (arm, closed) -> (wire-in epaddr, value)
+#   dose_triggers     arm -> (trigger epaddr, bit)
+#   rotation_triggers rotation -> (trigger epaddr, bit)
+#   scope_triggers    'start'/'stop'/'reset' -> (trigger epaddr, bit)
+#   dosing_writes     (epaddr, value) of the dose volumes and packed reps word
+RegisterTables = collections.namedtuple('RegisterTables',
+    'gate_writes dose_triggers rotation_triggers scope_triggers dosing_writes')
+
+class CalibrationError(ValueError):
+    pass
+
+def profile_path(serial):
+    return os.path.join(CALIBRATION_DIR, '{}.json'.format(serial))
+
+def calibrated(defaults, overrides, what='settings'):
+    '''
+    Copy of a settings table (e.g. PlusMaze.gate_settings) with the fields
+    in overrides, {arm: {field: value}}, replaced
+    '''
+    settings = dict(defaults)
+    for arm, fields in overrides.iteritems():
+        if not isinstance(settings.get(arm), tuple):
+            raise CalibrationError("unknown {} '{}'".format(what, arm))
+        try:
+            settings[arm] = settings[arm]._replace(**fields)
+        except ValueError, e:
+            raise CalibrationError("{} {}: {}".format(what, arm, e))
+    return settings
+
+def load_profile(serial, required=False):
+    '''
+    The calibration overrides of the board, {'gates': ..., 'doses': ...}.
+    A board without a profile runs with the PlusMaze defaults, with a
+    warning if it should have one (required, e.g. a real board)
+    '''
+    path = profile_path(serial)
+    try:
+        with open(path, 'r') as f:
+            profile = json.load(f)
+    except IOError:
+        if required:
+            print_msg("Warning! No calibration profile {}, using defaults".format(path), 'warning')
+        else:
+            print_msg("No calibration profile for {}, using defaults".format(serial))
+        return {}
+    except ValueError, e:
+        raise CalibrationError("{}: {}".format(path, e))
+
+    unknown = set(profile) - set(['gates', 'doses', 'notes'])
+    if unknown:
+        raise CalibrationError("{}: unknown sections {}".format(path, ', '.join(sorted(unknown))))
+    print_msg("Loaded calibration profile {}".format(path))
+    return profile
+
+def save_profile(serial, profile):
+    path = profile_path(serial)
+    if not os.path.isdir(CALIBRATION_DIR):
+        os.makedirs(CALIBRATION_DIR)
+    with open(path, 'w') as f:
+        json.dump(profile, f, indent=2, sort_keys=True)
+    return path
+
+def settings_for(serial=None, overrides=None, required=False):
+    '''
+    (gate_settings, dose_settings) of a board: the defaults, then its
+    profile (see load_profile), then overrides ({'gates': ..., 'doses':
+    ...}) on top
+    '''
+    gates, doses = plusmaze.PlusMaze.gate_settings, plusmaze.PlusMaze.dose_settings
+    for layer in (load_profile(serial, required) if serial else {}, overrides or {}):
+        gates = calibrated(gates, layer.get('gates', {}), 'gate')
+        doses = calibrated(doses, layer.get('doses', {}), 'dose')
+    return gates, doses
+
+def _check(errors, what, val, lo, hi):
+    if not isinstance(val, (int, long)):
+        errors.append("{} is not an integer".format(what))
+    elif not (lo <= val <= hi):
+        errors.append("{} is {}, not within {}-{}".format(what, val, lo, hi))
+
+def compile_tables(gate_settings, dose_settings):
+    '''
+    Checks the calibration and builds the RegisterTables. Raises
+    CalibrationError listing every problem
+    '''
+    errors = []
+    gate_writes = {}
+    for arm in plusmaze.PlusMaze.ordered_dirs:
+        g = gate_settings[arm]
+        _check(errors, '{} gate epaddr'.format(arm), g.epaddr, *WIRE_IN_RANGE)
+        _check(errors, '{} gate cl'.format(arm), g.cl, *SERVO_RANGE)
+        _check(errors, '{} gate op'.format(arm), g.op, *SERVO_RANGE)
+        if (g.cl == g.op):
+            errors.append("{} gate opens and closes at the same position".format(arm))
+        gate_writes[(arm, True)] = (g.epaddr, g.cl)
+        gate_writes[(arm, False)] = (g.epaddr, g.op)
+
+    trig_epaddr = dose_settings['TRIG_EPADDR']
+    reps_epaddr = dose_settings['REPS_EPADDR']
+    _check(errors, 'dose TRIG_EPADDR', trig_epaddr, *TRIGGER_IN_RANGE)
+    _check(errors, 'dose REPS_EPADDR', reps_epaddr, *WIRE_IN_RANGE)
+    dose_triggers = {'all': (trig_epaddr, dose_settings['all'].trig_bit)}
+    dosing_writes = []
+    dose_reps = 0x00
+    for arm in plusmaze.PlusMaze.ordered_dirs:
+        d = dose_settings[arm]
+        _check(errors, '{} dose trig_bit'.format(arm), d.trig_bit, 1, 32 // REPS_BITS)
+        _check(errors, '{} dose epaddr'.format(arm), d.epaddr, *WIRE_IN_RANGE)
+        _check(errors, '{} dose_vol'.format(arm), d.dose_vol, 0, 0xFFFFFFFF)
+        _check(errors, '{} dose_rep'.format(arm), d.dose_rep, 0, (1 << REPS_BITS) - 1)
+        dose_triggers[arm] = (trig_epaddr, d.trig_bit)
+        dosing_writes.append((d.epaddr, d.dose_vol))
+        if not errors: # The shift needs a valid trig_bit
+            dose_reps += d.dose_rep << (REPS_BITS*(d.trig_bit - 1))
+    dosing_writes.append((reps_epaddr, dose_reps))
+
+    r = plusmaze.PlusMaze.rotation_settings
+    s = plusmaze.PlusMaze.scope_settings
+    epaddrs = [epaddr for epaddr, val in dosing_writes] + \
+              [gate_settings[arm].epaddr for arm in plusmaze.PlusMaze.ordered_dirs]
+    if (len(set(epaddrs)) != len(epaddrs)):
+        errors.append("gates and doses share wire-in endpoints")
+    dose_bits = [bit for epaddr, bit in dose_triggers.itervalues()]
+    if (len(set(dose_bits)) != len(dose_bits)) or \
+       (set(dose_bits) & set(r['trig_map'].values() + s['trig_map'].values())):
+        errors.append("doses share trigger bits with each other or with other commands")
+
+    if errors:
+        raise CalibrationError('\n'.join(errors))
+
+    return RegisterTables(
+        gate_writes=gate_writes,
+        dose_triggers=dose_triggers,
+        rotation_triggers=dict((name, (r['TRIG_EPADDR'], bit)) for name, bit in r['trig_map'].iteritems()),
+        scope_triggers=dict((name, (s['TRIG_EPADDR'], bit)) for name, bit in s['trig_map'].iteritems()),
+        dosing_writes=tuple(dosing_writes))
+
+if (__name__ == '__main__'):
+    import argparse
+    from plusmaze import PlusMaze
+    parser = argparse.ArgumentParser(description='Check the calibration profile of a board')
+    parser.add_argument('serial')
+    parser.add_argument('--init', action='store_true',
+                        help='write a profile with the current default settings')
+    args = parser.parse_args()
+
+    if args.init:
+        if os.path.exists(profile_path(args.serial)):
+            raise SystemExit("{} already exists".format(profile_path(args.serial)))
+        # Endpoints and trigger bits are wiring, not calibration
+        fields = lambda t: dict((k, v) for k, v in t._asdict().iteritems()
+                                if k not in ('epaddr', 'trig_bit'))
+        profile = {'gates': dict((arm, fields(PlusMaze.gate_settings[arm]))
+                                 for arm in PlusMaze.ordered_dirs),
+                   'doses': dict((arm, fields(PlusMaze.dose_settings[arm]))
+                                 for arm in PlusMaze.ordered_dirs)}
+        print_msg("Wrote {}".format(save_profile(args.serial, profile)))
+
+    try:
+        tables = compile_tables(*settings_for(args.serial))
+    except CalibrationError, e:
+        raise SystemExit(str(e))
+    for arm in PlusMaze.ordered_dirs:
+        print '{:<6} gate 0x{:02X} cl {:5d} op {:5d}   dose bit {} '.format(
+            arm, tables.gate_writes[(arm, True)][0], tables.gate_writes[(arm, True)][1],
+            tables.gate_writes[(arm, False)][1], tables.dose_triggers[arm][1])
+    for epaddr, val in tables.dosing_writes:
+        print 'wire-in 0x{:02X} = 0x{:08X}'.format(epaddr, val)
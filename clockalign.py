@@ -0,0 +1,206 @@
+'''
+Alignment of the host monotonic clock with the miniscope frame counter.
+
+The counter only advances while the miniscope records, so it runs in
+segments (one per trial in semi-auto trials). Within a segment, frames
+arrive at the rate of the miniscope clock, which drifts against the host
+clock. FrameClock finds the frame edges in the acquired samples (the
+counter changed between two snapshots, so the frame started in between),
+and fits frame = f_ref + rate*(t - t_ref) to them: the rate is pooled over
+recent segments (older ones are forgotten with time constant `window`, to
+follow drift), and f_ref, t_ref are the centroid of the edges of each
+segment. The counter is 32 bits wide (FRAME_HI, FRAME_LO); wraparounds are
+counted so that frame indices keep increasing.
+'''
+from __future__ import division
+
+import bisect
+import collections
+import math
+import threading
+
+from events import FRAME_COUNTER_MODULUS
+
+# A fitted stretch of recording. Frames first_frame..last_frame (unwrapped)
+# started between start_time and end_time
+Segment = collections.namedtuple('Segment',
+    'start_time end_time first_frame last_frame t_ref f_ref')
+
+class FrameClock(object):
+    '''
+    Fed with every sample by the acquisition thread (update), and queried
+    from any thread (frame_at, counter_at, time_of)
+    '''
+    WINDOW = 300.0 # s, time constant of the drift tracking
+    SEGMENT_GAP = 0.5 # s without an edge that ends a segment,
+    SEGMENT_GAP_FRAMES = 3 # or frame periods, once the rate is known
+    MAX_SEGMENT = 60.0 # s, longer recordings are split to follow drift
+
+    def __init__(self, window=WINDOW):
+        self.window = window
+        self.lock = threading.Lock()
+        self.rate = None # Frames per host second, once known
+        self._pooled = (0.0, 0.0) # Decayed sum of centered t*t, t*f of past segments
+        self._pooled_time = None
+        self.reset()
+
+    def reset(self):
+        '''
+        Forget the segments, e.g. after the counter was reset. The rate of
+        the miniscope clock is kept
+        '''
+        with self.lock:
+            self.wraps = 0
+            self.prev_time = None
+            self.prev_frame = None
+            self.segments = [] # Closed segments
+            self._starts = [] # Their start times, for bisect
+            self._current = None # [n, mean_t, mean_f, m_tt, m_tf, first t, first f, last t, last f]
+
+    def unwrap(self, frame):
+        '''
+        Frame index of a raw 32-bit counter value read since the last wrap
+        '''
+        return frame + self.wraps*FRAME_COUNTER_MODULUS
+
+    def update(self, t, frame):
+        if (frame == self.prev_frame):
+            self.prev_time = t
+            return
+        prev_time, prev_frame = self.prev_time, self.prev_frame
+        self.prev_time, self.prev_frame = t, frame
+        if prev_frame is None:
+            return
+
+        with self.lock:
+            if (frame < prev_frame):
+                if (prev_frame - frame > FRAME_COUNTER_MODULUS // 2):
+                    self.wraps += 1
+                else: # Counter reset
+                    self._close_segment()
+                    self.segments = []
+                    self._starts = []
+                    self.wraps = 0
+                    return
+            self._add_edge(0.5*(prev_time + t), self.unwrap(frame))
+
+    def _add_edge(self, t, f):
+        c = self._current
+        gap = FrameClock.SEGMENT_GAP
+        if self.rate:
+            gap = min(gap, FrameClock.SEGMENT_GAP_FRAMES/self.rate)
+        if (c is not None) and ((t - c[7] > gap) or
+                                (t - c[5] > FrameClock.MAX_SEGMENT)):
+            self._close_segment()
+            c = None
+        if c is None:
+            self._current = [1, t, f, 0.0, 0.0, t, f, t, f]
+            return
+
+        # Welford update of the centered sums
+        n = c[0] + 1
+        dt = t - c[1]
+        df = f - c[2]
+        c[1] += dt/n
+        c[2] += df/n
+        c[3] += dt*(t - c[1])
+        c[4] += dt*(f - c[2])
+        c[0] = n
+        c[7], c[8] = t, f
+        self._update_rate()
+
+    def _decayed_pool(self, t):
+        if self._pooled_time is None:
+            return self._pooled
+        decay = math.exp(-(t - self._pooled_time)/self.window)
+        return (self._pooled[0]*decay, self._pooled[1]*decay)
+
+    def _update_rate(self):
+        c = self._current
+        p_tt, p_tf = self._decayed_pool(c[7])
+        s_tt = p_tt + c[3]
+        if (s_tt > 0):
+            self.rate = (p_tf + c[4])/s_tt
+
+    def _close_segment(self):
+        c = self._current
+        if c is None:
+            return
+        self._current = None
+        if (c[0] > 1):
+            p_tt, p_tf = self._decayed_pool(c[7])
+            self._pooled = (p_tt + c[3], p_tf + c[4])
+            self._pooled_time = c[7]
+        self.segments.append(Segment(start_time=c[5], end_time=c[7], first_frame=c[6],
+                                     last_frame=c[8], t_ref=c[1], f_ref=c[2]))
+        self._starts.append(c[5])
+
+    def frame_at(self, t):
+        '''
+        Fractional frame index (unwrapped) at host time t: the counter read
+        at t would be its integer part. Between segments, and before the
+        rate is known, this is the first frame of the segment. None before
+        the first frame
+        '''
+        with self.lock:
+            c = self._current
+            if (c is not None) and (t >= c[5]):
+                # Past the last sample, the next frames may have started
+                seg = Segment(start_time=c[5], end_time=c[7], first_frame=c[6],
+                              last_frame=c[8] if (t <= self.prev_time) else None,
+                              t_ref=c[1], f_ref=c[2])
+            else:
+                i = bisect.bisect_right(self._starts, t) - 1
+                if (i < 0):
+                    return None
+                seg = self.segments[i]
+            rate = self.rate
+
+        if rate is None:
+            return seg.first_frame
+        f = seg.f_ref + rate*(t - seg.t_ref)
+        f = max(f, seg.first_frame)
+        if (seg.last_frame is not None) and (f >= seg.last_frame + 1):
+            f = seg.last_frame # Counter stopped after the last frame
+        return f
+
+    def counter_at(self, t):
+        '''
+        Raw 32-bit counter value at host time t, as MazeState.frame
+        '''
+        f = self.frame_at(t)
+        if f is None:
+            return None
+        return int(math.floor(f)) % FRAME_COUNTER_MODULUS
+
+    def time_of(self, frame):
+        '''
+        Host time at which frame (unwrapped index) started, or None if it
+        is not within a segment
+        '''
+        with self.lock:
+            segments = list(self.segments)
+            c = self._current
+            if c is not None:
+                segments.append(Segment(start_time=c[5], end_time=c[7], first_frame=c[6],
+                                        last_frame=c[8], t_ref=c[1], f_ref=c[2]))
+            rate = self.rate
+        if not rate:
+            return None
+        for seg in reversed(segments):
+            if (seg.first_frame <= frame <= seg.last_frame):
+                return seg.t_ref + (frame - seg.f_ref)/rate
+        return None
+
+    def summary(self):
+        '''
+        The fit as plain data, e.g. for the metadata of a session file:
+        the rate, and [start_time, end_time, first_frame, last_frame,
+        t_ref, f_ref] of every segment
+        '''
+        with self.lock:
+            segments = [list(seg) for seg in self.segments]
+            c = self._current
+            if c is not None:
+                segments.append([c[5], c[7], c[6], c[8], c[1], c[2]])
+            return {'rate': self.rate, 'segments': segments}
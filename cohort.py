@@ -0,0 +1,305 @@
+'''
+Cohort summaries from a directory tree of session outputs, e.g.
+
+    cohort/mouse1/2018-03-10/results.txt
+    cohort/mouse1/2018-03-11/results.pmz
+    ...
+
+Sessions are session containers (.pmz) and the text result files of
+semi-auto trials (with their -lick files) and egocentric training; a text
+file next to a container of the same name is skipped. The subject of a
+session is its first directory below the root. Sessions are parsed in
+parallel, and the parsed sessions are cached in the root (.cohort_cache.json)
+by file mtime and hash, so that only new or changed sessions are parsed
+again. Writes, to the output directory:
+
+    sessions.csv    one line per session
+    days.csv        accuracy, turn bias and reaction times per subject and day
+    learning.csv    accuracy over consecutive blocks of trials per subject
+
+Usage: python cohort.py ROOT [-o OUTPUT_DIR] [-j JOBS] [--block-size 20]
+'''
+from __future__ import division
+
+import csv
+import datetime
+import hashlib
+import json
+import multiprocessing
+import os
+
+import numpy as np
+
+import lickanalysis
+import sessionfile
+from plusmaze import PlusMaze
+from protocol import reachable_arms
+from util import *
+
+CACHE_FILE = '.cohort_cache.json'
+CACHE_VERSION = 1
+
+def find_sessions(root):
+    '''
+    {relative path: [files the session is parsed from]}
+    '''
+    sessions = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        names = set(filenames)
+        for name in sorted(filenames):
+            base, ext = os.path.splitext(name)
+            path = os.path.join(dirpath, name)
+            if (ext == '.pmz'):
+                files = [path]
+            elif (ext == '.txt') and not base.endswith('-lick') and (base + '.pmz') not in names \
+                    and not base.startswith('autobackup'): # Copy of the results written on close
+                files = [path]
+                lick_name = base + '-lick' + ext
+                if lick_name in names:
+                    files.append(os.path.join(dirpath, lick_name))
+            else:
+                continue
+            sessions[os.path.relpath(path, root)] = files
+    return sessions
+
+def _hash_files(files):
+    h = hashlib.sha1()
+    for path in files:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), ''):
+                h.update(chunk)
+    return h.hexdigest()
+
+def _turn(start, end):
+    return PlusMaze.pos_to_turn.get((start, end))
+
+def _semiauto_trials(starts, blocks, goals, results, open_frames, close_frames,
+                     first_licks, frame_rate):
+    trials = []
+    for k in xrange(len(results)):
+        start, block, goal, result = starts[k], blocks[k], goals[k], results[k]
+        if (goal == 'none') or (result is None):
+            correct = None # Probe trial, or not run
+        elif (goal == 'any'):
+            correct = result in reachable_arms(start, block)
+        else:
+            correct = (result == goal)
+        reaction = None
+        if (open_frames[k] >= 0) and (close_frames[k] >= open_frames[k]):
+            reaction = (close_frames[k] - open_frames[k])/frame_rate
+        latency = first_licks[k]
+        trials.append({'turn': _turn(start, result), 'correct': correct,
+                       'reaction_time': reaction,
+                       'first_lick_latency': None if np.isnan(latency) else float(latency)})
+    return trials
+
+def _parse_container(path):
+    session = sessionfile.SessionFile(path)
+    t = session.trials
+    day = session.header['created'][:10]
+    if (session.protocol == 'semiauto'):
+        licks, trials, frame_rate = lickanalysis.load_session(path)
+        metrics = lickanalysis.trial_metrics(licks, trials, frame_rate)
+        arms = lambda field: session.decode(field, t[field])
+        trials = _semiauto_trials(arms('start'), arms('block'), arms('goal'), arms('result'),
+                                  t['open_frame'], t['close_frame'],
+                                  metrics['first_lick_latency'], frame_rate)
+    elif (session.protocol == 'ego'):
+        turn = session.meta.get('turn')
+        trials = [{'turn': turn_k, 'correct': None if turn is None else (turn_k == turn),
+                   'reaction_time': float(time_k), 'first_lick_latency': None}
+                  for turn_k, time_k in zip(session.decode('turn', t['turn']), t['time'])]
+    else:
+        return None
+    return {'protocol': session.protocol, 'day': day, 'trials': trials}
+
+def _parse_text(files):
+    path = files[0]
+    with open(path, 'r') as f:
+        rows = [line.split() for line in f if line.strip()]
+    if not rows:
+        return None
+    day = datetime.date.fromtimestamp(os.path.getmtime(path)).isoformat()
+    none = lambda v: None if (v == 'None') else v
+
+    if all(len(r) == 9 for r in rows):
+        startblocks = [r[0].split('-') for r in rows]
+        if len(files) > 1:
+            licks, table, frame_rate = lickanalysis.load_session(path)
+            first_licks = lickanalysis.trial_metrics(licks, table, frame_rate)['first_lick_latency']
+        else:
+            frame_rate = lickanalysis.DEFAULT_FRAME_RATE
+            first_licks = [np.nan] * len(rows)
+        frame = lambda v: -1 if (v == 'None') else int(v)
+        trials = _semiauto_trials([sb[0] for sb in startblocks], [sb[-1] for sb in startblocks],
+                                  [r[1] for r in rows], [none(r[2]) for r in rows],
+                                  [frame(r[6]) for r in rows], [frame(r[7]) for r in rows],
+                                  first_licks, frame_rate)
+        return {'protocol': 'semiauto', 'day': day, 'trials': trials}
+
+    if all((len(r) == 4) and (r[2] in ('left', 'right', 'straight')) for r in rows):
+        # The rewarded turn is not in the text file
+        trials = [{'turn': r[2], 'correct': None, 'reaction_time': float(r[3]),
+                   'first_lick_latency': None} for r in rows]
+        return {'protocol': 'ego', 'day': day, 'trials': trials}
+    return None # Not a session, e.g. a trial file
+
+def parse_session(task):
+    '''
+    Runs in the pool. task is (files, hash of the cached parse or None);
+    returns (hash, parsed session, error). The parse is skipped (None) if
+    the hash is unchanged
+    '''
+    files, cached_hash = task
+    try:
+        file_hash = _hash_files(files)
+        if (file_hash == cached_hash):
+            return file_hash, None, None
+        if files[0].endswith('.pmz'):
+            return file_hash, _parse_container(files[0]), None
+        return file_hash, _parse_text(files), None
+    except Exception, e:
+        return None, None, '{}: {}'.format(type(e).__name__, e)
+
+def load_cache(path):
+    try:
+        with open(path, 'r') as f:
+            cache = json.load(f)
+    except (IOError, ValueError):
+        return {}
+    if (cache.get('version') != CACHE_VERSION):
+        return {}
+    return cache['sessions']
+
+def save_cache(path, sessions):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'version': CACHE_VERSION, 'sessions': sessions}, f)
+    if os.path.exists(path):
+        os.remove(path) # os.rename does not replace files on Windows
+    os.rename(tmp_path, path)
+
+def update_sessions(root, jobs=None, cache_file=None):
+    '''
+    Parses the sessions under root that are not in the cache, or changed.
+    Returns {relative path: cache entry}, and saves the cache
+    '''
+    cache_file = cache_file or os.path.join(root, CACHE_FILE)
+    cache = load_cache(cache_file)
+    found = find_sessions(root)
+
+    sessions = {}
+    tasks = []
+    for rel_path, files in sorted(found.iteritems()):
+        mtimes = [os.path.getmtime(path) for path in files]
+        entry = cache.get(rel_path)
+        if (entry is not None) and (entry['mtimes'] == mtimes):
+            sessions[rel_path] = entry
+        else:
+            tasks.append((rel_path, files, mtimes, entry))
+
+    num_parsed = 0
+    if tasks:
+        pool = multiprocessing.Pool(jobs)
+        try:
+            outputs = pool.imap(parse_session,
+                                [(files, entry and entry['hash']) for _, files, _, entry in tasks],
+                                chunksize=4)
+            for (rel_path, files, mtimes, entry), (file_hash, parsed, error) in zip(tasks, outputs):
+                if error is not None:
+                    print_msg("Warning! Could not parse {}: {}".format(rel_path, error), 'warning')
+                    continue
+                if (entry is not None) and (entry['hash'] == file_hash):
+                    parsed = entry['session'] # Touched, not changed
+                else:
+                    num_parsed += 1
+                # Files that are not sessions are cached too, as None
+                sessions[rel_path] = {'mtimes': mtimes, 'hash': file_hash, 'session': parsed}
+        finally:
+            pool.close()
+            pool.join()
+
+    save_cache(cache_file, sessions)
+    sessions = dict((p, e) for p, e in sessions.iteritems() if e['session'] is not None)
+    print_msg("{} sessions ({} files parsed)".format(len(sessions), num_parsed))
+    return sessions
+
+def _subject(rel_path):
+    parts = rel_path.replace('\\', '/').split('/')
+    return parts[0] if (len(parts) > 1) else ''
+
+def _stats(trials):
+    scored = [t['correct'] for t in trials if t['correct'] is not None]
+    left = sum(1 for t in trials if t['turn'] == 'left')
+    right = sum(1 for t in trials if t['turn'] == 'right')
+    reaction = [t['reaction_time'] for t in trials if t['reaction_time'] is not None]
+    latency = [t['first_lick_latency'] for t in trials if t['first_lick_latency'] is not None]
+    median = lambda v: '{:.3f}'.format(np.median(v)) if v else ''
+    return [len(trials),
+            sum(scored),
+            '{:.3f}'.format(sum(scored)/len(scored)) if scored else '',
+            left, right,
+            '{:.3f}'.format(left/(left+right)) if (left+right) else '',
+            median(reaction), median(latency)]
+
+STATS_COLUMNS = ['trials', 'correct', 'accuracy', 'left', 'right', 'left_fraction',
+                 'median_reaction_time', 'median_first_lick_latency']
+
+def write_summaries(sessions, output_dir, block_size=20):
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    ordered = sorted(sessions.iteritems(),
+                     key=lambda (p, e): (_subject(p), e['session']['day'], p))
+
+    with open(os.path.join(output_dir, 'sessions.csv'), 'wb') as f:
+        w = csv.writer(f)
+        w.writerow(['subject', 'day', 'protocol', 'session'] + STATS_COLUMNS)
+        for rel_path, entry in ordered:
+            s = entry['session']
+            w.writerow([_subject(rel_path), s['day'], s['protocol'], rel_path] + _stats(s['trials']))
+
+    days = {}
+    for rel_path, entry in ordered:
+        s = entry['session']
+        days.setdefault((_subject(rel_path), s['day'], s['protocol']), []).extend(s['trials'])
+    with open(os.path.join(output_dir, 'days.csv'), 'wb') as f:
+        w = csv.writer(f)
+        w.writerow(['subject', 'day', 'protocol'] + STATS_COLUMNS)
+        for key in sorted(days):
+            w.writerow(list(key) + _stats(days[key]))
+
+    # Learning curves: scored trials of each subject and protocol, in order
+    curves = {}
+    for rel_path, entry in ordered:
+        s = entry['session']
+        curves.setdefault((_subject(rel_path), s['protocol']), []).extend(
+            (s['day'], t['correct']) for t in s['trials'] if t['correct'] is not None)
+    with open(os.path.join(output_dir, 'learning.csv'), 'wb') as f:
+        w = csv.writer(f)
+        w.writerow(['subject', 'protocol', 'block', 'first_trial', 'day', 'accuracy'])
+        for key in sorted(curves):
+            trials = curves[key]
+            for b in xrange(0, len(trials) - block_size + 1, block_size):
+                block = trials[b:b+block_size]
+                w.writerow(list(key) + [b//block_size + 1, b + 1, block[0][0],
+                           '{:.3f}'.format(sum(c for d, c in block)/block_size)])
+    print_msg("Wrote cohort summaries to {}".format(output_dir))
+
+if (__name__ == '__main__'):
+    import argparse
+    parser = argparse.ArgumentParser(description='Summarize a cohort of plus maze sessions')
+    parser.add_argument('root', help='directory tree of session outputs')
+    parser.add_argument('-o', '--output-dir', help='default: ROOT/cohort_summary')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='parser processes (default: one per CPU)')
+    parser.add_argument('--block-size', type=int, default=20,
+                        help='trials per point of the learning curves')
+    parser.add_argument('--cache', help='cache file (default: ROOT/{})'.format(CACHE_FILE))
+    args = parser.parse_args()
+
+    t0 = monotonic()
+    sessions = update_sessions(args.root, args.jobs, args.cache)
+    write_summaries(sessions, args.output_dir or os.path.join(args.root, 'cohort_summary'),
+                    args.block_size)
+    print_msg("Done in {:.1f} s".format(monotonic() - t0))
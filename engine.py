@@ -0,0 +1,840 @@
+'''
+Headless protocol engine. Each protocol is a state machine driven by the
+maze event stream (callbacks on the acquisition thread, i.e. at the full
+sample rate) and by timed actions on the ActionScheduler. Nothing here
+imports wx: the dialogs in runtrials.py and runegotrain.py are views that
+observe an engine and forward button presses to it, and plusmaze_cli.py
+runs the same engines from the command line.
+'''
+from __future__ import division
+
+import collections
+import itertools
+import os
+import random
+import threading
+import time
+
+import protocol
+import results
+from events import ArmEntered, LickOnset
+from journal import TrialJournal, journal_file_name, read_journal
+from lickstream import LickDrain
+from plusmaze import PlusMaze
+from results import EgoTrial, Trial
+from util import *
+
+# Outcome of a lick window, see LickRewarder. Times in s, None if the mouse
+# did not lick in time:
+#   lick_delay      From the arm entry to the sample showing the lick onset
+#   latency         From that sample to the end of the dose trigger
+#   worst_case      From the sample before it (the lick may have started
+#                   right after) to the end of the dose trigger
+LickReward = collections.namedtuple('LickReward', 'trial arm window lick_delay latency worst_case')
+
+_engine_ids = itertools.count()
+
+class ResumeError(ValueError):
+    pass
+
+class Protocol(object):
+    '''
+    Base class of the protocol state machines. All transitions happen with
+    self.lock held, from whichever thread caused them. Observers are called
+    (with the engine) after every transition; wx views must hand the call
+    over to the GUI thread with wx.CallAfter.
+
+    The maze is sampled every poll_periods[0] s in fast_states and during
+    a lick window, when detection latency matters, and every
+    poll_periods[1] s otherwise, to leave the USB bandwidth to the lick
+    pipe and to the other boards on the host. Arm entries with a turn not
+    in allowed_turns (None: any) are held back by the proximity filter
+    '''
+    POLL_PERIODS = (0.001, 0.02) # s, fast and slow
+    fast_states = frozenset()
+    allowed_turns = None
+
+    def __init__(self, maze, acq, scheduler=None, poll_periods=None):
+        self.maze = maze
+        self.acq = acq
+        self.scheduler = scheduler
+        self.poll_periods = poll_periods or Protocol.POLL_PERIODS
+        self.licks = LickRewarder(maze, acq)
+
+        self.lock = threading.RLock()
+        self.state = 'idle'
+        self.done = threading.Event()
+        self.observers = []
+
+        self.group = 'protocol-{}'.format(next(_engine_ids)) # Scheduler group
+        self.epoch = 0 # Bumped to invalidate everything scheduled so far
+        self._handlers = []
+
+    def observe(self, callback):
+        self.observers.append(callback)
+
+    def _set_state(self, state):
+        self.state = state
+        self._update_acquisition()
+        for callback in self.observers:
+            callback(self)
+
+    def _update_acquisition(self):
+        fast = (self.state in self.fast_states) or self.licks.active
+        self.acq.set_rate(1.0 / self.poll_periods[0 if fast else 1])
+        if self.acq.events.filter is not None:
+            self.acq.events.filter.allowed_turns = self.allowed_turns
+
+    def _subscribe(self, handler, event_types):
+        def locked(event):
+            with self.lock:
+                handler(event)
+        self.acq.events.subscribe(locked, event_types)
+        self._handlers.append(locked)
+
+    def _unsubscribe(self):
+        for handler in self._handlers:
+            self.acq.events.unsubscribe(handler)
+        self._handlers = []
+
+    def _frame_now(self):
+        '''
+        Miniscope frame count at this moment. Commands are not sampled, so
+        this comes from the frame clock rather than the last sample, which
+        may be a poll period old
+        '''
+        frame = self.acq.clock.counter_at(monotonic())
+        return self.acq.latest().frame if (frame is None) else frame
+
+    def _schedule(self, delay, func, *args):
+        # Actions that were due before the epoch changed (e.g. by a rewind)
+        # are dropped, even if they were already running up to the lock
+        epoch = self.epoch
+        def locked():
+            with self.lock:
+                if (self.epoch == epoch):
+                    func(*args)
+        return self.scheduler.schedule(delay, locked, group=self.group)
+
+    def _cancel_scheduled(self):
+        # Must not be called with self.lock held: cancel_group waits for a
+        # running action, which may itself be waiting for the lock
+        if self.scheduler is not None:
+            self.scheduler.cancel_group(self.group)
+
+    def close(self):
+        self._cancel_scheduled()
+        with self.lock:
+            self.epoch += 1
+            self._unsubscribe()
+            self.acq.set_rate(1.0 / self.poll_periods[1])
+            if self.acq.events.filter is not None:
+                self.acq.events.filter.allowed_turns = None
+            self.done.set()
+
+# Lick-contingent reward
+#------------------------------------------------------------
+class LickRewarder(object):
+    '''
+    Doses an arm at the first lick onset within a window after its entry.
+    The dose is triggered from the LickOnset callback on the acquisition
+    thread, so a lick is rewarded at most one sample period plus one
+    trigger transaction after it started, and this is measured for every
+    window. Called by the engines with their lock held
+    '''
+    def __init__(self, maze, acq):
+        self.maze = maze
+        self.acq = acq
+        self.rewards = [] # LickReward of every window, in order
+        self._window = None # (trial, arm, window, entry time) while open
+
+    @property
+    def active(self):
+        return self._window is not None
+
+    def open(self, trial, arm, window, entry_time):
+        self.close()
+        self._window = (trial, arm, window, entry_time)
+        print_msg("Waiting up to {} seconds for a lick".format(window))
+
+    def close(self):
+        # A window that is still open ends without a reward
+        if self._window is None:
+            return
+        trial, arm, window, entry_time = self._window
+        self._window = None
+        print_msg("No lick within {} seconds, no reward".format(window))
+        self.rewards.append(LickReward(trial=trial, arm=arm, window=window,
+                                       lick_delay=None, latency=None, worst_case=None))
+
+    def cancel(self, trial):
+        # Forget the window and outcome of a trial that is repeated
+        self._window = None
+        self.rewards = [r for r in self.rewards if r.trial != trial]
+
+    def lick_onset(self, event):
+        '''
+        Doses if the lick is within the open window. Returns the time from
+        the arm entry to the dose, or None
+        '''
+        if self._window is None:
+            return None
+        trial, arm, window, entry_time = self._window
+        if (event.time - entry_time > window):
+            self.close()
+            return None
+
+        self._window = None
+        self.maze.dose(arm)
+        t = monotonic()
+        ring = self.acq.ring
+        prev_time = ring.time_of(ring.count-2) if (ring.count > 1) else event.time
+        reward = LickReward(trial=trial, arm=arm, window=window,
+                            lick_delay=event.time - entry_time,
+                            latency=t - event.time, worst_case=t - prev_time)
+        self.rewards.append(reward)
+        print_msg("Lick reward {:.3f} seconds after entry, trigger latency {:.2f} ms "
+                  "(worst case {:.2f} ms)".format(
+                    reward.lick_delay, reward.latency*1e3, reward.worst_case*1e3))
+        return t - entry_time
+
+    def summary(self):
+        '''
+        The outcomes as plain data, e.g. for the metadata of a session file
+        '''
+        worst = [r.worst_case for r in self.rewards if r.worst_case is not None]
+        return {'rewards': [r._asdict() for r in self.rewards],
+                'max_worst_case': max(worst) if worst else None}
+
+    def report(self):
+        if not self.rewards:
+            return
+        worst = self.summary()['max_worst_case']
+        print_msg("{} of {} lick windows rewarded{}".format(
+            sum(1 for r in self.rewards if r.latency is not None), len(self.rewards),
+            '' if worst is None else ', worst-case trigger latency {:.2f} ms'.format(worst*1e3)))
+
+# Semi-automatic trials
+#------------------------------------------------------------
+class SemiAutoTrials(Protocol):
+    '''
+    Semi-automatic trials (the mouse needs to be handled -- removed and
+    reinserted -- between trials), running a compiled protocol (a list of
+    protocol.CompiledTrial). States, in order:
+        setup           Block rotating into place
+        ready           Waiting for start() (mouse must be in the start arm)
+        start_hold      Recording, start gate closed for START ms
+        open_ready      Waiting for open()
+        running         Start gate open, waiting for an arm entry
+        finish_hold     Goal gate closed, reward pending, for FINISH ms
+                        (with a LICK_WINDOW, until the first lick)
+        finish_ready    Waiting for finish()
+        done            All trials finished
+    rewind() restarts the current trial from any state. With auto=True the
+    start, open and finish steps are taken as soon as they are allowed
+    '''
+    # Block geometry, see protocol.py
+    block_mappings = protocol.block_mappings
+    block_steps = protocol.block_steps
+
+    # Holds and delays come from the compiled protocol; this one is fixed
+    trial_timing = {'RECORDING_STOP': 100} # ms
+    fast_states = frozenset(['running'])
+
+    def __init__(self, maze, acq, scheduler, plan, block_pos,
+                 journal=None, lick_drain=None, auto=False):
+        Protocol.__init__(self, maze, acq, scheduler)
+        self.plan = plan
+        self.trials = [Trial(start=p.start, block=p.block, goal=p.goal, result=None,
+                             time=0.0, reward_delay=0.0, start_frame=None,
+                             open_frame=None, close_frame=None, end_frame=None)
+                       for p in plan]
+        self.num_trials = len(plan)
+        self.block_pos = block_pos
+        self.journal = journal
+        self.lick_drain = lick_drain
+        self.auto = auto
+        self.trial_file = None
+
+        self.trial_index = 0
+        self.num_correct = 0
+        self._reset_trial()
+
+    def _reset_trial(self):
+        self.trial_start = None
+        self.trial_goal = None
+        self.trial_time = 0.0
+        self.reward_delay = 0.0
+        self.trial_result = None
+        self.trial_start_time = None
+
+        self.trial_start_frame = 0
+        self.trial_open_frame = 0
+        self.trial_close_frame = 0
+        self.trial_end_frame = 0
+
+    def replay(self, records):
+        '''
+        Restore the results, counters and block position of journaled trials
+        '''
+        for record in records:
+            index = record['index']
+            self.trials[index] = Trial(**record['trial'])
+            self.trial_index = max(self.trial_index, index+1)
+            self.block_pos = record['block_pos']
+        self.num_correct = sum(1 for trial, p in zip(self.trials, self.plan)[:self.trial_index]
+                               if trial.result in p.rewarded)
+        print_msg("Resuming at trial {} of {} ({} correct so far)".format(
+            self.trial_index+1, self.num_trials, self.num_correct))
+
+    def begin(self):
+        with self.lock:
+            self._subscribe(self._arm_entered, ArmEntered)
+            if any(p.lick_window for p in self.plan):
+                self._subscribe(self._lick_onset, LickOnset)
+            if (self.trial_index < self.num_trials):
+                self._initialize_trial()
+            else:
+                print_msg("All trials are finished")
+                self._set_state('done')
+                self.done.set()
+
+    def elapsed_time(self):
+        if self.trial_start_time is None:
+            return 0.0
+        return time.time() - self.trial_start_time # sec
+
+    def _initialize_trial(self):
+        print_msg("*")
+        print_msg("Initializing trial {}...".format(self.trial_index+1)) # 1-index for the biologists
+        self.epoch += 1
+        self._reset_trial()
+        self.licks.cancel(self.trial_index)
+
+        trial = self.plan[self.trial_index]
+        self.trial_start = trial.start
+        self.trial_goal = trial.goal
+        self.poll_periods = trial.poll_periods
+
+        # Actuate the maze. Only the start gate is closed
+        self.maze.set_gates(trial.gates)
+
+        self._set_state('setup')
+        self._set_block_pos(trial)
+
+    def _set_block_pos(self, trial):
+        '''
+        Schedule the rotations that bring the block in place for trial, then
+        move on to the ready state
+        '''
+        rotations = trial.rotations
+        if (rotations is None) or (trial.from_block != self.block_pos):
+            # Not where the protocol expects it (first trial, or a rewind
+            # that interrupted a rotation)
+            rotations = protocol.rotation_plan(self.block_pos, trial.block)
+
+        delay = 0.0
+        for r in rotations:
+            self._schedule(delay, self._rotate_block, r)
+            delay += trial.rotation_step
+        self._schedule(delay, self._block_ready)
+
+    def _rotate_block(self, r):
+        # Track the block position step by step, so it stays accurate if the
+        # remaining rotations are cancelled
+        self.maze.rotate(r)
+        self.block_pos = SemiAutoTrials.block_steps[(r, self.block_pos)]
+
+    def _block_ready(self):
+        self._set_state('ready')
+        if self.auto:
+            self._try_start()
+
+    def _try_start(self):
+        if (self.acq.position() == self.trial_start):
+            self.start()
+
+    def start(self):
+        with self.lock:
+            if (self.state != 'ready'):
+                return False
+            state = self.acq.latest()
+            if (self.acq.position() != self.trial_start):
+                print_msg("Error! Cannot start trial. Is the mouse in the start arm?", 'error')
+                return False
+
+            print_msg("Starting trial {}".format(self.trial_index+1))
+            self.trial_start_time = time.time()
+            self.trial_start_frame = state.frame+1
+            self.maze.start_recording() # Trigger miniscope
+
+            hold = self.plan[self.trial_index].start_hold
+            print_msg("Holding at start for {} seconds".format(hold))
+            self._set_state('start_hold')
+            self._schedule(hold, self._start_held)
+            return True
+
+    def _start_held(self):
+        self._set_state('open_ready')
+        if self.auto:
+            self.open()
+
+    def open(self):
+        with self.lock:
+            if (self.state != 'open_ready'):
+                return False
+            self.maze.actuate_gate(self.trial_start, False) # Open the gate
+            self.trial_open_frame = self._frame_now()
+            self._set_state('running')
+            return True
+
+    def _arm_entered(self, event):
+        if (self.state == 'ready') and self.auto and (event.to_arm == self.trial_start):
+            self.start()
+            return
+        if (self.state != 'running') or (event.to_arm == self.trial_start):
+            return
+
+        # First arm entry away from the start arm
+        mouse_pos = event.to_arm
+        self.trial_close_frame = event.frame
+        print_msg("Mouse detected at {}".format(mouse_pos))
+
+        self.maze.actuate_gate(mouse_pos, True) # Close the gate
+        self.trial_result = mouse_pos
+
+        # Reward conditions
+        trial = self.plan[self.trial_index]
+        if mouse_pos in trial.rewarded:
+            if trial.lick_window:
+                self.licks.open(self.trial_index, mouse_pos, trial.lick_window, event.time)
+            else:
+                delay = random.uniform(*trial.reward_delay)
+                print_msg("Reward delayed by {:.3f} seconds".format(delay))
+                self._schedule(delay, self.maze.dose, mouse_pos)
+                self.reward_delay = delay
+
+        print_msg("Holding at finish for {} seconds".format(trial.finish_hold))
+        self._set_state('finish_hold')
+        self._schedule(trial.finish_hold, self._finish_held)
+
+    def _lick_onset(self, event):
+        if (self.state == 'finish_hold'):
+            delay = self.licks.lick_onset(event)
+            if delay is not None:
+                self.reward_delay = delay
+                self._update_acquisition()
+
+    def _finish_held(self):
+        self.licks.close()
+        self._update_acquisition()
+        self.trial_time = self.elapsed_time()
+        self.maze.stop_recording() # Turn off miniscope
+
+        # Let the last frames come in before reading the counter
+        self._schedule(SemiAutoTrials.trial_timing['RECORDING_STOP']/1000, self._recording_stopped)
+
+    def _recording_stopped(self):
+        self.trial_end_frame = self.acq.latest().frame
+        self._set_state('finish_ready')
+        if self.auto:
+            self.finish()
+
+    def rewind(self):
+        self._cancel_scheduled()
+        with self.lock:
+            if (self.state == 'done'):
+                return
+            self.maze.stop_recording()
+            print_msg("Re-setup trial {}".format(self.trial_index+1))
+            self._initialize_trial()
+
+    def finish(self):
+        with self.lock:
+            if (self.state != 'finish_ready'):
+                return False
+            print_msg("Finish trial {}".format(self.trial_index+1))
+
+            # Record the result
+            trial = self.trials[self.trial_index]
+            new_trial = trial._replace(result=self.trial_result,
+                                       time=self.trial_time,
+                                       reward_delay=self.reward_delay,
+                                       start_frame=self.trial_start_frame,
+                                       open_frame=self.trial_open_frame,
+                                       close_frame=self.trial_close_frame,
+                                       end_frame=self.trial_end_frame)
+            self.trials[self.trial_index] = new_trial
+            if self.journal is not None:
+                self.journal.append(self.trial_index, new_trial, block_pos=self.block_pos)
+
+            # Update running stats
+            if self.trial_result in self.plan[self.trial_index].rewarded:
+                self.num_correct += 1
+
+            # Move to next trial
+            self.trial_index += 1
+            if (self.trial_index < self.num_trials):
+                self._initialize_trial()
+            else:
+                print_msg("*")
+                rate = self.acq.clock.rate
+                print_msg("Miniscope recorded {} frames total{}".format(
+                            self.acq.latest().frame,
+                            '' if rate is None else ' ({:.3f} Hz)'.format(rate)))
+                self.licks.report()
+                self._set_state('done')
+                self.done.set()
+            return True
+
+    def save_result(self, output_file):
+        print_msg("Writing results to {}...".format(output_file))
+
+        # Save trial results
+        results.save_trials(output_file, self.trials)
+        meta = {'trial_file': self.trial_file,
+                'frame_clock': self.acq.clock.summary()}
+        if self.licks.rewards:
+            meta['lick_rewards'] = self.licks.summary()
+        if self.lick_drain is None:
+            results.save_session(results.session_file_name(output_file), 'semiauto',
+                                 self.trials, meta=meta)
+            return
+
+        # Save lickometer data
+        self.lick_drain.stop()
+        licks = self.lick_drain.licks()
+        results.save_licks(results.lick_file_name(output_file), licks, len(licks))
+
+        # Everything again, in the binary container used for analysis
+        meta.update(lick_stream=self.lick_drain.stream_file,
+                    lost_lick_bytes=self.lick_drain.num_lost_bytes)
+        results.save_session(results.session_file_name(output_file), 'semiauto',
+                             self.trials, licks=licks, meta=meta)
+
+    def close(self):
+        Protocol.close(self)
+        self.maze.stop_recording()
+        if self.journal is not None:
+            self.journal.close()
+
+def read_semiauto_journal(path):
+    '''
+    (header, records) of the journal of a semi-auto session. Raises
+    protocol.ProtocolError for the journal of another protocol
+    '''
+    header, records = read_journal(path)
+    if (header.get('protocol') != 'semiauto') or ('trial_file' not in header):
+        raise protocol.ProtocolError("{} is not the journal of a semi-auto session (protocol {})".format(
+                                        path, header.get('protocol', 'unknown')))
+    return header, records
+
+def lick_stream_name(rig=None):
+    return 'lickstream-{}{}.bin'.format(rig + '-' if rig else '', time.strftime('%Y%m%d-%H%M%S'))
+
+def check_resume(maze, resume_file, header, records):
+    '''
+    Path of the lick stream of the journaled session, which is stored
+    relative to the journal. Raises ResumeError if the stream is missing,
+    or if the frame counter was reset since the last journaled trial, as
+    the licks and frames of the resumed trials would not line up with
+    those of the journaled ones
+    '''
+    stream_file = header.get('lick_stream')
+    if stream_file is not None:
+        stream_file = os.path.join(os.path.dirname(resume_file), stream_file)
+        if not os.path.exists(stream_file):
+            raise ResumeError("The lick stream {} of {} is missing".format(stream_file, resume_file))
+
+    end_frames = [r['trial']['end_frame'] for r in records
+                  if r['trial'].get('end_frame') is not None]
+    frame_count = maze.get_frame_count()
+    if end_frames and (frame_count < max(end_frames)):
+        raise ResumeError("The miniscope frame counter ({}) is behind the last trial of {} (frame {}), "
+                          "it was reset since".format(frame_count, resume_file, max(end_frames)))
+    return stream_file
+
+def open_semiauto(maze, acq, scheduler, trial_file, block_pos, resume_file=None, auto=False,
+                  rig=None):
+    '''
+    Set up a semi-auto session from a trial file, or continue the one
+    recorded in the journal resume_file: starts the trial journal and the
+    lickometer stream (next to the journal), and resets the miniscope frame
+    counter. A resumed session keeps the frame counter and appends to its
+    lick stream, so that the frames and licks of its journaled trials stay
+    valid (see check_resume). The rig name goes into the names of the
+    session files, so that rigs sharing a directory do not write to the
+    same files
+    '''
+    stream_file = None
+    if resume_file is not None:
+        header, records = read_semiauto_journal(resume_file)
+        trial_file = header['trial_file']
+        stream_file = check_resume(maze, resume_file, header, records)
+        if records:
+            block_pos = records[-1]['block_pos']
+
+    # Fails (protocol.ProtocolError, ResumeError) before anything in the maze moves
+    plan = protocol.compile_protocol(trial_file, block_pos)
+    print_msg("Loaded {} containing {} trials".format(trial_file, len(plan)))
+
+    engine = SemiAutoTrials(maze, acq, scheduler, plan, block_pos, auto=auto)
+    engine.trial_file = trial_file
+    resumed = stream_file is not None
+    if resume_file is None:
+        journal_file = journal_file_name(trial_file, rig)
+        stream_name = lick_stream_name(rig)
+        stream_file = os.path.join(os.path.dirname(journal_file), stream_name)
+        engine.journal = TrialJournal(journal_file, 'semiauto',
+                                      trial_file=trial_file, num_trials=len(plan),
+                                      lick_stream=stream_name)
+    else:
+        engine.replay(records)
+        engine.journal = TrialJournal(resume_file, 'semiauto')
+        if not resumed:
+            # Journals from before the lick stream was recorded
+            print_msg("Warning! {} does not name its lick stream, starting a new one".format(
+                        resume_file), 'warning')
+            stream_file = os.path.join(os.path.dirname(resume_file), lick_stream_name(rig))
+
+    # Reset the frame counter of a new session, and stream the lickometer
+    # buffer to disk over the course of the session
+    if not resumed:
+        maze.reset_scope_counter()
+    engine.lick_drain = LickDrain(maze, acq, stream_file, resume=resumed)
+    engine.lick_drain.start()
+    return engine
+
+# Continuous egocentric training
+#------------------------------------------------------------
+class EgoTraining(Protocol):
+    '''
+    Continuous egocentric training: every turn in the rewarded direction is
+    dosed, and the block is rotated to compensate every turn. With a
+    lick_window (s), the dose waits for the first lick in that window
+    instead; the window of the last turn ends with the training. States
+    are idle, running, paused and completed
+    '''
+    fast_states = frozenset(['running'])
+    allowed_turns = frozenset(['left', 'right']) # The T-block closes the way straight on
+
+    def __init__(self, maze, acq, prev_pos, turn='left', num_trials=50, journal_file=None,
+                 lick_window=None, poll_periods=None):
+        Protocol.__init__(self, maze, acq, poll_periods=poll_periods)
+        self.prev_pos = prev_pos
+        self.turn = turn
+        self.num_trials = num_trials
+        self.journal_file = journal_file
+        self.journal = None
+        self.lick_window = lick_window
+
+        self.trial_index = 0
+        self.trial_start_time = 0
+        self.trials = []
+        self.num_left = 0
+        self.num_right = 0
+
+        self.maze.actuate_gate(self.prev_pos, True) # Close initial gate
+
+    def start(self):
+        '''
+        Start training, or resume it after a pause
+        '''
+        with self.lock:
+            if (self.state == 'idle'):
+                self.trial_index = 1 # 1-index for the biologists
+                self.trial_start_time = time.time()
+                if self.journal_file is not None:
+                    self.journal = TrialJournal(self.journal_file, 'ego',
+                                                turn=self.turn, num_trials=self.num_trials)
+                self.maze.actuate_gate(self.prev_pos, False) # Open gate
+            elif (self.state != 'paused'):
+                return
+            self._subscribe(self._arm_entered, ArmEntered)
+            if self.lick_window:
+                self._subscribe(self.licks.lick_onset, LickOnset)
+            self._set_state('running')
+
+    def pause(self):
+        with self.lock:
+            if (self.state == 'running'):
+                self._unsubscribe()
+                self._set_state('paused')
+
+    def _arm_entered(self, event):
+        if (self.state != 'running'):
+            return
+        pos = event.to_arm
+        if (self.prev_pos == pos):
+            return
+
+        if (event.from_arm == self.prev_pos) and (event.turn is None):
+            # The proximity filter accepted an impossible transition: the
+            # mouse was moved by hand, and carries on from its new arm
+            print_msg("Mouse was moved from {} to {}, no reward".format(self.prev_pos, pos),
+                      'warning')
+            self.licks.close()
+            self.prev_pos = pos
+            return
+
+        print_msg('* * * Trial {} of {} * * *'.format(self.trial_index, self.num_trials))
+        print_msg('Detected mouse at {}'.format(pos))
+        self.licks.close()
+
+        try:
+            if (event.from_arm == self.prev_pos):
+                turn = event.turn
+            else:
+                # Mouse was moved by hand while training was paused
+                turn = PlusMaze.pos_to_turn[(self.prev_pos, pos)]
+            print_msg('mouse executed {} turn'.format(turn))
+
+            if (turn == self.turn):
+                print_msg("Reward for {} turn".format(turn))
+                if self.lick_window:
+                    self.licks.open(self.trial_index, pos, self.lick_window, event.time)
+                else:
+                    self.maze.dose(pos)
+
+            self.maze.compensate_turn(turn)
+
+            current_time = time.time()
+            elapsed_time = current_time - self.trial_start_time # sec
+
+            # Keep tally
+            self.trials.append(EgoTrial(start=self.prev_pos,
+                                        end=pos,
+                                        turn=turn,
+                                        time=elapsed_time,
+                                        ))
+            if self.journal is not None:
+                self.journal.append(len(self.trials)-1, self.trials[-1])
+            if (turn == 'left'):
+                self.num_left += 1
+            elif (turn == 'right'):
+                self.num_right += 1
+
+            # Set up for next trial
+            self.prev_pos = pos
+            self.trial_start_time = current_time
+
+            if (self.trial_index == self.num_trials):
+                self._completed_training(pos)
+            else:
+                self.trial_index += 1
+                self._set_state('running') # Notify observers of the new tally
+
+        except KeyError, e:
+            print_msg("Warning! Did the mouse jump over the T-block?", 'warning')
+            print_msg("Pausing training!", 'warning')
+            print_msg("Place the mouse back at {} before resuming training".format(
+                        self.prev_pos))
+            self.pause()
+
+    def _completed_training(self, final_pos):
+        self._unsubscribe()
+        self.licks.close()
+        self.maze.actuate_gate(final_pos, True) # Close the gate
+        print_msg("Completed training!")
+        self.licks.report()
+        self._set_state('completed')
+        self.done.set()
+
+    def save_result(self, output_file):
+        print_msg("Writing results to {}...".format(output_file))
+        results.save_ego_trials(output_file, self.trials)
+        meta = {'turn': self.turn}
+        if self.licks.rewards:
+            meta['lick_rewards'] = self.licks.summary()
+        results.save_session(results.session_file_name(output_file), 'ego', self.trials,
+                             meta=meta)
+
+    def close(self):
+        Protocol.close(self)
+        if self.journal is not None:
+            self.journal.close()
+
+# Autoreward
+#------------------------------------------------------------
+class AutoReward(Protocol):
+    '''
+    Free exploration. Arm entries are rewarded according to mode (None,
+    'every', 'right' or 'left'), at the first lick within lick_window (s)
+    if given, and the block is turned at random after every entry. The
+    maze is only sampled fast while a lick window is open: this runs for
+    hours whenever the controller is idle
+    '''
+    def __init__(self, maze, acq, scheduler, mode=None, lick_window=None, poll_periods=None):
+        Protocol.__init__(self, maze, acq, scheduler, poll_periods=poll_periods)
+        self.mode = mode
+        self.rng = random.Random()
+        self.lick_window = lick_window
+        self.num_entries = 0
+
+    def start(self):
+        with self.lock:
+            if (self.state != 'running'):
+                self._subscribe(self._arm_entered, ArmEntered)
+                if self.lick_window:
+                    self._subscribe(self._lick_onset, LickOnset)
+                self._set_state('running')
+
+    def stop(self):
+        with self.lock:
+            self._unsubscribe()
+            self.licks.close()
+            self._set_state('idle')
+
+    def _arm_entered(self, event):
+        pos = event.to_arm
+        turn = event.turn
+
+        print_msg("*")
+        print_msg("Detected mouse at {}".format(pos))
+        self.licks.close()
+        self.num_entries += 1
+
+        if turn is None:
+            print_msg("Warning! Did the mouse jump over the T-block?", 'warning')
+            self._update_acquisition()
+            return
+        print_msg("Mouse executed {} turn".format(turn))
+
+        if (self.mode == 'every') or (self.mode == turn):
+            print_msg("Autoreward ({})".format(
+                'every arm' if (self.mode == 'every') else (turn + ' turn')))
+            if self.lick_window:
+                self.licks.open(self.num_entries, pos, self.lick_window, event.time)
+                self._schedule(self.lick_window, self._window_ended, self.num_entries)
+            else:
+                self.maze.dose(pos)
+        self._update_acquisition()
+
+        dice = self.rng.randint(0,1)
+        if (turn == 'straight'):
+            if dice:
+                print_msg("Rotate block by 180 deg")
+                self.scheduler.sequence([(self.maze.rotate, 'center ccw'),
+                                         1.0,
+                                         (self.maze.rotate, 'center ccw')],
+                                        group=self.group)
+            else:
+                print_msg("Block kept in same position")
+        else:
+            self.maze.rotate('center ccw' if dice else 'center cw')
+
+    def _lick_onset(self, event):
+        if self.licks.active:
+            self.licks.lick_onset(event)
+            self._update_acquisition()
+
+    def _window_ended(self, entry):
+        # Unless a lick or a later entry closed it already
+        if self.licks.active and (self.num_entries == entry):
+            self.licks.close()
+            self._update_acquisition()
+
+    def close(self):
+        Protocol.close(self)
+        with self.lock:
+            self.licks.close()
@@ -0,0 +1,221 @@
+from __future__ import division
+
+import collections
+import Queue
+import traceback
+
+from plusmaze import PlusMaze
+from util import *
+
+# Maze events. Each event carries the host monotonic time and the frame
+# count of the sample at which it was detected. An arm entry also carries
+# the number of raw samples that read the new arm before it was accepted,
+# and its confidence: the fraction of the samples since the new arm was
+# first read that agree (see ProximityFilter)
+ArmEntered = collections.namedtuple('ArmEntered', 'time frame from_arm to_arm turn confidence samples')
+LickOnset = collections.namedtuple('LickOnset', 'time frame')
+LickOffset = collections.namedtuple('LickOffset', 'time frame')
+FrameCounterWrapped = collections.namedtuple('FrameCounterWrapped', 'time frame')
+
+FRAME_COUNTER_MODULUS = 1 << 32
+
+class ProximityFilter(object):
+    '''
+    Debounces the proximity detector, whose last-detected bits can glitch
+    for a sample. A new arm is accepted once `votes` of the last `window`
+    samples read it and it was first read at least `min_dwell` s before.
+    Transitions whose turn (pos_to_turn) is not in allowed_turns, e.g. a
+    straight run across the T-block in egocentric training, are held back
+    until the new arm has been read for `relocate_after` s: the mouse was
+    then moved by hand, and the entry is reported with turn None
+    '''
+    VOTES = 3
+    WINDOW = 5 # Samples
+    MIN_DWELL = 0.002 # s
+    RELOCATE_AFTER = 1.0 # s
+
+    def __init__(self, votes=VOTES, window=WINDOW, min_dwell=MIN_DWELL,
+                 relocate_after=RELOCATE_AFTER):
+        self.votes = votes
+        self.min_dwell = min_dwell
+        self.relocate_after = relocate_after
+        self.allowed_turns = None # Any
+
+        self.recent = collections.deque(maxlen=window)
+        self.pos = None # Accepted arm
+        self.num_glitches = 0 # Readings that were never accepted
+        self.num_rejected = 0 # Transitions held back as impossible
+        self._reset_candidate()
+
+    def _reset_candidate(self):
+        self.candidate = None
+        self.candidate_time = None
+        self.candidate_samples = 0 # Samples that read the candidate,
+        self.candidate_total = 0   # of all samples since it was first read
+        self.candidate_rejected = False
+
+    def update(self, state):
+        '''
+        Feeds a sample. Returns (from_arm, to_arm, turn, confidence,
+        samples) if it completes an arm entry, else None
+        '''
+        pos = state.pos
+        self.recent.append(pos)
+        if (pos == self.pos) and (self.candidate is None):
+            return None
+        if self.pos is None:
+            self.pos = pos # The first sample only establishes the arm
+            return None
+
+        if (pos != self.pos) and (pos != self.candidate):
+            if self.candidate is not None:
+                self.num_glitches += 1
+            self._reset_candidate()
+            self.candidate = pos
+            self.candidate_time = state.time
+        self.candidate_total += 1
+        if (pos == self.candidate):
+            self.candidate_samples += 1
+
+        votes = self.recent.count(self.candidate)
+        if (votes == 0):
+            # The reading went away without being accepted
+            self.num_glitches += 1
+            self._reset_candidate()
+            return None
+        dwell = state.time - self.candidate_time
+        if (votes < self.votes) or (dwell < self.min_dwell):
+            return None
+
+        turn = PlusMaze.pos_to_turn.get((self.pos, self.candidate))
+        if (self.allowed_turns is not None) and (turn not in self.allowed_turns):
+            if not self.candidate_rejected:
+                self.candidate_rejected = True
+                self.num_rejected += 1
+                print_msg("Ignoring {} turn from {} to {}".format(turn, self.pos, self.candidate),
+                          'warning')
+            if (dwell < self.relocate_after):
+                return None
+            turn = None
+
+        entry = (self.pos, self.candidate, turn,
+                 self.candidate_samples/self.candidate_total, self.candidate_samples)
+        self.pos = self.candidate
+        self._reset_candidate()
+        return entry
+
+def diff_states(prev, state, entry=None):
+    '''
+    Returns the list of events implied by going from sample prev to state.
+    entry is the arm entry accepted by the ProximityFilter, if any; without
+    a filter every change of the detected arm is an entry
+    '''
+    events = []
+    if (entry is None) and (state.pos != prev.pos):
+        entry = (prev.pos, state.pos, PlusMaze.pos_to_turn.get((prev.pos, state.pos)), 1.0, 1)
+    if entry is not None:
+        # turn is None for transitions that are not in pos_to_turn
+        from_arm, to_arm, turn, confidence, samples = entry
+        events.append(ArmEntered(time=state.time,
+                                 frame=state.frame,
+                                 from_arm=from_arm,
+                                 to_arm=to_arm,
+                                 turn=turn,
+                                 confidence=confidence,
+                                 samples=samples))
+    if (state.lick != prev.lick):
+        lick_event = LickOnset if state.lick else LickOffset
+        events.append(lick_event(time=state.time, frame=state.frame))
+
+    # A small decrease is a counter reset (reset_scope_counter), not a wrap
+    if (prev.frame - state.frame > FRAME_COUNTER_MODULUS // 2):
+        events.append(FrameCounterWrapped(time=state.time, frame=state.frame))
+    return events
+
+class EventStream(object):
+    '''
+    Diffs consecutive maze samples into events. Subscribers are called
+    synchronously from whichever thread feeds the stream (normally the
+    acquisition thread), so callbacks must be quick and must not touch wx.
+    Use listen() to consume events from another thread instead
+    '''
+    def __init__(self, prox_filter=None):
+        self.prev = None
+        self.subscribers = [] # Replaced (not mutated) so update needs no lock
+        self.filter = prox_filter
+
+    def subscribe(self, callback, event_types=None):
+        self.subscribers = self.subscribers + [(callback, event_types)]
+
+    def unsubscribe(self, callback):
+        self.subscribers = [s for s in self.subscribers if s[0] != callback]
+
+    def listen(self, event_types=None):
+        return EventListener(self, event_types)
+
+    def update(self, state):
+        if self.filter is None:
+            entry = None
+        else:
+            entry = self.filter.update(state)
+            if (state.pos != self.filter.pos):
+                state = state._replace(pos=self.filter.pos)
+
+        if self.prev is None:
+            events = [] # First sample only establishes the baseline
+        else:
+            events = diff_states(self.prev, state, entry)
+        self.prev = state
+
+        for event in events:
+            for callback, event_types in self.subscribers:
+                if (event_types is None) or isinstance(event, event_types):
+                    try:
+                        callback(event)
+                    except Exception:
+                        print_msg("Exception in event subscriber:")
+                        traceback.print_exc()
+        return events
+
+    def feed(self, samples):
+        '''
+        Generator over the events in an iterable of samples
+        '''
+        for state in samples:
+            for event in self.update(state):
+                yield event
+
+class EventListener(object):
+    '''
+    Queues events from an EventStream for consumption on another thread,
+    e.g. from a wx timer
+    '''
+    def __init__(self, stream, event_types=None):
+        self.stream = stream
+        self.queue = Queue.Queue()
+        stream.subscribe(self.queue.put, event_types)
+
+    def poll(self):
+        '''
+        Generator over the events received since the last poll
+        '''
+        while True:
+            try:
+                yield self.queue.get_nowait()
+            except Queue.Empty:
+                return
+
+    def get(self, timeout=None):
+        # Block until an event arrives. Returns None on timeout
+        try:
+            return self.queue.get(timeout=timeout)
+        except Queue.Empty:
+            return None
+
+    def skip(self):
+        # Discard any events that have not been consumed yet
+        for event in self.poll():
+            pass
+
+    def close(self):
+        self.stream.unsubscribe(self.queue.put)
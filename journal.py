@@ -0,0 +1,81 @@
+'''
+Append-only trial journal. The first line of a journal is a header naming
+the session; every line after it is one finished trial. Lines are JSON and
+each one is flushed and fsync'd as it is written, so a crash loses at most
+the trial in progress.
+'''
+import json
+import os
+import time
+
+from util import *
+
+def journal_file_name(name, rig=None):
+    '''
+    e.g. trials-20240101-120000.journal for the trial file trials.txt, or
+    trials-rig1-20240101-120000.journal for the rig rig1
+    '''
+    base = os.path.splitext(os.path.basename(name))[0]
+    if rig:
+        base = '{}-{}'.format(base, rig)
+    return '{}-{}.journal'.format(base, time.strftime('%Y%m%d-%H%M%S'))
+
+class TrialJournal(object):
+    '''
+    Opens path for appending. Header fields (e.g. the trial file) are only
+    written when the journal is new
+    '''
+    def __init__(self, path, protocol, **header):
+        self.path = path
+        new = not os.path.exists(path) or (os.path.getsize(path) == 0)
+        if not new:
+            # Terminate an entry left incomplete by a crash
+            with open(path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                torn = (f.read(1) != '\n')
+        self._f = open(path, 'a')
+        if new:
+            header.update(protocol=protocol, created=get_time())
+            self._write(header)
+        elif torn:
+            self._f.write('\n')
+        print_msg("Journaling trials to {}".format(path))
+
+    def _write(self, record):
+        self._f.write(json.dumps(record, sort_keys=True) + '\n')
+        self._f.flush()
+        os.fsync(self._f.fileno())
+
+    def append(self, index, trial, **extra):
+        '''
+        Record trial (a namedtuple) as the index-th trial of the session
+        '''
+        record = dict(extra, index=index, trial=trial._asdict())
+        self._write(record)
+
+    def close(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+
+def read_journal(path):
+    '''
+    Returns (header, records). A partially written last line, as left by a
+    crash, is ignored
+    '''
+    header = None
+    records = []
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                print_msg("Warning! Skipping incomplete journal entry in {}".format(path), 'warning')
+                continue
+            if header is None:
+                header = record
+            else:
+                records.append(record)
+    if header is None:
+        raise ValueError("{} is not a trial journal".format(path))
+    return header, records
@@ -0,0 +1,165 @@
+'''
+Lick metrics of semi-auto sessions, computed with NumPy array operations
+only (no Python loops over frames or trials), so that a cohort of
+hundreds of sessions takes seconds.
+
+Licks are a bool array with one entry per miniscope frame, and trials a
+structured array with the start_frame, open_frame, close_frame, end_frame
+and reward_delay fields of the trial table (as SessionFile.trials; a frame
+of -1 was not recorded). Each lick is counted at its onset frame, the
+first frame of a run of lick frames.
+
+Usage: python lickanalysis.py session.pmz [more sessions]
+'''
+from __future__ import division
+
+import os
+
+import numpy as np
+
+import sessionfile
+
+DEFAULT_FRAME_RATE = 20.0 # Hz, when the session does not record it
+BOUT_GAP = 0.5 # s, longest pause between the licks of a bout
+REWARD_WINDOW = (2.0, 2.0) # s, before and after the reward
+
+TRIAL_DTYPE = [('start_frame', '<i8'), ('open_frame', '<i8'),
+               ('close_frame', '<i8'), ('end_frame', '<i8'),
+               ('reward_delay', '<f8')]
+
+# Per-trial metrics. Latencies and durations in s, rates in licks/s;
+# NaN where they do not apply (no lick, no reward, frames not recorded)
+#   num_licks           Lick onsets from start_frame up to end_frame
+#   first_lick_latency  From close_frame (arm entry) to the first lick
+#   pre_reward_rate     Lick rate in the REWARD_WINDOW before the reward,
+#   post_reward_rate    and after it (close_frame + reward_delay)
+#   num_bouts           Bouts starting within the trial
+#   bout_licks          Mean licks per bout
+#   bout_duration       Mean duration of a bout
+METRICS_DTYPE = [('num_licks', '<i4'), ('first_lick_latency', '<f8'),
+                 ('pre_reward_rate', '<f8'), ('post_reward_rate', '<f8'),
+                 ('num_bouts', '<i4'), ('bout_licks', '<f8'), ('bout_duration', '<f8')]
+
+BOUT_DTYPE = [('start', '<i8'), ('end', '<i8'), ('num_licks', '<i4')]
+
+def lick_edges(licks):
+    '''
+    Onset frames (first lick frame) and offset frames (first frame after)
+    of every lick
+    '''
+    licks = np.asarray(licks, dtype=bool)
+    if (licks.size == 0):
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    padded = np.concatenate(([False], licks, [False])).view(np.int8)
+    change = np.diff(padded)
+    return np.flatnonzero(change == 1), np.flatnonzero(change == -1)
+
+def find_bouts(onsets, offsets, max_gap):
+    '''
+    Groups licks separated by at most max_gap frames into bouts. Returns
+    a BOUT_DTYPE array; end is the frame after the last lick
+    '''
+    bouts = np.zeros(len(onsets), dtype=BOUT_DTYPE)
+    if (len(onsets) == 0):
+        return bouts
+    new_bout = np.concatenate(([True], onsets[1:] - offsets[:-1] > max_gap))
+    first = np.flatnonzero(new_bout)
+    last = np.concatenate((first[1:], [len(onsets)])) - 1
+    bouts = bouts[:len(first)]
+    bouts['start'] = onsets[first]
+    bouts['end'] = offsets[last]
+    bouts['num_licks'] = last - first + 1
+    return bouts
+
+def _count(sorted_frames, lo, hi):
+    # Number of sorted_frames within [lo, hi), for arrays of lo and hi
+    return np.searchsorted(sorted_frames, hi) - np.searchsorted(sorted_frames, lo)
+
+def trial_metrics(licks, trials, frame_rate=DEFAULT_FRAME_RATE,
+                  bout_gap=BOUT_GAP, reward_window=REWARD_WINDOW):
+    '''
+    METRICS_DTYPE array with one entry per trial
+    '''
+    onsets, offsets = lick_edges(licks)
+    bouts = find_bouts(onsets, offsets, bout_gap*frame_rate)
+
+    start = trials['start_frame']
+    close = trials['close_frame']
+    end = trials['end_frame']
+    recorded = (start >= 0) & (end >= start)
+    closed = recorded & (close >= start) & (close <= end)
+    m = np.zeros(len(trials), dtype=METRICS_DTYPE)
+
+    m['num_licks'] = np.where(recorded, _count(onsets, start, end), 0)
+
+    # First lick after the arm entry, within the trial
+    i = np.searchsorted(onsets, close)
+    first = onsets[np.minimum(i, len(onsets)-1)] if len(onsets) else np.zeros_like(close)
+    licked = closed & (i < len(onsets)) & (first < end)
+    m['first_lick_latency'] = np.where(licked, (first - close)/frame_rate, np.nan)
+
+    # Licking around the reward
+    before, after = reward_window
+    rewarded = closed & (trials['reward_delay'] > 0)
+    reward = close + trials['reward_delay']*frame_rate
+    m['pre_reward_rate'] = np.where(
+        rewarded, _count(onsets, reward - before*frame_rate, reward)/before, np.nan)
+    m['post_reward_rate'] = np.where(
+        rewarded, _count(onsets, reward, reward + after*frame_rate)/after, np.nan)
+
+    # Bouts that start within the trial
+    j0 = np.searchsorted(bouts['start'], start)
+    j1 = np.searchsorted(bouts['start'], end)
+    num_bouts = np.where(recorded, j1 - j0, 0)
+    licks_sum = np.concatenate(([0], np.cumsum(bouts['num_licks'])))
+    frames_sum = np.concatenate(([0], np.cumsum(bouts['end'] - bouts['start'])))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        m['num_bouts'] = num_bouts
+        m['bout_licks'] = np.where(num_bouts > 0, (licks_sum[j1] - licks_sum[j0])/num_bouts, np.nan)
+        m['bout_duration'] = np.where(
+            num_bouts > 0, (frames_sum[j1] - frames_sum[j0])/(num_bouts*frame_rate), np.nan)
+    return m
+
+def load_session(path):
+    '''
+    (licks, trials, frame_rate) of a session container (.pmz), or of the
+    text result file of a semi-auto session and its -lick file
+    '''
+    if (os.path.splitext(path)[1] == '.pmz'):
+        session = sessionfile.SessionFile(path)
+        rate = (session.meta.get('frame_clock') or {}).get('rate') or DEFAULT_FRAME_RATE
+        return session.licks(), session.trials, rate
+
+    rows = []
+    with open(path, 'r') as f:
+        for line in f:
+            fields = line.split()
+            if (len(fields) == 9):
+                frames = [-1 if (v == 'None') else int(v) for v in fields[5:9]]
+                rows.append(tuple(frames) + (float(fields[4]),))
+    trials = np.array(rows, dtype=TRIAL_DTYPE)
+
+    name, ext = os.path.splitext(path)
+    with open(name + '-lick' + ext, 'rb') as f:
+        chars = np.frombuffer(f.read(), dtype=np.uint8)
+    licks = chars[(chars == ord('0')) | (chars == ord('1'))] == ord('1')
+    return licks, trials, DEFAULT_FRAME_RATE
+
+def session_metrics(path, **kw):
+    licks, trials, frame_rate = load_session(path)
+    return trial_metrics(licks, trials, frame_rate, **kw)
+
+if (__name__ == '__main__'):
+    import argparse
+    parser = argparse.ArgumentParser(description='Per-trial lick metrics of sessions')
+    parser.add_argument('sessions', nargs='+', help='.pmz or text result files')
+    parser.add_argument('--bout-gap', type=float, default=BOUT_GAP, help='s')
+    args = parser.parse_args()
+
+    names = [name for name, dtype in METRICS_DTYPE]
+    print 'session trial ' + ' '.join(names)
+    for path in args.sessions:
+        m = session_metrics(path, bout_gap=args.bout_gap)
+        for k, row in enumerate(m):
+            print '{} {} {}'.format(path, k+1, ' '.join('{:.3f}'.format(v) if isinstance(v, float)
+                                                      else str(v) for v in row))
@@ -0,0 +1,105 @@
+import itertools
+
+# Lookup tables indexed by byte value
+_POPCOUNT = bytearray(bin(b).count('1') for b in xrange(256))
+_BITS = [tuple(bool(b & (1<<j)) for j in xrange(8)) for b in xrange(256)]
+_LINES = [''.join('1\n' if bit else '0\n' for bit in bits) for bits in _BITS]
+
+class LickBuffer(object):
+    '''
+    Bit-packed view of the lickometer buffer. The lick state of frame i is
+    bit (i % 8) of byte (i // 8), i.e. little-endian as stored by the FPGA.
+    Neither construction nor slicing copies the underlying bytearray
+    '''
+    __slots__ = ('data', 'offset', 'length')
+
+    def __init__(self, data, length=None, offset=0):
+        self.data = data # bytearray
+        self.offset = offset # in bits
+        if length is None:
+            length = 8*len(data) - offset
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.length)
+            if (step != 1):
+                return [self._get(i) for i in xrange(start, stop, step)]
+            return LickBuffer(self.data, max(0, stop-start), self.offset+start)
+
+        if (key < 0):
+            key += self.length
+        if not (0 <= key < self.length):
+            raise IndexError("LickBuffer index out of range")
+        return self._get(key)
+
+    def __iter__(self):
+        head = self.offset & 7
+        first, last = self._byte_range()
+        bits = itertools.chain.from_iterable(_BITS[self.data[k]] for k in xrange(first, last))
+        return itertools.islice(bits, head, head + self.length)
+
+    def _get(self, i):
+        i += self.offset
+        return bool(self.data[i>>3] & (1 << (i & 7)))
+
+    def _byte_range(self):
+        return (self.offset >> 3, (self.offset + self.length + 7) >> 3)
+
+    def _aligned(self):
+        # Split into leading bits, whole bytes [first, last) and trailing bits
+        start = self.offset
+        stop = self.offset + self.length
+        first = (start + 7) >> 3
+        last = stop >> 3
+        if (first > last): # Within a single byte
+            return (xrange(start, stop), first, first, xrange(0))
+        return (xrange(start, 8*first), first, last, xrange(8*last, stop))
+
+    def count(self, value=True):
+        '''
+        Number of frames whose lick state equals value
+        '''
+        head, first, last, tail = self._aligned()
+        data = self.data
+        num_set = sum(data[first:last].translate(_POPCOUNT))
+        for i in itertools.chain(head, tail):
+            num_set += (data[i>>3] >> (i & 7)) & 1
+        return num_set if value else (self.length - num_set)
+
+    def tobytes(self):
+        '''
+        Packed contents as a str, starting at bit 0 of the first byte
+        '''
+        first, last = self._byte_range()
+        if (self.offset & 7 == 0):
+            data = self.data[first:last]
+        else:
+            data = bytearray((self.length + 7) >> 3)
+            for i, bit in enumerate(self):
+                if bit:
+                    data[i >> 3] |= (1 << (i & 7))
+        data = bytearray(data)
+        if (self.length & 7):
+            data[-1] &= (1 << (self.length & 7)) - 1 # Clear bits past the end
+        return str(data)
+
+    def to_list(self):
+        '''
+        Lick state of every frame as a list of bools (legacy representation)
+        '''
+        return list(self)
+
+    def write_text(self, f, num_frames=None):
+        '''
+        Write one "0" or "1" line per frame to the file object f
+        '''
+        buf = self if (num_frames is None) else self[:num_frames]
+        head, first, last, tail = buf._aligned()
+        data = buf.data
+        f.write(''.join('1\n' if buf._get(i - buf.offset) else '0\n' for i in head))
+        f.write(''.join(_LINES[b] for b in data[first:last]))
+        f.write(''.join('1\n' if buf._get(i - buf.offset) else '0\n' for i in tail))
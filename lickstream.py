@@ -0,0 +1,149 @@
+import fractions
+import os
+import threading
+import time
+
+from lickbuffer import LickBuffer
+from plusmaze import PlusMaze
+from util import *
+
+class LickDrain(threading.Thread):
+    '''
+    Drains the FPGA lickometer buffer incrementally during a session. The
+    buffer holds one bit per miniscope frame, written at address
+    (frame % buffer length), so the drain follows the frame counter and
+    reads every byte once all 8 of its frames have been recorded. Drained
+    bytes (bit-packed, little-endian) are appended to `stream_file` and
+    kept in memory for live access. As long as the drain keeps up, the
+    session is not limited by the size of the FPGA buffer. With resume, an
+    existing stream is continued where it left off, which needs the frame
+    counter not to have been reset since (see engine.check_resume)
+    '''
+    PIPE_BLOCK = 16 # bytes; ReadFromPipeOut lengths must be a multiple of this
+    DRAIN_PERIOD = 1.0 # s
+
+    def __init__(self, maze, acq, stream_file, period=DRAIN_PERIOD, resume=False):
+        threading.Thread.__init__(self, name='PlusMazeLickDrain')
+        self.daemon = True
+
+        self.maze = maze
+        self.acq = acq
+        self.stream_file = stream_file
+        self.period = period
+        self.resume = resume
+
+        self.data = bytearray() # Drained buffer contents
+        self.num_lost_bytes = 0
+
+        self._buffer_length = PlusMaze.lick_settings['BUFFER_LENGTH_IN_BYTES']
+        self._running = False
+        self._f = None
+
+    def start(self):
+        # The drain reads from the start of the buffer, i.e. frame 0
+        self.maze.reset_lick_pipe()
+        if self.resume and os.path.exists(self.stream_file):
+            self._resume()
+        self._f = open(self.stream_file, 'ab')
+        self._running = True
+        threading.Thread.start(self)
+        print_msg("Streaming lickometer data to {}".format(self.stream_file))
+
+    def _resume(self):
+        # Pipe reads are whole blocks, so cut the stream back to whole
+        # blocks (the rest is still in the FPGA buffer, and is read again)
+        # and skip past them in the pipe. The pipe address wraps around the
+        # buffer, so skipping any multiple of the buffer length leaves it
+        # in place
+        with open(self.stream_file, 'rb') as f:
+            data = bytearray(f.read())
+        keep = _round_down(len(data))
+        with open(self.stream_file, 'r+b') as f:
+            f.truncate(keep)
+        self.data = data[:keep]
+
+        period = LickDrain.PIPE_BLOCK*self._buffer_length // \
+                 fractions.gcd(LickDrain.PIPE_BLOCK, self._buffer_length)
+        skip = keep % period
+        while (skip > 0):
+            n = min(skip, _round_down(self._buffer_length))
+            if (self.maze.read_lick_pipe(bytearray(n)) < 0):
+                print_msg("Error! Lickometer drain failed", 'error')
+                break
+            skip -= n
+        print_msg("Resuming lickometer stream {} at frame {}".format(self.stream_file, 8*keep))
+
+    def stop(self):
+        '''
+        Stop draining, after reading out all frames recorded so far
+        '''
+        if self._f is None:
+            return # Already stopped
+
+        self._running = False
+        if self.is_alive():
+            self.join()
+        self.drain(final=True)
+        self._f.close()
+        self._f = None
+        print_msg("Drained {} bytes of lickometer data".format(len(self.data)))
+
+    def num_frames(self):
+        return min(8*len(self.data), self.acq.latest().frame)
+
+    def licks(self):
+        '''
+        Lick data drained so far, as a LickBuffer
+        '''
+        return LickBuffer(self.data, self.num_frames())
+
+    def drain(self, final=False):
+        '''
+        Read all complete bytes that have not been read yet. Reads are whole
+        pipe blocks; on the final drain the last block is padded, and the
+        padding is trimmed to the frame count
+        '''
+        num_frames = self.acq.latest().frame
+        if final:
+            available = (num_frames + 7)//8 - len(self.data)
+        else:
+            available = num_frames//8 - len(self.data)
+
+        if (available > self._buffer_length):
+            # The FPGA has overwritten bytes we had not read yet. Skip past
+            # them in the pipe, and record them as no licks
+            lost = _round_up(available - self._buffer_length)
+            print_msg("Warning! Lickometer drain fell behind, {} bytes lost".format(lost), 'warning')
+            self.num_lost_bytes += lost
+            if (self.maze.read_lick_pipe(bytearray(lost)) < 0):
+                print_msg("Error! Lickometer drain failed", 'error')
+                return
+            self._append(bytearray(lost))
+            available -= lost
+
+        num_bytes = _round_up(available) if final else _round_down(available)
+        if (num_bytes <= 0):
+            return
+
+        buf = bytearray(num_bytes)
+        code = self.maze.read_lick_pipe(buf)
+        if (code < 0):
+            print_msg("Error! Lickometer drain failed (code {})".format(code), 'error')
+            return
+        self._append(buf[:min(num_bytes, available)])
+
+    def _append(self, chunk):
+        self.data += chunk
+        self._f.write(chunk)
+        self._f.flush()
+
+    def run(self):
+        while self._running:
+            self.drain()
+            time.sleep(self.period)
+
+def _round_down(num_bytes):
+    return (num_bytes // LickDrain.PIPE_BLOCK) * LickDrain.PIPE_BLOCK
+
+def _round_up(num_bytes):
+    return -(-num_bytes // LickDrain.PIPE_BLOCK) * LickDrain.PIPE_BLOCK
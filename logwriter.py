@@ -0,0 +1,176 @@
+'''
+Asynchronous logging of print_msg. Once start_logging is called, print_msg
+only appends a record (monotonic time, level, rig, thread, message) to a
+queue, which costs a few us in the polling callbacks. A background thread
+formats the records and writes them in batches: to the console as before,
+and to a log file with one JSON object per line, for analysis:
+
+    {"t": 1234.567891, "wall": "2026-10-18 14:03:12.345", "level": "info",
+     "rig": "rig1", "thread": "acquisition", "msg": "Mouse detected at east"}
+
+t is the host monotonic clock of the other timestamps of a session
+(samples, events, traces), and wall the time of day. The file is rotated
+when it reaches max_bytes, keeping backups FILE.1 (newest) to FILE.N.
+'''
+import atexit
+import collections
+import datetime
+import json
+import os
+import sys
+import threading
+import time
+
+import util
+from util import *
+
+class AsyncLogger(object):
+    FLUSH_PERIOD = 0.05 # s, between batches
+    MAX_BYTES = 10 << 20
+    BACKUPS = 5
+
+    def __init__(self, log_file=None, console=True, level='info', rig=None,
+                 max_bytes=MAX_BYTES, backups=BACKUPS):
+        if level not in LOG_LEVELS:
+            raise ValueError("unknown log level '{}'".format(level))
+        self.log_file = log_file
+        self.console = console
+        self.threshold = LOG_LEVELS[level]
+        self.rig = rig
+        self.max_bytes = max_bytes
+        self.backups = backups
+
+        # deque.append and popleft are atomic, so the queue needs no lock
+        self.queue = collections.deque()
+        self.num_records = 0
+
+        # Wall time of the monotonic clock, fixed once so that the hot path
+        # only reads the monotonic clock
+        self.wall_offset = time.time() - monotonic()
+
+        self.f = None
+        if log_file:
+            self.f = open(log_file, 'a')
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='logwriter')
+        self.thread.daemon = True
+
+    def log(self, msg, level='info'):
+        if (LOG_LEVELS.get(level, 0) < self.threshold):
+            return
+        self.queue.append((monotonic(), level, threading.current_thread().name, msg))
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        while not self.stopping.wait(AsyncLogger.FLUSH_PERIOD):
+            self.flush()
+        self.flush()
+
+    def _drain(self):
+        records = []
+        try:
+            while True:
+                records.append(self.queue.popleft())
+        except IndexError:
+            pass
+        return records
+
+    def _wall(self, t):
+        wall = datetime.datetime.fromtimestamp(t + self.wall_offset)
+        return wall.strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+
+    def flush(self):
+        records = self._drain()
+        if not records:
+            return
+        self.num_records += len(records)
+        prefix = '[{}] '.format(self.rig) if self.rig else ''
+
+        if self.console:
+            lines = ['{}{}: {}\n'.format(prefix, self._wall(t)[:19], msg)
+                     for t, level, thread, msg in records]
+            sys.stdout.write(''.join(lines))
+            sys.stdout.flush()
+
+        if self.f is not None:
+            lines = [json.dumps(collections.OrderedDict([
+                        ('t', round(t, 6)), ('wall', self._wall(t)), ('level', level),
+                        ('rig', self.rig), ('thread', thread), ('msg', str(msg))])) + '\n'
+                     for t, level, thread, msg in records]
+            self.f.write(''.join(lines))
+            self.f.flush()
+            if (self.f.tell() >= self.max_bytes):
+                self._rotate()
+
+    def _rotate(self):
+        self.f.close()
+        for k in xrange(self.backups - 1, 0, -1):
+            src = '{}.{}'.format(self.log_file, k)
+            if os.path.exists(src):
+                dst = '{}.{}'.format(self.log_file, k+1)
+                if os.path.exists(dst):
+                    os.remove(dst)
+                os.rename(src, dst)
+        if (self.backups > 0):
+            dst = self.log_file + '.1'
+            if os.path.exists(dst):
+                os.remove(dst)
+            os.rename(self.log_file, dst)
+        else:
+            os.remove(self.log_file)
+        self.f = open(self.log_file, 'a')
+
+    def stop(self):
+        self.stopping.set()
+        self.thread.join()
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+def start_logging(log_file=None, console=True, level='info', rig=None, **kw):
+    '''
+    Routes print_msg to a background writer, until stop_logging (called at
+    exit otherwise; a multiprocessing worker must call it itself)
+    '''
+    stop_logging()
+    logger = AsyncLogger(log_file, console, level, rig, **kw)
+    logger.start()
+    util._logger = logger
+    return logger
+
+def stop_logging():
+    '''
+    Writes the queued records and goes back to printing right away
+    '''
+    logger = util._logger
+    if logger is None:
+        return
+    util._logger = None
+    logger.stop()
+
+atexit.register(stop_logging)
+
+if (__name__ == '__main__'):
+    import argparse
+    parser = argparse.ArgumentParser(description='Time print_msg with and without the async logger')
+    parser.add_argument('-n', type=int, default=10000)
+    args = parser.parse_args()
+
+    def cost():
+        t0 = monotonic()
+        for k in xrange(args.n):
+            print_msg("Mouse detected at east")
+        return (monotonic() - t0)/args.n*1e6
+
+    devnull = open(os.devnull, 'w')
+    stdout, sys.stdout = sys.stdout, devnull
+    try:
+        sync_us = cost()
+        start_logging(os.devnull, console=True, level='info')
+        async_us = cost()
+        stop_logging()
+    finally:
+        sys.stdout = stdout
+    print "print_msg: {:.2f} us synchronous, {:.2f} us queued".format(sync_us, async_us)
@@ -1,12 +1,31 @@
 import collections
-import ok
+import contextlib
+import hashlib
+import json
+import os
+import threading
 import time
 
+try:
+    import ok
+except ImportError:
+    ok = None # Only simulated devices (see simdevice.py) are available
+
+import calibration
+from lickbuffer import LickBuffer
 from util import *
 
 GateSetting = collections.namedtuple('Gate', 'epaddr cl op')
 DoseSetting = collections.namedtuple('Dose', 'trig_bit epaddr dose_vol dose_rep')
 
+class MazeState(collections.namedtuple('MazeState', 'time pos lick frame raw')):
+    '''
+    Immutable record of the maze hardware state. All fields are decoded from
+    a single UpdateWireOuts transaction, so they are consistent with each other.
+    The time is the host monotonic clock (in seconds) at the transaction
+    '''
+    __slots__ = ()
+
 class DeviceError(Exception):
     pass
 
@@ -20,6 +39,10 @@ class PlusMaze(object):
     BITFILE = 'toplevel.bit'
     POLL_PERIOD = 100 # ms
 
+    # Fingerprint of the bitfile last loaded onto each board, one file per
+    # serial so that the rigs of a host never write the same file
+    FPGA_CACHE = os.path.join(os.path.expanduser('~'), '.plusmaze_fpga')
+
     # HARDWARE SETTINGS
     #------------------------------------------------------------
     gate_settings = {'north': GateSetting(epaddr=0x02, cl=500, op=1100),
@@ -93,24 +116,76 @@ class PlusMaze(object):
     turn_compensation = {'right': 'center ccw',
                          'left' : 'center cw',
                         }
-    def __init__(self):
-        self._initialize_fpga()
+    def __init__(self, xem=None, force_reprogram=False, serial=None, calibration=None):
+        '''
+        Opens the FPGA with the given serial (default: the first device).
+        Pass `xem` to use a device other than ok.FrontPanel, e.g.
+        simdevice.SimFrontPanel. The bitfile is only loaded if the board is
+        not already running it, unless `force_reprogram` is set.
+        The gates and doses are set up from the calibration profile of the
+        board (see calibration.py), with `calibration` overrides on top
+        '''
+        # Serializes access to the FrontPanel handle, which is shared between
+        # the acquisition thread and the GUI
+        self.lock = threading.RLock()
+
+        # Wire-in values last sent to the FPGA, and writes waiting for the
+        # end of the current batch
+        self.wire_ins = {}
+        self._pending_wire_ins = {}
+        self._batch_depth = 0
+
+        self._initialize_fpga(xem, force_reprogram, serial)
+        self._load_calibration(calibration)
         self.setup_dosing()
 
-    def _initialize_fpga(self):
-        self.xem = ok.FrontPanel()
+    @staticmethod
+    def frontpanel(xem=None):
+        '''
+        xem, or a new ok.FrontPanel if it is None
+        '''
+        if xem is not None:
+            return xem
+        elif ok is not None:
+            return ok.FrontPanel()
+        else:
+            print_msg("Opal Kelly FrontPanel library (ok) is not installed")
+            raise DeviceError
+
+    @staticmethod
+    def list_serials(xem=None):
+        '''
+        Serials of all the FrontPanel devices attached to this host
+        '''
+        xem = PlusMaze.frontpanel(xem)
+        return [xem.GetDeviceListSerial(i) for i in xrange(xem.GetDeviceCount())]
+
+    def _initialize_fpga(self, xem=None, force_reprogram=False, serial=None):
+        self.xem = PlusMaze.frontpanel(xem)
+
         num_devices = self.xem.GetDeviceCount()
         print_msg("Detected {} device{}".format(num_devices,
-                                                '' if num_devices==2 else 's'))
+                                                '' if num_devices==1 else 's'))
         if (num_devices == 0):
             raise DeviceError
         else:
-            # FIXME: Always opens the first device
-            serial = self.xem.GetDeviceListSerial(0)
+            if serial is None:
+                serial = self.xem.GetDeviceListSerial(0)
+            self.serial = serial
             if (self.xem.NoError != self.xem.OpenBySerial(serial)):
                 print_msg("FPGA with serial {} could not be opened".format(serial))
                 raise DeviceError
 
+            # The cache is for real devices only, and a bitfile that can't
+            # be read is always loaded (for ConfigureFPGA to report it)
+            fingerprint = PlusMaze._bitfile_fingerprint()
+            cached = (fingerprint is not None) and not getattr(self.xem, 'simulated', False)
+            if (cached and not force_reprogram
+                    and PlusMaze._load_fingerprint(serial) == fingerprint
+                    and self.xem.IsFrontPanelEnabled()):
+                print_msg("Bitfile {} already loaded on {}".format(PlusMaze.BITFILE, serial))
+                return
+
             if (self.xem.NoError != self.xem.LoadDefaultPLLConfiguration()):
                 print_msg("Unable to set default PLL config")
                 raise DeviceError
@@ -120,93 +195,201 @@ class PlusMaze(object):
                 raise DeviceError
             else:
                 print_msg("Loaded bitfile {} to {}".format(PlusMaze.BITFILE, serial))
+                if cached:
+                    PlusMaze._save_fingerprint(serial, fingerprint)
+
+    def _load_calibration(self, overrides=None):
+        try:
+            # Simulated boards run on the defaults, real ones should be calibrated
+            self.gate_settings, self.dose_settings = calibration.settings_for(
+                self.serial, overrides, required=not getattr(self.xem, 'simulated', False))
+            self.registers = calibration.compile_tables(self.gate_settings, self.dose_settings)
+        except calibration.CalibrationError, e:
+            print_msg("Invalid calibration of {}:\n{}".format(self.serial, e))
+            raise DeviceError
+
+    @staticmethod
+    def _bitfile_fingerprint():
+        try:
+            with open(PlusMaze.BITFILE, 'rb') as f:
+                return hashlib.sha1(f.read()).hexdigest()
+        except IOError:
+            return None # Let ConfigureFPGA report the missing bitfile
+
+    @staticmethod
+    def _fingerprint_file(serial):
+        return os.path.join(PlusMaze.FPGA_CACHE, '{}.json'.format(serial))
+
+    @staticmethod
+    def _load_fingerprint(serial):
+        try:
+            with open(PlusMaze._fingerprint_file(serial), 'r') as f:
+                return json.load(f)['fingerprint']
+        except (IOError, ValueError, KeyError, TypeError):
+            return None
+
+    @staticmethod
+    def _save_fingerprint(serial, fingerprint):
+        # Written to a temporary file and renamed, so that a crash never
+        # leaves a torn file behind
+        path = PlusMaze._fingerprint_file(serial)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            if not os.path.isdir(PlusMaze.FPGA_CACHE):
+                os.makedirs(PlusMaze.FPGA_CACHE)
+            with open(tmp_path, 'w') as f:
+                json.dump({'serial': serial, 'fingerprint': fingerprint}, f, indent=2, sort_keys=True)
+            if os.path.exists(path):
+                os.remove(path) # os.rename does not replace files on Windows
+            os.rename(tmp_path, path)
+        except (IOError, OSError):
+            print_msg("Warning! Could not write {}".format(path), 'warning')
 
     def setup_dosing(self):
-        dose_reps = 0x00
-        for d in PlusMaze.ordered_dirs:
-            dose_reps += PlusMaze.dose_settings[d].dose_rep << \
-                            (4*(PlusMaze.dose_settings[d].trig_bit - 1))
-            self.xem.SetWireInValue(PlusMaze.dose_settings[d].epaddr,
-                                    PlusMaze.dose_settings[d].dose_vol)
-        self.xem.SetWireInValue(PlusMaze.dose_settings['REPS_EPADDR'], dose_reps)
-        self.xem.UpdateWireIns()
+        # Dose volumes, and the packed reps word
+        with self.batch():
+            for epaddr, val in self.registers.dosing_writes:
+                self.set_wire_in(epaddr, val)
+
+    @contextlib.contextmanager
+    def batch(self):
+        '''
+        Buffers wire-in writes made within the block, and sends them with a
+        single UpdateWireIns at the end. Batches may be nested
+        '''
+        with self.lock:
+            self._batch_depth += 1
+            try:
+                yield
+            finally:
+                self._batch_depth -= 1
+                if (self._batch_depth == 0) and self._pending_wire_ins:
+                    self.xem.UpdateWireIns()
+                    self.wire_ins.update(self._pending_wire_ins)
+                    self._pending_wire_ins = {}
+
+    def set_wire_in(self, epaddr, val):
+        '''
+        Writes a wire-in, skipping the write if the FPGA already has val
+        '''
+        with self.batch():
+            if (self._pending_wire_ins.get(epaddr, self.wire_ins.get(epaddr)) != val):
+                self.xem.SetWireInValue(epaddr, val)
+                self._pending_wire_ins[epaddr] = val
 
     def start_recording(self):
-        self.xem.ActivateTriggerIn(PlusMaze.scope_settings['TRIG_EPADDR'],
-                                   PlusMaze.scope_settings['trig_map']['start'])
+        with self.lock:
+            self.xem.ActivateTriggerIn(*self.registers.scope_triggers['start'])
         print_msg("Started miniscope recording")
 
     def stop_recording(self):
-        self.xem.ActivateTriggerIn(PlusMaze.scope_settings['TRIG_EPADDR'],
-                                   PlusMaze.scope_settings['trig_map']['stop'])
+        with self.lock:
+            self.xem.ActivateTriggerIn(*self.registers.scope_triggers['stop'])
         print_msg("Stopped miniscope recording")
 
     def reset_scope_counter(self):
-        self.xem.ActivateTriggerIn(PlusMaze.scope_settings['TRIG_EPADDR'],
-                                   PlusMaze.scope_settings['trig_map']['reset'])
+        with self.lock:
+            self.xem.ActivateTriggerIn(*self.registers.scope_triggers['reset'])
         time.sleep(0.1)
-        frame_count = self.get_frame_count()
+        frame_count = self.snapshot().frame
         print_msg("Reset miniscope counter (new value: {})".format(frame_count))
 
+    def snapshot(self):
+        '''
+        Sample position, lick and frame count with one USB round-trip
+        '''
+        with self.lock:
+            t0 = monotonic()
+            self.xem.UpdateWireOuts()
+            t1 = monotonic()
+            raw = self.xem.GetWireOutValue(PlusMaze.prox_settings['LASTDETECT_EPADDR'])
+            frame_lo = self.xem.GetWireOutValue(PlusMaze.scope_settings['FRAME_LO_EPADDR'])
+            frame_hi = self.xem.GetWireOutValue(PlusMaze.scope_settings['FRAME_HI_EPADDR'])
+
+        return PlusMaze.decode_state(0.5*(t0+t1), raw, (frame_hi<<16) + frame_lo)
+
+    @staticmethod
+    def decode_state(t, raw, frame):
+        '''
+        Build a MazeState from the raw status wire and frame count. Note that
+        the lick bit shares the status wire (0x20) with the proximity detector
+        '''
+        last_detected_id = raw & PlusMaze.prox_settings['LASTDETECT_MASK']
+        return MazeState(time=t,
+                         pos=PlusMaze.prox_settings['names'][last_detected_id],
+                         lick=bool(check_bit(raw, PlusMaze.lick_settings['LICK_BIT'])),
+                         frame=frame & 0xFFFFFFFF,
+                         raw=raw)
+
     def get_frame_count(self):
-        self.xem.UpdateWireOuts()
-        frame_lo = self.xem.GetWireOutValue(PlusMaze.scope_settings['FRAME_LO_EPADDR'])
-        frame_hi = self.xem.GetWireOutValue(PlusMaze.scope_settings['FRAME_HI_EPADDR'])
-        return ((frame_hi<<16) + frame_lo)
+        return self.snapshot().frame
 
     def get_last_detected_pos(self):
-        self.xem.UpdateWireOuts()
-        last_detected_id = self.xem.GetWireOutValue(PlusMaze.prox_settings['LASTDETECT_EPADDR'])
-        last_detected_id = last_detected_id & PlusMaze.prox_settings['LASTDETECT_MASK']
-        last_detected_name = PlusMaze.prox_settings['names'][last_detected_id]
-        return last_detected_name
+        return self.snapshot().pos
 
     def get_lick_state(self):
-        self.xem.UpdateWireOuts()
-        status = self.xem.GetWireOutValue(PlusMaze.lick_settings['LICK_EPADDR'])
-        return check_bit(status, PlusMaze.lick_settings['LICK_BIT'])
+        return self.snapshot().lick
 
     def actuate_gate(self, gate, closed):
-        val = PlusMaze.gate_settings[gate].cl if closed else PlusMaze.gate_settings[gate].op
-        self.xem.SetWireInValue(PlusMaze.gate_settings[gate].epaddr, val)
-        self.xem.UpdateWireIns()
+        epaddr, val = self.registers.gate_writes[(gate, bool(closed))]
+        self.set_wire_in(epaddr, val)
         print_msg("{} gate {}".format(gate, "closed" if closed else "opened"))
 
+    def set_gates(self, gates):
+        '''
+        Moves several gates at once. gates maps arm to closed (bool)
+        '''
+        with self.batch():
+            for gate, closed in gates.iteritems():
+                self.actuate_gate(gate, closed)
+
     def dose(self, d):
-        self.xem.ActivateTriggerIn(PlusMaze.dose_settings['TRIG_EPADDR'],
-                                   PlusMaze.dose_settings[d].trig_bit)
+        with self.lock:
+            self.xem.ActivateTriggerIn(*self.registers.dose_triggers[d])
         print_msg("Dosed {}".format(d))
 
     def compensate_turn(self, turn):
         self.rotate(PlusMaze.turn_compensation[turn])
 
     def rotate(self, r):
-        self.xem.ActivateTriggerIn(PlusMaze.rotation_settings['TRIG_EPADDR'],
-                                   PlusMaze.rotation_settings['trig_map'][r])
+        with self.lock:
+            self.xem.ActivateTriggerIn(*self.registers.rotation_triggers[r])
         print_msg("Rotating {}".format(r))
 
-    def pull_lick_buffer(self):
+    def pull_lick_buffer(self, as_list=False):
+        '''
+        Returns the lickometer buffer as a LickBuffer, or as a list of bools
+        if as_list is set
+        '''
         # First, reset the buffer read address counter
-        self.xem.ActivateTriggerIn(PlusMaze.lick_settings['TRIG_EPADDR'],
-                                   PlusMaze.lick_settings['trig_map']['reset_addr'])
+        self.reset_lick_pipe()
         time.sleep(0.1)
 
         # Pull the buffer contents in binary. Note that contents are
         # stored little-endian
         bin_buf = bytearray(PlusMaze.lick_settings['BUFFER_LENGTH_IN_BYTES'])
-        code = self.xem.ReadFromPipeOut(PlusMaze.lick_settings['PIPE_EPADDR'], bin_buf)
+        code = self.read_lick_pipe(bin_buf)
         if (code < 0):
-            print_msg("WARNING: pull_lick_buffer failed!")
+            print_msg("Error! pull_lick_buffer failed", 'error')
         else:
             print_msg("Transferred {} bytes from FPGA lickometer buffer".format(code))
 
-        # Convert the binary buffer contents into list of bools, for readability
-        buffer_length_in_bits = 8*PlusMaze.lick_settings['BUFFER_LENGTH_IN_BYTES']
-        buf = [False,]*buffer_length_in_bits
-        for i in xrange(PlusMaze.lick_settings['BUFFER_LENGTH_IN_BYTES']):
-            bin_byte = bin_buf[i]
-            for j in xrange(8):
-                ind = 8*i + j
-                buf[ind] = ((1<<j) & bin_byte == (1<<j))
-
+        buf = LickBuffer(bin_buf)
+        if as_list:
+            return buf.to_list()
         return buf
+
+    def reset_lick_pipe(self):
+        # Rewind the lickometer pipe read address to the start of the buffer
+        with self.lock:
+            self.xem.ActivateTriggerIn(PlusMaze.lick_settings['TRIG_EPADDR'],
+                                       PlusMaze.lick_settings['trig_map']['reset_addr'])
+
+    def read_lick_pipe(self, buf):
+        '''
+        Reads len(buf) bytes from the lickometer pipe at the current read
+        address, which advances (and wraps around the buffer). Returns the
+        number of bytes read, or a negative error code
+        '''
+        with self.lock:
+            return self.xem.ReadFromPipeOut(PlusMaze.lick_settings['PIPE_EPADDR'], buf)
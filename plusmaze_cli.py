@@ -0,0 +1,185 @@
+'''
+Run a protocol without the GUI (and without wx), e.g. on a rack machine or
+against the simulated maze in CI:
+
+    python plusmaze_cli.py --sim semiauto trials.txt -o results.txt
+    python plusmaze_cli.py ego --turn left --num-trials 50 -o ego.txt
+    python plusmaze_cli.py autoreward --mode every --duration 600
+
+Semi-auto trials run with auto=True: each trial starts as soon as the mouse
+is in the start arm, and opens and finishes as soon as the holds are over.
+With --sim, the virtual mouse is placed in the start arm for every trial.
+
+The run_* functions call report(engine) every WAIT_PERIOD, if given; the
+supervisor (see supervisor.py) uses this to collect the status of its rigs.
+Messages are written by a background thread (see logwriter.py), and with
+--log FILE also to a machine-readable log.
+'''
+import argparse
+import time
+
+import tracing
+from logwriter import start_logging
+from acquisition import Acquisition
+from engine import AutoReward, EgoTraining, ResumeError, open_semiauto, read_semiauto_journal
+from journal import journal_file_name
+from plusmaze import PlusMaze, DeviceError
+from protocol import ProtocolError, compile_protocol
+from scheduler import ActionScheduler
+from util import *
+
+WAIT_PERIOD = 0.1 # s
+
+def default_output(args):
+    return 'autobackup-{}.txt'.format(args.rig) if args.rig else 'autobackup.txt'
+
+def run_semiauto(args, maze, acq, scheduler, sim, report=None):
+    try:
+        engine = open_semiauto(maze, acq, scheduler, args.trial_file, acq.position(),
+                               resume_file=args.resume, auto=True, rig=args.rig)
+    except ResumeError, e:
+        raise SystemExit(str(e))
+    engine.begin()
+    try:
+        while not engine.done.wait(WAIT_PERIOD):
+            if (sim is not None) and (engine.state == 'ready'):
+                start = engine.trials[engine.trial_index].start
+                if (acq.position() != start):
+                    with maze.lock:
+                        sim.place_mouse(start)
+            if report is not None:
+                report(engine)
+    finally:
+        engine.close()
+        engine.save_result(args.output or default_output(args))
+    print_msg("{} of {} trials correct".format(engine.num_correct, engine.trial_index))
+
+def run_ego(args, maze, acq, scheduler, sim, report=None):
+    engine = EgoTraining(maze, acq, acq.position(), turn=args.turn,
+                         num_trials=args.num_trials,
+                         journal_file=journal_file_name('egotraining', args.rig),
+                         lick_window=args.lick_window)
+    engine.start()
+    try:
+        while not engine.done.wait(WAIT_PERIOD):
+            if report is not None:
+                report(engine)
+    finally:
+        engine.close()
+        if args.output:
+            engine.save_result(args.output)
+    print_msg("{} left, {} right turns".format(engine.num_left, engine.num_right))
+
+def run_autoreward(args, maze, acq, scheduler, sim, report=None):
+    engine = AutoReward(maze, acq, scheduler, mode=args.mode, lick_window=args.lick_window)
+    engine.start()
+    try:
+        end_time = monotonic() + args.duration
+        while (monotonic() < end_time) and not engine.done.wait(WAIT_PERIOD):
+            if report is not None:
+                report(engine)
+    finally:
+        engine.close()
+        engine.licks.report()
+
+def make_parser():
+    parser = argparse.ArgumentParser(description='Run a plus maze protocol headless')
+    parser.add_argument('--sim', action='store_true',
+                        help='run against a simulated maze instead of the FPGA')
+    parser.add_argument('--force-reprogram', action='store_true',
+                        help='load the bitfile even if the FPGA is already running it')
+    parser.add_argument('--serial', default=None,
+                        help='serial of the FPGA to open (default: the first device)')
+    parser.add_argument('--rig', default=None,
+                        help='name of the rig, in the session file names and messages (default: the serial)')
+    parser.add_argument('--seed', type=int, default=None, help='seed of the simulation')
+    parser.add_argument('--entry-licks', type=float, default=0.0, metavar='P',
+                        help='probability that the simulated mouse licks on entering an arm')
+    parser.add_argument('--trace', metavar='BASE', default=None,
+                        help='profile the USB transactions, to BASE.trace.json and BASE.latency.txt')
+    parser.add_argument('--log', metavar='FILE', default=None,
+                        help='also write the messages to FILE, one JSON record per line')
+    parser.add_argument('--log-level', choices=sorted(LOG_LEVELS, key=LOG_LEVELS.get),
+                        default='info')
+    subparsers = parser.add_subparsers(dest='protocol')
+
+    p = subparsers.add_parser('semiauto', help='semi-auto trials from a trial file')
+    p.add_argument('trial_file', nargs='?')
+    p.add_argument('--resume', metavar='JOURNAL', help='continue an interrupted session')
+    p.add_argument('-o', '--output', help='result file (default: autobackup[-RIG].txt)')
+    p.set_defaults(run=run_semiauto)
+
+    p = subparsers.add_parser('ego', help='continuous egocentric training')
+    p.add_argument('--turn', choices=['left', 'right'], default='left')
+    p.add_argument('--num-trials', type=int, default=50)
+    p.add_argument('--lick-window', type=float, default=None,
+                   help='s, reward the first lick within this time of the turn')
+    p.add_argument('-o', '--output', help='result file')
+    p.set_defaults(run=run_ego)
+
+    p = subparsers.add_parser('autoreward', help='free exploration with autoreward')
+    p.add_argument('--mode', choices=['every', 'left', 'right'], default=None)
+    p.add_argument('--duration', type=float, default=600.0, help='s')
+    p.add_argument('--lick-window', type=float, default=None,
+                   help='s, reward the first lick within this time of the entry')
+    p.set_defaults(run=run_autoreward)
+    return parser
+
+def check_args(parser, args):
+    if args.rig is None:
+        args.rig = args.serial
+    if (args.protocol == 'semiauto'):
+        if not (args.trial_file or args.resume):
+            parser.error('semiauto needs a trial file or --resume')
+        if args.resume:
+            try:
+                read_semiauto_journal(args.resume)
+            except (IOError, ValueError), e: # ProtocolError is a ValueError
+                raise SystemExit(str(e))
+        elif args.trial_file:
+            # Check the protocol before touching the maze
+            try:
+                compile_protocol(args.trial_file)
+            except ProtocolError, e:
+                raise SystemExit(str(e))
+
+def run(args, report=None, **maze_settings):
+    '''
+    Opens the maze and runs the protocol in args. maze_settings (e.g. the
+    calibration overrides of a rig) are passed on to PlusMaze
+    '''
+    sim = None
+    if args.sim:
+        from simdevice import SimFrontPanel
+        serials = (args.serial,) if args.serial else ('SIM00001',)
+        sim = SimFrontPanel(serials=serials, p_entry_lick=args.entry_licks, seed=args.seed)
+
+    try:
+        xem = sim
+        if args.trace:
+            xem = tracing.TracedDevice(PlusMaze.frontpanel(sim))
+        maze = PlusMaze(xem=xem, force_reprogram=args.force_reprogram,
+                        serial=args.serial, **maze_settings)
+    except DeviceError:
+        raise SystemExit("Error initializing the FPGA")
+
+    acq = Acquisition(maze)
+    acq.start()
+    scheduler = ActionScheduler()
+    scheduler.start()
+    try:
+        args.run(args, maze, acq, scheduler, sim, report)
+    except KeyboardInterrupt:
+        print_msg("Interrupted")
+    finally:
+        scheduler.stop()
+        acq.stop()
+        if args.trace:
+            xem.save(args.trace)
+
+if (__name__ == '__main__'):
+    parser = make_parser()
+    args = parser.parse_args()
+    check_args(parser, args)
+    start_logging(args.log, level=args.log_level, rig=args.rig)
+    run(args)
@@ -1,15 +1,23 @@
+import argparse
 import os
-import random
 import wx
 
+import results
+import tracing
+from logwriter import start_logging
+from acquisition import Acquisition
+from engine import AutoReward, ResumeError, open_semiauto
+from events import ArmEntered, LickOnset, LickOffset
 from plusmaze import PlusMaze, DeviceError
+from protocol import ProtocolError
 from runtrials import RunTrialsDialog
 from runegotrain import RunEgoTraining
-from time import sleep
+from scheduler import ActionScheduler
 from util import *
 
 ID_EXPT_SEMIAUTO = wx.NewId()
 ID_EXPT_EGOTRAIN = wx.NewId()
+ID_EXPT_RESUME = wx.NewId()
 ID_DEV_QUERYCNT = wx.NewId()
 ID_DEV_RESETCNT = wx.NewId()
 ID_DEV_PULLBUF = wx.NewId()
@@ -19,12 +27,12 @@ class PlusMazeController(wx.Frame):
     User interface for the plus maze
     '''
 
-    def __init__(self, parent, title):
+    def __init__(self, parent, title, xem=None, force_reprogram=False, serial=None):
         wx.Frame.__init__(self, parent, title=title, size=(275,3*120),
                           style=wx.DEFAULT_FRAME_STYLE ^ wx.RESIZE_BORDER)
 
         try:
-            self.maze = PlusMaze()
+            self.maze = PlusMaze(xem=xem, force_reprogram=force_reprogram, serial=serial)
         except DeviceError:
             wx.MessageBox('Error initializing the FPGA.\nSee console for detailed information.',
                           'PlusMazeController', wx.OK | wx.ICON_ERROR)
@@ -38,10 +46,25 @@ class PlusMazeController(wx.Frame):
         self.StatusBar.SetStatusWidths([-3, -1, -1]) # Relative widths 3:1:1
 
         # Sample initial location of mouse (may be garbage)
-        self.prev_pos = self.maze.get_last_detected_pos()
+        self.prev_pos = self.maze.snapshot().pos
         print_msg("Initial detected position: {}".format(self.prev_pos))
         self.StatusBar.SetStatusText(self.prev_pos, 1)
 
+        # Sample the maze on a background thread. The GUI only consumes its
+        # samples and events, at the pace of its timers
+        self.acq = Acquisition(self.maze)
+        self.acq.start()
+        self.listener = self.acq.events.listen((ArmEntered, LickOnset, LickOffset))
+
+        # Timed actions (e.g. multi-step rotations) run off the GUI thread
+        self.scheduler = ActionScheduler()
+        self.scheduler.start()
+
+        # Autoreward runs between experiments, on the acquisition thread
+        self.autoreward = AutoReward(self.maze, self.acq, self.scheduler)
+        self._update_autoreward()
+        self.Bind(wx.EVT_CLOSE, self.OnClose)
+
         # Start polling of maze
         self.poll_timer = wx.Timer(self)
         self.Bind(wx.EVT_TIMER, self.default_polling , self.poll_timer)
@@ -81,6 +104,9 @@ class PlusMazeController(wx.Frame):
                                                      'Reward left turns only',
                                                      kind=wx.ITEM_RADIO)
         maze_menu.AppendMenu(wx.ID_ANY, '&Autoreward', reward_menu)
+        for item in [self.reward_enable, self.reward_every_arm,
+                     self.reward_right_turns, self.reward_left_turns]:
+            self.Bind(wx.EVT_MENU, self._update_autoreward, item)
         maze_menu.AppendSeparator()
         maze_menu.Append(wx.ID_EXIT, 'Exit', 'Exit the program')
         self.Bind(wx.EVT_MENU, self.on_exit, id=wx.ID_EXIT)
@@ -95,6 +121,9 @@ class PlusMazeController(wx.Frame):
         expt_menu.Append(ID_EXPT_SEMIAUTO, 'Semi-auto trials...', '')
         self.Bind(wx.EVT_MENU, self.run_semiauto_trials, id=ID_EXPT_SEMIAUTO)
 
+        expt_menu.Append(ID_EXPT_RESUME, 'Resume semi-auto trials...', '')
+        self.Bind(wx.EVT_MENU, self.resume_semiauto_trials, id=ID_EXPT_RESUME)
+
         menubar.Append(expt_menu, '&Experiment')
 
         # Dev options
@@ -169,68 +198,46 @@ class PlusMazeController(wx.Frame):
 
     def start_default_polling(self):
         print_msg("Start default maze polling")
+        self.listener.skip()
+        self.prev_pos = self.acq.position()
+        self.autoreward.start()
         self.poll_timer.Start(PlusMaze.POLL_PERIOD)
 
 
     def stop_default_polling(self):
         self.poll_timer.Stop()
+        self.autoreward.stop()
         print_msg("Stopped default maze polling")
 
 
     def default_polling(self, e):
-        pos = self.maze.get_last_detected_pos()
-
-        if (self.prev_pos != pos):
-            print "*"
-            print_msg("Detected mouse at {}".format(pos))
-
-            try:
-                turn = PlusMaze.pos_to_turn[(self.prev_pos, pos)]
-                print_msg("Mouse executed {} turn".format(turn))
-
-                # Autoreward
-                if self.reward_enable.IsChecked():
-                    if self.reward_every_arm.IsChecked():
-                        print_msg("Autoreward (every arm)")
-                        self.maze.dose(pos)
-                    elif (self.reward_right_turns.IsChecked() & (turn=='right')):
-                        print_msg("Autoreward (right turn)")
-                        self.maze.dose(pos)
-                    elif (self.reward_left_turns.IsChecked() & (turn=='left')):
-                        print_msg("Autoreward (left turn)")
-                        self.maze.dose(pos)
-
-                # Maintain T-maze
-                '''
-                if self.maintain_t_maze.IsChecked():
-                    self.maze.rotate(PlusMaze.turn_compensation[turn])
-                '''
-                dice = random.randint(0,1)
-                
-                if (turn == 'straight'):
-                    if dice:
-                        print_msg("Rotate block by 180 deg")
-                        self.maze.rotate('center ccw')
-                        sleep(1)
-                        self.maze.rotate('center ccw')
-                    else:
-                        print_msg("Block kept in same position")
-                else:
-                    self.maze.rotate('center ccw' if dice else 'center cw')
-                
-
-            except KeyError, e:
-                print_msg("Warning! Did the mouse jump over the T-block?")
+        for event in self.listener.poll():
+            if isinstance(event, ArmEntered):
+                self._arm_entered(event)
+            elif isinstance(event, LickOnset):
+                self.StatusBar.SetStatusText('Lick!', 2)
+            elif isinstance(event, LickOffset):
+                self.StatusBar.SetStatusText('', 2)
 
         # Set status
-        self.prev_pos = pos
         self.StatusBar.SetStatusText(self.prev_pos, 1)
 
-        lick = self.maze.get_lick_state()
-        if lick:
-            self.StatusBar.SetStatusText('Lick!', 2)
-        else:
-            self.StatusBar.SetStatusText('', 2)
+
+    def _arm_entered(self, event):
+        # Rewards and block rotations are handled by self.autoreward
+        self.prev_pos = event.to_arm
+
+
+    def _update_autoreward(self, e=None):
+        mode = None
+        if self.reward_enable.IsChecked():
+            if self.reward_every_arm.IsChecked():
+                mode = 'every'
+            elif self.reward_right_turns.IsChecked():
+                mode = 'right'
+            elif self.reward_left_turns.IsChecked():
+                mode = 'left'
+        self.autoreward.mode = mode
 
 
     def actuate_gate(self, e):
@@ -257,6 +264,7 @@ class PlusMazeController(wx.Frame):
     def run_ego_training(self, e):
         self.stop_default_polling()
         runegotrain_dlg = RunEgoTraining(maze=self.maze,
+                                         acq=self.acq,
                                          prev_pos=self.prev_pos,
                                          parent=None, title='Run egocentric training')
         runegotrain_dlg.ShowModal()
@@ -271,19 +279,46 @@ class PlusMazeController(wx.Frame):
         dlg = wx.FileDialog(self, "Choose trial file", '', '', '*.txt', wx.FD_OPEN)
         if dlg.ShowModal() == wx.ID_OK:
             trial_file = os.path.join(dlg.GetDirectory(), dlg.GetFilename())
-            runtrials_dlg = RunTrialsDialog(trial_file=trial_file,
-                                            maze=self.maze,
-                                            block_pos=self.prev_pos,
-                                            parent=None, title='Run trials ({})'.format(trial_file))
-            runtrials_dlg.ShowModal()
-            self.last_pos = runtrials_dlg.block_pos # Retrieve final position of block
-            runtrials_dlg.Destroy()
+            self._run_trials_dialog(trial_file, None, 'Run trials ({})'.format(trial_file))
 
         self.start_default_polling()
 
 
+    def resume_semiauto_trials(self, e):
+        self.stop_default_polling()
+
+        # Continue an interrupted session from its journal
+        dlg = wx.FileDialog(self, "Choose trial journal", '', '', '*.journal', wx.FD_OPEN)
+        if dlg.ShowModal() == wx.ID_OK:
+            journal_file = os.path.join(dlg.GetDirectory(), dlg.GetFilename())
+            self._run_trials_dialog(None, journal_file, 'Resume trials ({})'.format(journal_file))
+
+        self.start_default_polling()
+
+
+    def _run_trials_dialog(self, trial_file, resume_file, title):
+        try:
+            engine = open_semiauto(self.maze, self.acq, self.scheduler, trial_file,
+                                   self.prev_pos, resume_file=resume_file)
+        except ResumeError, e:
+            print_msg("Cannot resume trials:\n{}".format(e), 'error')
+            wx.MessageBox('Cannot resume trials:\n{}'.format(e),
+                          'PlusMazeController', wx.OK | wx.ICON_ERROR)
+            return
+        except ProtocolError, e:
+            print_msg("Error in trial file:\n{}".format(e), 'error')
+            wx.MessageBox('Error in trial file:\n{}'.format(e),
+                          'PlusMazeController', wx.OK | wx.ICON_ERROR)
+            return
+
+        runtrials_dlg = RunTrialsDialog(engine=engine, parent=None, title=title)
+        runtrials_dlg.ShowModal()
+        self.last_pos = runtrials_dlg.block_pos # Retrieve final position of block
+        runtrials_dlg.Destroy()
+
+
     def query_counter(self, e):
-        counter = self.maze.get_frame_count()
+        counter = self.acq.latest().frame
         print_msg("Miniscope counter currently reads {}".format(counter))
 
 
@@ -292,26 +327,65 @@ class PlusMazeController(wx.Frame):
 
 
     def pull_lickometer_buffer(self, e):
-        dlg = wx.FileDialog(self, "Choose output destination", '', '', '*.txt',
+        dlg = wx.FileDialog(self, "Choose output destination", '', '',
+                            'Text (*.txt)|*.txt|Session file (*.pmz)|*.pmz',
                             wx.FD_SAVE | wx.FD_OVERWRITE_PROMPT)
         if dlg.ShowModal() == wx.ID_OK:
-            licks = self.maze.pull_lick_buffer() # List of bools
+            licks = self.maze.pull_lick_buffer() # LickBuffer
 
             output_file = os.path.join(dlg.GetDirectory(), dlg.GetFilename())
-            f = open(output_file, 'w')
-            for lick in licks:
-                if (lick):
-                    f.write("1\n")
-                else:
-                    f.write("0\n")
-            f.close()
+            if output_file.endswith('.pmz'):
+                results.save_session(output_file, 'semiauto', [], licks=licks,
+                                     meta={'source': 'lickometer buffer dump'})
+            else:
+                f = open(output_file, 'w')
+                licks.write_text(f)
+                f.close()
             print_msg("Dumped lickometer buffer contents to {}".format(output_file))
 
 
     def on_exit(self, e):
         self.Close()
 
+
+    def OnClose(self, e):
+        self.poll_timer.Stop()
+        self.listener.close()
+        self.autoreward.close()
+        self.scheduler.stop()
+        self.acq.stop()
+        self.Destroy()
+
 if (__name__ == '__main__'):
+    parser = argparse.ArgumentParser(description='Plus maze controller')
+    parser.add_argument('--sim', action='store_true',
+                        help='run against a simulated maze instead of the FPGA')
+    parser.add_argument('--force-reprogram', action='store_true',
+                        help='load the bitfile even if the FPGA is already running it')
+    parser.add_argument('--serial', default=None,
+                        help='serial of the FPGA to open (default: the first device)')
+    parser.add_argument('--trace', metavar='BASE', default=None,
+                        help='profile the USB transactions, to BASE.trace.json and BASE.latency.txt')
+    parser.add_argument('--log', metavar='FILE', default=None,
+                        help='also write the messages to FILE, one JSON record per line')
+    parser.add_argument('--log-level', choices=sorted(LOG_LEVELS, key=LOG_LEVELS.get),
+                        default='info')
+    args = parser.parse_args()
+    start_logging(args.log, level=args.log_level, rig=args.serial)
+
+    xem = None
+    if args.sim:
+        from simdevice import SimFrontPanel
+        xem = SimFrontPanel(serials=(args.serial,) if args.serial else ('SIM00001',))
+    if args.trace:
+        try:
+            xem = tracing.TracedDevice(PlusMaze.frontpanel(xem))
+        except DeviceError:
+            raise SystemExit("Error initializing the FPGA")
+
     app = wx.App(False)
-    pmc = PlusMazeController(None, 'Plus Maze Controller')
+    pmc = PlusMazeController(None, 'Plus Maze Controller', xem=xem,
+                             force_reprogram=args.force_reprogram, serial=args.serial)
     app.MainLoop()
+    if args.trace:
+        xem.save(args.trace)
@@ -0,0 +1,213 @@
+'''
+Trial protocol files and their compiler. A protocol file lists one trial
+per line as "start goal" or "start-block goal", as before, and may set the
+trial timing for the trials that follow it:
+
+    # Comments run to the end of the line
+    set START 5000              # Start hold, ms
+    set REWARD_DELAY 1500 2500  # Reward delay range, ms
+    set LICK_WINDOW 3000        # Reward the first lick within 3 s instead
+    set FAST_POLL 1             # Sampling period while the mouse can move
+    set SLOW_POLL 20            # and during holds, ms
+    east north
+    west-south any              # Reward any arm the mouse can reach
+    north none                  # Probe trial, no reward
+
+A goal that the block closes off is never reached, so such a trial runs
+unrewarded, as a probe, with a warning.
+
+compile_protocol checks the whole file before anything moves, and turns it
+into a flat list of CompiledTrial records, so that the engine does not
+need to look anything up while a trial runs.
+'''
+from __future__ import division
+
+import collections
+
+from plusmaze import PlusMaze
+from util import *
+
+# How to bring the block from one arm to another: (rotation, number of steps)
+block_mappings = {('south', 'west') : ('center cw', 1),
+                  ('south', 'north'): ('center cw', 2),
+                  ('south', 'east') : ('center ccw', 1),
+                  ('west',  'north'): ('center cw', 1),
+                  ('west',  'east') : ('center cw', 2),
+                  ('west',  'south'): ('center ccw', 1),
+                  ('north', 'east' ): ('center cw', 1),
+                  ('north', 'south'): ('center cw', 2),
+                  ('north', 'west' ): ('center ccw', 1),
+                  ('east',  'south'): ('center cw', 1),
+                  ('east',  'west' ): ('center cw', 2),
+                  ('east',  'north'): ('center ccw', 1)}
+
+# Rotation steps between every pair of block positions
+_rotation_plans = dict(((a, b), (r,) * n) for (a, b), (r, n) in block_mappings.items())
+
+# Single 90 degree rotation steps of the block, e.g. 'center cw' moves
+# the block from south to west
+block_steps = dict(((r, a), b) for (a, b), (r, n) in block_mappings.items() if n == 1)
+
+DEFAULT_TIMING = {'START': 5000, # All timing in ms
+                  'FINISH': 5000,
+                  'ROTATION': 1500,
+                  'REWARD_DELAY': (1500, 2500),
+                  'LICK_WINDOW': 0, # Off: reward after REWARD_DELAY
+                  # Keep SLOW_POLL below the miniscope frame period, so
+                  # that the frame clock sees every frame
+                  'FAST_POLL': 1,
+                  'SLOW_POLL': 20,
+                 }
+
+# Everything the engine needs to run one trial. Durations are in seconds.
+#   gates           Arm -> closed?, for PlusMaze.set_gates
+#   rotations       Rotation steps from the block of the previous trial
+#                   (from_block), or None if that is not known in advance
+#   rewarded        Arms whose entry is rewarded
+#   lick_window     Time after the entry in which the first lick is
+#                   rewarded, or None to reward after reward_delay
+#   poll_periods    (fast, slow) sampling periods of the maze
+CompiledTrial = collections.namedtuple('CompiledTrial',
+    'line start block goal gates from_block rotations rewarded '
+    'start_hold finish_hold rotation_step reward_delay lick_window poll_periods')
+
+class ProtocolError(ValueError):
+    pass
+
+def rotation_plan(from_block, to_block):
+    '''
+    Rotation steps that bring the block from from_block to to_block
+    '''
+    if (from_block == to_block):
+        return ()
+    return _rotation_plans[(from_block, to_block)]
+
+def reachable_arms(start, block):
+    '''
+    Arms that a mouse leaving start can enter. The T-block closes off the
+    arm opposite to the one it faces
+    '''
+    return frozenset(arm for arm in PlusMaze.ordered_dirs
+                     if (arm != start) and (PlusMaze.pos_to_turn.get((block, arm)) != 'straight'))
+
+def _parse_timing(key, values):
+    if key not in DEFAULT_TIMING:
+        raise ProtocolError("unknown timing parameter '{}'".format(key))
+    try:
+        values = [int(v) for v in values]
+    except ValueError:
+        raise ProtocolError("timing must be given in whole ms")
+    if any(v < 0 for v in values):
+        raise ProtocolError("timing must not be negative")
+    if key.endswith('_POLL') and (0 in values):
+        raise ProtocolError("{} must be at least 1 ms".format(key))
+
+    if (key == 'REWARD_DELAY'):
+        if (len(values) == 1):
+            values = values * 2
+        if (len(values) != 2) or (values[0] > values[1]):
+            raise ProtocolError("REWARD_DELAY takes a delay or a range 'lo hi'")
+        return tuple(values)
+    if (len(values) != 1):
+        raise ProtocolError("{} takes a single value".format(key))
+    return values[0]
+
+def _parse_trial(fields):
+    # Returns (start, block, goal, rewarded, warning or None)
+    if (len(fields) != 2):
+        raise ProtocolError("expected 'start goal' or 'start-block goal'")
+    startblock = fields[0].lower().split('-')
+    goal = fields[1].lower()
+    if (len(startblock) > 2):
+        raise ProtocolError("too many arms in '{}'".format(fields[0]))
+    start = startblock[0]
+    block = startblock[-1]
+
+    for arm in (start, block):
+        if arm not in PlusMaze.ordered_dirs:
+            raise ProtocolError("unknown arm '{}'".format(arm))
+
+    reachable = reachable_arms(start, block)
+    warning = None
+    if (goal == 'any'):
+        rewarded = reachable
+    elif (goal == 'none'):
+        rewarded = frozenset()
+    elif goal not in PlusMaze.ordered_dirs:
+        raise ProtocolError("unknown goal '{}'".format(goal))
+    elif (goal == start):
+        raise ProtocolError("goal is the start arm")
+    elif goal not in reachable:
+        warning = "goal {} is closed off by the block at {}, running as a probe".format(goal, block)
+        rewarded = frozenset()
+    else:
+        rewarded = frozenset([goal])
+    return start, block, goal, rewarded, warning
+
+def compile_lines(lines, source='<protocol>', block_pos=None):
+    '''
+    Compile the lines of a protocol. block_pos is the position of the block
+    before the first trial, if known. Raises ProtocolError listing every
+    problem in the protocol
+    '''
+    timing = dict(DEFAULT_TIMING)
+    gates = dict(((start, dict((arm, arm == start) for arm in PlusMaze.ordered_dirs))
+                  for start in PlusMaze.ordered_dirs))
+
+    trials = []
+    errors = []
+    parsed = {} # Schedules repeat the same few trial types
+    prev_block = block_pos
+    for line_no, line in enumerate(lines, 1):
+        fields = line.split('#', 1)[0].split()
+        if not fields:
+            continue
+        try:
+            if (fields[0].lower() == 'set'):
+                if (len(fields) < 3):
+                    raise ProtocolError("expected 'set NAME value'")
+                key = fields[1].upper()
+                timing[key] = _parse_timing(key, fields[2:])
+                continue
+
+            key = tuple(fields)
+            if key not in parsed:
+                parsed[key] = _parse_trial(fields)
+            start, block, goal, rewarded, warning = parsed[key]
+            if warning:
+                print_msg("{}:{}: {}".format(source, line_no, warning), 'warning')
+        except ProtocolError, e:
+            errors.append("{}:{}: {}".format(source, line_no, e))
+            continue
+
+        if (timing['LICK_WINDOW'] > timing['FINISH']):
+            errors.append("{}:{}: LICK_WINDOW is longer than the FINISH hold".format(source, line_no))
+            continue
+
+        lo, hi = timing['REWARD_DELAY']
+        trials.append(CompiledTrial(
+            line=line_no,
+            start=start,
+            block=block,
+            goal=goal,
+            gates=gates[start],
+            from_block=prev_block,
+            rotations=None if (prev_block is None) else rotation_plan(prev_block, block),
+            rewarded=rewarded,
+            start_hold=timing['START']/1000,
+            finish_hold=timing['FINISH']/1000,
+            rotation_step=timing['ROTATION']/1000,
+            reward_delay=(lo/1000, hi/1000),
+            lick_window=(timing['LICK_WINDOW']/1000) or None,
+            poll_periods=(timing['FAST_POLL']/1000, timing['SLOW_POLL']/1000)))
+        prev_block = block
+
+    if not errors and not trials:
+        errors.append("{}: no trials".format(source))
+    if errors:
+        raise ProtocolError('\n'.join(errors))
+    return trials
+
+def compile_protocol(path, block_pos=None):
+    with open(path, 'r') as f:
+        return compile_lines(f, source=path, block_pos=block_pos)
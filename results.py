@@ -0,0 +1,61 @@
+'''
+Writers for the session result files. Kept free of wx so that results can
+be written (and benchmarked) headless.
+'''
+import collections
+import os
+
+import sessionfile
+
+# Result rows of the semi-auto trials and of egocentric training
+Trial = collections.namedtuple('Trial', 'start block goal result time reward_delay start_frame open_frame close_frame end_frame')
+EgoTrial = collections.namedtuple('EgoTrial', 'start end turn time')
+
+def save_trials(output_file, trials):
+    '''
+    Semi-auto trial results (RunTrialsDialog), one space-separated line per trial
+    '''
+    f = open(output_file, 'w')
+    for trial in trials:
+        start = trial.start
+        block = trial.block
+        if start == block:
+            startblock = start
+        else:
+            startblock = '{}-{}'.format(start, block)
+
+        f.write("{} {} {} {:.3f} {:.3f} {} {} {} {}\n".format(
+            startblock, trial.goal, trial.result, trial.time, trial.reward_delay,
+            trial.start_frame, trial.open_frame, trial.close_frame, trial.end_frame))
+    f.close()
+
+def lick_file_name(output_file):
+    output_name, output_ext = os.path.splitext(output_file)
+    return output_name + '-lick' + output_ext
+
+def session_file_name(output_file):
+    return os.path.splitext(output_file)[0] + '.pmz'
+
+def save_session(session_file, protocol, trials, licks=None, samples=None, meta=None):
+    '''
+    Binary session container (see sessionfile.py), alongside the text files
+    '''
+    sessionfile.write_session(session_file, protocol, trials,
+                              licks=licks, samples=samples, meta=meta)
+
+def save_licks(lick_file, licks, num_frames):
+    '''
+    Lickometer data (a LickBuffer), one "0" or "1" line per recorded frame
+    '''
+    g = open(lick_file, 'w')
+    licks.write_text(g, num_frames)
+    g.close()
+
+def save_ego_trials(output_file, trials):
+    '''
+    Continuous egocentric training results (RunEgoTraining)
+    '''
+    f = open(output_file, 'w')
+    for trial in trials:
+        f.write("{} {} {} {}\n".format(trial.start, trial.end, trial.turn, trial.time))
+    f.close()
@@ -1,25 +1,22 @@
 from __future__ import division
 
-import collections
 import os
-import time
 import wx
 
-from plusmaze import PlusMaze
+from engine import EgoTraining
+from journal import journal_file_name
 from util import *
 
-Trial = collections.namedtuple('Trial', 'start end turn time')
-
 class RunEgoTraining(wx.Dialog):
     '''
-    Run continuous egocentric training
+    Run continuous egocentric training. A view of engine.EgoTraining
     '''
-    def __init__(self, maze, prev_pos, *args, **kw):
+    def __init__(self, maze, acq, prev_pos, *args, **kw):
         super(RunEgoTraining, self).__init__(*args, **kw)
 
-        self.maze = maze
-        self.prev_pos = prev_pos
-        self.maze.actuate_gate(self.prev_pos, True) # Close initial gate
+        self.engine = EgoTraining(maze, acq, prev_pos,
+                                  journal_file=journal_file_name('egotraining'))
+        self.engine.observe(lambda engine: wx.CallAfter(self._refresh))
 
         self.Bind(wx.EVT_CLOSE, self.OnClose)
 
@@ -44,16 +41,6 @@ class RunEgoTraining(wx.Dialog):
                          'save' : wx.Button(self, label='Save')}
         self._enable_controls(True, False, False) # Start, Pause, Save
 
-        # Will be initialized later
-        self.num_trials = 0
-        self.trial_index = 0
-        self.trial_start_time = 0
-
-        # Running stats
-        self.trials = []
-        self.num_left  = 0
-        self.num_right = 0
-
         # Set up UI
         #------------------------------------------------------------
         self.SetSize((400,250))
@@ -117,10 +104,6 @@ class RunEgoTraining(wx.Dialog):
 
         self.sizers = {'overall': overall_gs}
 
-        # Prepare maze monitor
-        self.mon_timer = wx.Timer(self)
-        self.Bind(wx.EVT_TIMER, self._monitor_training, self.mon_timer)
-
     def _enable_controls(self, start, pause, save):
         if start:
             self.controls['start'].Enable()
@@ -139,124 +122,57 @@ class RunEgoTraining(wx.Dialog):
 
 
     def _update_stats(self):
+        engine = self.engine
+        num_done = len(engine.trials)
+        if (num_done == 0):
+            return
         self.stats['trial_no'].SetLabel("{} ({:.0%})".format(
-            self.trial_index, self.trial_index / self.num_trials))
+            num_done, num_done / engine.num_trials))
         self.stats['left'].SetLabel("{} ({:.0%})".format(
-            self.num_left, self.num_left / self.trial_index))
+            engine.num_left, engine.num_left / num_done))
         self.stats['right'].SetLabel("{} ({:.0%})".format(
-            self.num_right, self.num_right / self.trial_index))
+            engine.num_right, engine.num_right / num_done))
         self.sizers['overall'].Layout()
 
-    def _monitor_training(self, e):
-        pos = self.maze.get_last_detected_pos()
-        if (self.prev_pos != pos):
-            print '* * * Trial {} of {} * * *'.format(self.trial_index, self.num_trials)
-            print_msg('Detected mouse at {}'.format(pos))
-
-            try:
-                turn = PlusMaze.pos_to_turn[(self.prev_pos, pos)]
-                print_msg('mouse executed {} turn'.format(turn))
-
-                if (turn == self.setup['turn'].GetValue()):
-                    print_msg("Reward for {} turn".format(turn))
-                    self.maze.dose(pos)
-
-                self.maze.compensate_turn(turn)
-
-                current_time = time.time()
-                elapsed_time = current_time - self.trial_start_time # sec
-
-                # Keep tally
-                self.trials.append(Trial(start=self.prev_pos,
-                                         end=pos,
-                                         turn=turn,
-                                         time=elapsed_time,
-                                         ))
-                if (turn == 'left'):
-                    self.num_left += 1
-                elif (turn == 'right'):
-                    self.num_right += 1
-
-                self._update_stats()
-
-                if (self.trial_index == self.num_trials):
-                    self._completed_training(pos)
-                else:
-                    self.trial_index += 1
-
-                # Set up for next trial
-                self.prev_pos = pos
-                self.trial_start_time = current_time
-
-            except KeyError, e:
-                print_msg("Warning! Did the mouse jump over the T-block?")
-                print_msg("Pausing training!")
-                print_msg("Place the mouse back at {} before resuming training".format(
-                            self.prev_pos))
-                self._pause_training()
+    def _refresh(self):
+        if not self:
+            return # Dialog already destroyed
+        state = self.engine.state
+        if (state == 'running'):
+            self._enable_controls(False, True, False)
+        elif (state == 'paused'):
+            self._enable_controls(True, False, False)
+        elif (state == 'completed'):
+            self._enable_controls(False, False, True)
+        self._update_stats()
 
 
     def _training_control(self, e):
         ctrl = e.EventObject.GetLabel()
         if (ctrl == 'Start'):
-            if (self.num_trials == 0):
-                self._initialize_training()
-            else:
-                self._resume_training()
+            if (self.engine.state == 'idle'):
+                # Can't alter training params once started
+                self.setup['turn'].Disable()
+                self.setup['num_trials'].Disable()
+                self.setup['close_gate'].Disable()
+
+                self.engine.turn = self.setup['turn'].GetValue()
+                self.engine.num_trials = int(self.setup['num_trials'].GetValue())
+            self.engine.start()
         elif (ctrl == 'Pause'):
-            self._pause_training()
+            self.engine.pause()
         elif (ctrl == 'Save'):
             self._save_result()
 
 
-    def _initialize_training(self):
-        self._enable_controls(False, True, False)
-
-        # Can't alter training params once started
-        self.setup['turn'].Disable()
-        self.setup['num_trials'].Disable()
-        self.setup['close_gate'].Disable()
-
-        self.num_trials = int(self.setup['num_trials'].GetValue())
-        self.trial_index = 1 # 1-index for the biologists
-        self.trial_start_time = time.time()
-
-        self.maze.actuate_gate(self.prev_pos, False) # Open gate
-
-        self.mon_timer.Start(PlusMaze.POLL_PERIOD)
-
-
-    def _resume_training(self):
-        self._enable_controls(False, True, False)
-        self.mon_timer.Start(PlusMaze.POLL_PERIOD)
-
-
-    def _pause_training(self):
-        self._enable_controls(True, False, False)
-        self.mon_timer.Stop()
-
-
-    def _completed_training(self, final_pos):
-        self._enable_controls(False, False, True)
-        self.mon_timer.Stop()
-
-        self.maze.actuate_gate(final_pos, True) # Close the gate
-
-        print_msg("Completed training!")
-
-
     def _save_result(self):
         dlg = wx.FileDialog(self, "Choose output file", '', '', '*.txt',
                             wx.FD_SAVE | wx.FD_OVERWRITE_PROMPT)
         if dlg.ShowModal() == wx.ID_OK:
             output_file = os.path.join(dlg.GetDirectory(), dlg.GetFilename())
-            print_msg("Writing results to {}...".format(output_file))
-            f = open(output_file, 'w')
-            for trial in self.trials:
-                f.write("{} {} {} {}\n".format(trial.start, trial.end, trial.turn, trial.time))
-            f.close()
+            self.engine.save_result(output_file)
 
 
     def OnClose(self, e):
-        self.mon_timer.Stop()
+        self.engine.close()
         self.Destroy()
@@ -1,68 +1,43 @@
 from __future__ import division
 
-import collections
 import os
-import random
-import time
 import wx
 
-from plusmaze import PlusMaze
+from engine import SemiAutoTrials, Trial
 from util import *
 
-Trial = collections.namedtuple('Trial', 'start block goal result time reward_delay start_frame open_frame close_frame end_frame')
-
 class RunTrialsDialog(wx.Dialog):
     '''
     Run semi-automatic trials (the mouse needs to be handled -- removed
-    and reinserted -- between trials)
+    and reinserted -- between trials). A view of an engine.SemiAutoTrials,
+    as set up by engine.open_semiauto
     '''
-
-    block_mappings = {('south', 'west') : ('center cw', 1),
-                      ('south', 'north'): ('center cw', 2),
-                      ('south', 'east') : ('center ccw', 1),
-                      ('west',  'north'): ('center cw', 1),
-                      ('west',  'east') : ('center cw', 2),
-                      ('west',  'south'): ('center ccw', 1),
-                      ('north', 'east' ): ('center cw', 1),
-                      ('north', 'south'): ('center cw', 2),
-                      ('north', 'west' ): ('center ccw', 1),
-                      ('east',  'south'): ('center cw', 1),
-                      ('east',  'west' ): ('center cw', 2),
-                      ('east',  'north'): ('center ccw', 1)}
-
-    trial_timing = {'POLL_PERIOD': 1000, # All timing in ms
-                    'START': 5000,
-                    'FINISH': 5000,
-                   }
-
-    def __init__(self, trial_file, maze, block_pos, *args, **kw):
+    block_mappings = SemiAutoTrials.block_mappings
+    block_steps = SemiAutoTrials.block_steps
+
+    trial_timing = {'POLL_PERIOD': 1000} # ms, for the elapsed time display
+
+    # Labels and enabled controls (start, rewind, finish) in each engine state
+    control_states = {'setup':        ('Start', False, False, False),
+                      'ready':        ('Start', True,  False, False),
+                      'start_hold':   ('Open',  False, True,  False),
+                      'open_ready':   ('Open',  True,  True,  False),
+                      'running':      ('Open',  False, True,  False),
+                      'finish_hold':  ('Open',  False, True,  False),
+                      'finish_ready': ('Open',  False, True,  True),
+                      'done':         ('Start', False, False, False),
+                     }
+
+    def __init__(self, engine, *args, **kw):
         super(RunTrialsDialog, self).__init__(*args, **kw)
 
-        self.trials = self._parse_trial_file(trial_file)
-        self.num_trials = len(self.trials)
-        print "{}: Loaded {} containing {} trials".format(
-                get_time(), trial_file, self.num_trials)
+        self.engine = engine
+        self.num_trials = self.engine.num_trials
+        self.displayed_index = None
+        self.saved = False
 
         self.Bind(wx.EVT_CLOSE, self.OnClose)
 
-        self.maze = maze
-        self.block_pos = block_pos
-
-        self.trial_index = 0
-        self.trial_start = None
-        self.trial_goal = None
-        self.trial_time = 0.0
-        self.reward_delay = 0.0
-        self.trial_result = None
-        self.trial_start_time = None
-
-        self.trial_start_frame = 0
-        self.trial_open_frame = 0
-        self.trial_close_frame = 0
-        self.trial_end_frame = 0
-
-        self.num_correct = 0
-
         self.trial_stats = {'trial_no': wx.StaticText(self, label=''),
                             'start_arm': wx.StaticText(self, label=''),
                             'goal_arm': wx.StaticText(self, label=''),
@@ -151,308 +126,84 @@ class RunTrialsDialog(wx.Dialog):
                        'overall': overall_gs,
                       }
 
-        # Prepare maze monitor
-        #------------------------------------------------------------
-        self.mon_timer = wx.Timer(self)
-        self.Bind(wx.EVT_TIMER, self._monitor_trial, self.mon_timer)
-
-        # Timers for delayed start and finish
-        self.delayed_time = 0
-
-        self.delayed_start_timer = wx.Timer(self)
-        self.Bind(wx.EVT_TIMER, self._delayed_start, self.delayed_start_timer)
-
-        self.delayed_finish_timer = wx.Timer(self)
-        self.Bind(wx.EVT_TIMER, self._delayed_finish, self.delayed_finish_timer)
-
-        # Reset the frame counter
-        self.maze.reset_scope_counter()
-
-        # Initialize first trial
-        self._initialize_trial()
-
-
-    def _parse_trial_file(self, trial_file):
-        '''
-        Trial files are text files where each line indicates the start and goal arms
-        '''
-        trials = []
-
-        f = open(trial_file, 'r')
-        for line in f:
-            ld = line.split()
-            
-            startblock = ld[0].lower()
-            goal = ld[1].lower()
-            
-            startblock = startblock.split('-')
-            if (len(startblock) == 1):
-                start = startblock[0]
-                block = startblock[0]
-            else:
-                start = startblock[0]
-                block = startblock[1]
-
-            trials.append(Trial(start=start,
-                                block=block,
-                                goal=goal,
-                                result=None,
-                                time=0.0,
-                                reward_delay=0.0,
-                                start_frame=None,
-                                open_frame=None,
-                                close_frame=None,
-                                end_frame=None))
-
-        f.close()
-        return trials
-
-
-    def _set_block_pos(self, new_pos):
-        if (self.block_pos == new_pos):
-            return
-        else:
-            block_map = RunTrialsDialog.block_mappings[(self.block_pos, new_pos)]
-            for i in xrange(block_map[1]):
-                self.maze.rotate(block_map[0])
-                self.sizers['trial'].Layout()
-                time.sleep(1.5)
-            self.block_pos = new_pos
-
-
-    def _trial_control(self, e):
-        ctrl = e.EventObject.GetLabel()
-        if (ctrl == 'Start'):
-            self._start_trial()
-        elif (ctrl == 'Open'):
-            self._open_trial()
-        elif (ctrl == 'Rewind'):
-            self._rewind_trial()
-        elif (ctrl == 'Finish'):
-            self._finish_trial()
-
-
-    def _initialize_trial(self):
-        display_trial_index = str(self.trial_index + 1) # For the biologists
-        print "*"
-        print_msg("Initializing trial {}...".format(display_trial_index))
-
-        # Set up trial stats
-        trial = self.trials[self.trial_index]
-        self.trial_stats['trial_no'].SetLabel(display_trial_index)
-        self.trial_stats['start_arm'].SetLabel(trial.start)
-        self.trial_stats['goal_arm'].SetLabel(trial.goal)
-        self.trial_stats['time'].SetLabel('')
-        self.trial_stats['result'].SetLabel('')
-        self.sizers['trial'].Layout()
-
-        # Actuate the maze
-        for arm in PlusMaze.ordered_dirs:
-            if (arm == trial.start):
-                self.maze.actuate_gate(arm, True) # Close the gate
-            else:
-                self.maze.actuate_gate(arm, False)
-        self._set_block_pos(trial.block)
-
-        # Set up controls
-        self.controls['start'].SetLabel('Start')
-        self.controls['start'].Enable()
-        self.controls['rewind'].Disable()
-        self.controls['finish'].Disable()
-
-        self.trial_start = trial.start
-        self.trial_goal = trial.goal
-
-
-    def _start_trial(self):
-        if (self.maze.get_last_detected_pos() != self.trial_start):
-            print_msg("Error! Cannot start trial. Is the mouse in the start arm?")
-        else:
-            print_msg("Starting trial {}".format(self.trial_index+1)) # 1-index just for display
-
-            self.trial_start_time = time.time()
-
-            self.trial_start_frame = self.maze.get_frame_count()+1
-            self.maze.start_recording() # Trigger miniscope
-
-            self.controls['start'].SetLabel('Open') # FIXME: Hackish
-            self.controls['start'].Disable()
-            self.controls['rewind'].Enable()
-            self.controls['finish'].Disable()
-
-            # Trigger delayed start
-            self.delayed_time = 0
-            self.delayed_start_timer.Start(RunTrialsDialog.trial_timing['POLL_PERIOD'])
-            print_msg("Holding at start for {} seconds".format(
-                RunTrialsDialog.trial_timing['START']/1000.0))
-
-    def _update_elapsed_time(self):
-        elapsed_time = time.time() - self.trial_start_time # sec
-        m, s = divmod(elapsed_time, 60)
-        self.trial_stats['time'].SetLabel("%02d:%02d" % (m, s))
-        self.sizers['trial'].Layout()
-        return elapsed_time
-
-    def _delayed_start(self, e):
-        self._update_elapsed_time()
-
-        self.delayed_time += RunTrialsDialog.trial_timing['POLL_PERIOD']
-        if (self.delayed_time >= RunTrialsDialog.trial_timing['START']):
-            self.controls['start'].Enable()
-
-    def _open_trial(self):
-        self.delayed_start_timer.Stop()
-        self.controls['start'].Disable()
-
-        # Open the gate and poll at a higher rate
-        self.trial_open_frame = self.maze.get_frame_count()
-        self.maze.actuate_gate(self.trial_start, False) # Open the gate
-        self.mon_timer.Start(PlusMaze.POLL_PERIOD)
+        # Refresh the elapsed time while a trial is under way
+        self.time_timer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self._update_elapsed_time, self.time_timer)
+        self.time_timer.Start(RunTrialsDialog.trial_timing['POLL_PERIOD'])
 
-    def _monitor_trial(self, e):
-        self._update_elapsed_time()
+        # The engine may change state on any thread
+        self.engine.observe(lambda engine: wx.CallAfter(self._refresh))
+        self.engine.begin()
+        self._refresh()
 
-        mouse_pos = self.maze.get_last_detected_pos()
-        if (mouse_pos != self.trial_start):
-            self.trial_close_frame = self.maze.get_frame_count()
 
-            print_msg("Mouse detected at {}".format(mouse_pos))
-            self.trial_stats['result'].SetLabel(mouse_pos)
-            
-            self.maze.actuate_gate(mouse_pos, True) # Close the gate
+    @property
+    def block_pos(self):
+        return self.engine.block_pos
 
-            self.trial_result = mouse_pos
 
-            # Reward conditions
-            if (self.trial_goal == 'any') or (mouse_pos == self.trial_goal):
-                delay = random.uniform(1.5, 2.5)
-                print_msg("Reward delayed by {:.3f} seconds".format(delay))
-                time.sleep(delay)
-                self.maze.dose(mouse_pos)
-                self.reward_delay = delay
-
-            self.mon_timer.Stop()
-
-            # Trigger delayed finish
-            self.delayed_time = 0
-            self.delayed_finish_timer.Start(RunTrialsDialog.trial_timing['POLL_PERIOD'])
-            print_msg("Holding at finish for {} seconds".format(
-                RunTrialsDialog.trial_timing['FINISH']/1000.0))
+    def _refresh(self):
+        if not self:
+            return # Dialog already destroyed
+        engine = self.engine
+        state = engine.state
 
+        # Current trial
+        if (state != 'done') and (engine.trial_index != self.displayed_index):
+            self.displayed_index = engine.trial_index
+            trial = engine.trials[engine.trial_index]
+            self.trial_stats['trial_no'].SetLabel(str(engine.trial_index + 1)) # For the biologists
+            self.trial_stats['start_arm'].SetLabel(trial.start)
+            self.trial_stats['goal_arm'].SetLabel(trial.goal)
+            self.trial_stats['time'].SetLabel('')
+        self.trial_stats['result'].SetLabel(engine.trial_result or '')
         self.sizers['trial'].Layout()
 
+        # Running stats
+        if (engine.trial_index > 0):
+            self.overall_stats['num_correct'].SetLabel(str(engine.num_correct))
+            self.overall_stats['percentage'].SetLabel(
+                "{:.0%}".format(engine.num_correct/engine.trial_index))
+            self.sizers['overall'].Layout()
 
-    def _delayed_finish(self, e):
-        elapsed_time = self._update_elapsed_time()
-
-        self.delayed_time += RunTrialsDialog.trial_timing['POLL_PERIOD']
-        if (self.delayed_time >= RunTrialsDialog.trial_timing['FINISH']):
-            self.maze.stop_recording() # Turn off miniscope
-            time.sleep(0.1)
-            self.trial_end_frame = self.maze.get_frame_count()
-
-            self.delayed_finish_timer.Stop()
-            self.trial_time = elapsed_time
-
-            self.controls['finish'].Enable()
+        # Controls
+        label, start, rewind, finish = RunTrialsDialog.control_states[state]
+        self.controls['start'].SetLabel(label) # FIXME: Hackish
+        for c, enabled in [('start', start), ('rewind', rewind), ('finish', finish)]:
+            self.controls[c].Enable(enabled)
 
-
-    def _rewind_trial(self):
-        self.maze.stop_recording()
-
-        # Stop all timers
-        self.mon_timer.Stop()
-        self.delayed_start_timer.Stop()
-        self.delayed_finish_timer.Stop()
-
-        self.controls['start'].SetLabel('Start')
-        print_msg("Re-setup trial {}".format(self.trial_index+1))
-        self._initialize_trial()
-
-
-    def _finish_trial(self):
-        print_msg("Finish trial {}".format(self.trial_index+1))
-        self.controls['rewind'].Disable()
-        self.controls['finish'].Disable()
-        
-        # Record the result
-        #   FIXME: May prefer a mutable representation of Trial
-        new_trial = Trial(start=self.trials[self.trial_index].start,
-                          block=self.trials[self.trial_index].block,
-                          goal=self.trials[self.trial_index].goal,
-                          result=self.trial_result,
-                          time=self.trial_time,
-                          reward_delay=self.reward_delay,
-                          start_frame=self.trial_start_frame,
-                          open_frame=self.trial_open_frame,
-                          close_frame=self.trial_close_frame,
-                          end_frame=self.trial_end_frame)
-        self.trials[self.trial_index] = new_trial
-
-        # Update running stats        
-        if (self.trial_result == self.trial_goal):
-            self.num_correct += 1
-        self.overall_stats['num_correct'].SetLabel(str(self.num_correct))
-        self.overall_stats['percentage'].SetLabel(
-            "{:.0%}".format(self.num_correct/(self.trial_index+1)))
-        self.sizers['overall'].Layout()
-
-        # Move to next trial
-        self.trial_index += 1
-        if (self.trial_index < self.num_trials):
-            self._initialize_trial()
-        else:
+        if (state == 'done') and not self.saved:
             # We are done. Select output file and record results
-            print "*"
-            print_msg("Miniscope recorded {} frames total".format(
-                        self.maze.get_frame_count()))
-
+            self.saved = True
             dlg = wx.FileDialog(self, "Choose output file", '', '', '*.txt',
                                 wx.FD_SAVE | wx.FD_OVERWRITE_PROMPT)
             if dlg.ShowModal() == wx.ID_OK:
                 output_file = os.path.join(dlg.GetDirectory(), dlg.GetFilename())
-                self._save_result(output_file)
-
-
-    def _save_result(self, output_file):
-        print_msg("Writing results to {}...".format(output_file))
-
-        # Save trial results
-        f = open(output_file, 'w')
-        for trial in self.trials:
-            start = trial.start
-            block = trial.block
-            if start == block:
-                startblock = start
-            else:
-                startblock = '{}-{}'.format(start, block)
-                
-            f.write("{} {} {} {:.3f} {:.3f} {} {} {} {}\n".format(
-                startblock, trial.goal, trial.result, trial.time, trial.reward_delay,
-                trial.start_frame, trial.open_frame, trial.close_frame, trial.end_frame))
-        f.close()
-
-        # Save lickometer data
-        num_recorded_frames = self.maze.get_frame_count()
-        licks = self.maze.pull_lick_buffer()
-
-        output_name, output_ext = os.path.splitext(output_file)
-        lick_file = output_name + '-lick' + output_ext
-        g = open(lick_file, 'w')
-        for i in xrange(num_recorded_frames):
-            if (licks[i]):
-                g.write("1\n")
-            else:
-                g.write("0\n")
-        g.close()
+                self.engine.save_result(output_file)
+
+
+    def _update_elapsed_time(self, e):
+        if self.engine.state in ('start_hold', 'open_ready', 'running', 'finish_hold'):
+            m, s = divmod(self.engine.elapsed_time(), 60)
+            self.trial_stats['time'].SetLabel("%02d:%02d" % (m, s))
+            self.sizers['trial'].Layout()
+
+
+    def _trial_control(self, e):
+        ctrl = e.EventObject.GetLabel()
+        if (ctrl == 'Start'):
+            self.engine.start()
+        elif (ctrl == 'Open'):
+            self.engine.open()
+        elif (ctrl == 'Rewind'):
+            self.engine.rewind()
+        elif (ctrl == 'Finish'):
+            self.engine.finish()
 
 
     def OnClose(self, e):
         # Stop all timers!
-        self.mon_timer.Stop()
-        self.delayed_start_timer.Stop()
-        self.delayed_finish_timer.Stop()
-
-        self.maze.stop_recording()
-        self._save_result("autobackup.txt")
+        self.time_timer.Stop()
+        self.engine.close()
+        self.engine.save_result("autobackup.txt")
         self.Destroy()
@@ -0,0 +1,323 @@
+'''
+Generator of semi-auto trial files that keep the block rotations between
+trials to a minimum. Each trial starts with the block facing the start arm
+and rewards a left or a right turn. Schedules are balanced over start arms
+and turn directions over the whole session, and the turn sequence meets
+Gellermann-style criteria:
+    - as many left as right turns, in each half of the session too
+    - no more than max_run identical turns (or goal arms) in a row
+    - alternating (or repeating) the previous turn is right on 40-60% of
+      trials
+Many random schedules meeting these are drawn, the cheapest ones (in
+rotation steps, from protocol.block_mappings) are improved by swapping
+trials, and the best one is written out.
+
+Usage: python schedgen.py -n 100 [--starts east west] [--goal north] [-o trials.txt]
+'''
+from __future__ import division
+
+import argparse
+import itertools
+import random
+import time
+
+import protocol
+from plusmaze import PlusMaze
+from util import *
+
+TURNS = ('left', 'right')
+ALTERNATION_RANGE = (0.4, 0.6)
+
+# Arm reached from each start arm by each turn
+_goals = dict(((a, turn), b) for (a, b), turn in PlusMaze.pos_to_turn.iteritems())
+
+# Rotation steps between block positions. Index None is "unknown", which costs nothing
+_steps = dict(((a, b), len(protocol.rotation_plan(a, b)))
+              for a in PlusMaze.ordered_dirs for b in PlusMaze.ordered_dirs)
+for _b in PlusMaze.ordered_dirs:
+    _steps[(None, _b)] = 0
+
+def trial_types(starts, goal=None):
+    '''
+    (start, turn, goal) of the trials that may be used. With a fixed goal
+    arm (allocentric task), the start arms are the ones next to it
+    '''
+    types = []
+    for start in starts:
+        for turn in TURNS:
+            g = _goals[(start, turn)]
+            if (goal is None) or (g == goal):
+                types.append((start, turn, g))
+    return types
+
+def target_counts(types, n, rng, first=None, prior=None):
+    '''
+    Number of trials of each type: as even as possible, with the remainder
+    spread so that left and right turns stay balanced, and then so that the
+    start arms do, counting the trials in prior (counts of the types
+    already scheduled, e.g. in the first half). An odd remainder favors the
+    turn first (default: random)
+    '''
+    base, extra = divmod(n, len(types))
+    if first is None:
+        first = rng.choice(TURNS)
+    num_first = (extra + 1)//2
+    starts = dict((t[0], 0) for t in types)
+    for t in types:
+        starts[t[0]] += base + (prior.get(t, 0) if prior else 0)
+
+    # Few enough types to try every way of placing the remainder
+    best, choices = None, []
+    for extras in itertools.combinations(types, extra):
+        totals = dict(starts)
+        for t in extras:
+            totals[t[0]] += 1
+        score = (abs(sum(1 for t in extras if t[1] == first) - num_first),
+                 max(totals.itervalues()) - min(totals.itervalues()))
+        if (best is None) or (score < best):
+            best, choices = score, [extras]
+        elif (score == best):
+            choices.append(extras)
+    extras = rng.choice(choices)
+    return dict((t, base + (t in extras)) for t in types)
+
+def rotation_steps(schedule, block_pos=None):
+    total = 0
+    prev = block_pos
+    for start, turn, goal in schedule:
+        total += _steps[(prev, start)]
+        prev = start
+    return total
+
+def is_gellermann(turns):
+    '''
+    Checks the balance and alternation of a turn sequence (see the module
+    docstring); run lengths are checked separately
+    '''
+    n = len(turns)
+    half = n // 2
+    for part in (turns, turns[:half], turns[half:]):
+        if abs(2*part.count('left') - len(part)) > 1:
+            return False
+    if (n > 2):
+        alternations = sum(1 for i in xrange(1, n) if turns[i] != turns[i-1])
+        lo, hi = ALTERNATION_RANGE
+        if not (lo <= alternations/(n-1) <= hi):
+            return False
+    return True
+
+def run_limits(types, max_run, max_start_run=None):
+    '''
+    (field, limit) pairs for the trial types: turns and (unless the goal is
+    fixed) goal arms are limited to max_run, start arms to max_start_run
+    '''
+    limits = [(1, max_run)]
+    if (len(set(t[2] for t in types)) > 1):
+        limits.append((2, max_run))
+    if max_start_run is not None:
+        limits.append((0, max_start_run))
+    return limits
+
+def _valid(schedule, limits):
+    for field, limit in limits:
+        run = 1
+        for i in xrange(1, len(schedule)):
+            run = run+1 if (schedule[i][field] == schedule[i-1][field]) else 1
+            if (run > limit):
+                return False
+    return is_gellermann([t[1] for t in schedule])
+
+def _draw_counts(types, n, rng):
+    # Counts of each half of the session, with opposite odd remainders so
+    # that the whole session stays balanced too, in turns and start arms
+    first = rng.choice(TURNS)
+    second = TURNS[1 - TURNS.index(first)]
+    counts = target_counts(types, n//2, rng, first)
+    return [counts, target_counts(types, n - n//2, rng, second, prior=counts)]
+
+def build_candidate(halves, rng, limits, greed, block_pos=None):
+    '''
+    Draw a schedule trial by trial from the remaining counts of each half,
+    never exceeding the run limits. Trials are drawn in proportion to how many of
+    each are left; with probability greed, only among those that need the
+    fewest rotation steps. Returns None on a dead end
+    '''
+    n = sum(sum(counts.itervalues()) for counts in halves)
+    ls, lt, lg = [n+1]*3 # Run limits of start, turn and goal
+    for field, limit in limits:
+        if (field == 0): ls = limit
+        elif (field == 1): lt = limit
+        else: lg = limit
+
+    schedule = []
+    prev = block_pos
+    s0 = t0 = g0 = None # Last start, turn and goal, and their run lengths
+    rs = rt = rg = 0
+    for counts in halves:
+        remaining = dict(counts)
+        for i in xrange(sum(counts.itervalues())):
+            options = [t for t, c in remaining.iteritems() if c > 0
+                       and (t[0] != s0 or rs < ls)
+                       and (t[1] != t0 or rt < lt)
+                       and (t[2] != g0 or rg < lg)]
+            if not options:
+                return None
+            if (rng.random() < greed):
+                cheapest = min(_steps[(prev, t[0])] for t in options)
+                options = [t for t in options if _steps[(prev, t[0])] == cheapest]
+
+            k = rng.randrange(sum(remaining[t] for t in options))
+            for t in options:
+                k -= remaining[t]
+                if (k < 0):
+                    break
+            remaining[t] -= 1
+            schedule.append(t)
+            rs = rs+1 if (t[0] == s0) else 1
+            rt = rt+1 if (t[1] == t0) else 1
+            rg = rg+1 if (t[2] == g0) else 1
+            s0, t0, g0 = t
+            prev = s0
+
+    return schedule
+
+def improve(schedule, rng, limits, block_pos=None, num_swaps=2000):
+    '''
+    Local search: swap pairs of trials whenever that keeps the schedule
+    valid and does not add rotation steps
+    '''
+    best = list(schedule)
+    cost = rotation_steps(best, block_pos)
+    n = len(best)
+    for k in xrange(num_swaps):
+        i, j = rng.randrange(n), rng.randrange(n)
+        if (best[i] == best[j]):
+            continue
+        best[i], best[j] = best[j], best[i]
+        new_cost = rotation_steps(best, block_pos)
+        if (new_cost <= cost) and _valid(best, limits):
+            cost = new_cost
+        else:
+            best[i], best[j] = best[j], best[i]
+    return best
+
+def generate(n, starts=None, goal=None, max_run=3, num_candidates=2000,
+             block_pos=None, seed=None, max_start_run=None, greed=0.7, num_improved=10):
+    '''
+    Returns the best schedule, a list of (start, turn, goal), and a dict of
+    statistics over the candidates
+    '''
+    rng = random.Random(seed)
+    types = trial_types(starts or PlusMaze.ordered_dirs, goal)
+    if not types:
+        raise ValueError("No trials lead to the goal from the given start arms")
+    limits = run_limits(types, max_run, max_start_run)
+
+    t0 = time.time()
+    candidates = []
+    baseline = [] # Rotation steps of the candidates drawn without greed
+    num_drawn = 0
+    while (len(candidates) < num_candidates) and (num_drawn < 10*num_candidates):
+        num_drawn += 1
+        halves = _draw_counts(types, n, rng)
+        # Every other draw ignores the rotation cost, as a baseline
+        greedy = (num_drawn % 2 == 1)
+        schedule = build_candidate(halves, rng, limits, greed if greedy else 0.0, block_pos)
+        if (schedule is not None) and _valid(schedule, limits):
+            cost = rotation_steps(schedule, block_pos)
+            candidates.append((cost, schedule))
+            if not greedy:
+                baseline.append(cost)
+    if not candidates:
+        raise ValueError("No valid schedule found; try longer max runs")
+
+    candidates.sort(key=lambda c: c[0])
+    baseline.sort()
+    best = None
+    for cost, schedule in candidates[:num_improved]:
+        schedule = improve(schedule, rng, limits, block_pos)
+        cost = rotation_steps(schedule, block_pos)
+        if (best is None) or (cost < best[0]):
+            best = (cost, schedule)
+
+    stats = {'num_candidates': len(candidates),
+             'num_drawn': num_drawn,
+             'median_steps': baseline[len(baseline)//2] if baseline else None,
+             'rotation_steps': best[0],
+             'generate_s': time.time() - t0}
+    return best[1], stats
+
+def expected_duration(schedule, block_pos=None, timing=protocol.DEFAULT_TIMING,
+                      run_time=10.0, handling_time=15.0):
+    '''
+    Expected session length in seconds: rotations and holds (the reward
+    delay falls within the finish hold), plus an estimate of the time the
+    mouse takes to choose an arm (run_time) and of the handling between
+    trials (handling_time)
+    '''
+    per_trial = (timing['START'] + timing['FINISH'])/1000 + run_time + handling_time
+    rotation = rotation_steps(schedule, block_pos) * timing['ROTATION']/1000
+    return len(schedule)*per_trial + rotation
+
+def write_trial_file(path, schedule, comments=()):
+    with open(path, 'w') as f:
+        for c in comments:
+            f.write('# {}\n'.format(c))
+        for start, turn, goal in schedule:
+            f.write('{} {}\n'.format(start, goal))
+
+if (__name__ == '__main__'):
+    parser = argparse.ArgumentParser(description='Generate a semi-auto trial file')
+    parser.add_argument('-n', '--num-trials', type=int, required=True)
+    parser.add_argument('--starts', nargs='+', choices=PlusMaze.ordered_dirs,
+                        help='start arms (default: all)')
+    parser.add_argument('--goal', choices=PlusMaze.ordered_dirs,
+                        help='fixed goal arm (default: goal follows the turn)')
+    parser.add_argument('--block', choices=PlusMaze.ordered_dirs,
+                        help='block position before the first trial')
+    parser.add_argument('--max-run', type=int, default=3,
+                        help='longest run of the same turn (or goal arm)')
+    parser.add_argument('--max-start-run', type=int, default=None,
+                        help='longest run of the same start arm (default: no limit)')
+    parser.add_argument('--candidates', type=int, default=2000)
+    parser.add_argument('--run-time', type=float, default=10.0,
+                        help='expected time for the mouse to choose an arm, s')
+    parser.add_argument('--handling-time', type=float, default=15.0,
+                        help='expected handling time between trials, s')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('-o', '--output', help='trial file (default: stdout)')
+    args = parser.parse_args()
+
+    schedule, stats = generate(args.num_trials, args.starts, args.goal, args.max_run,
+                               args.candidates, args.block, args.seed, args.max_start_run)
+
+    # The result must be a valid protocol
+    lines = ['{} {}'.format(start, goal) for start, turn, goal in schedule]
+    protocol.compile_lines(lines, source='<generated>', block_pos=args.block)
+
+    duration = expected_duration(schedule, args.block, run_time=args.run_time,
+                                 handling_time=args.handling_time)
+    comments = ["Generated {} by schedgen.py (seed {})".format(get_time(), args.seed),
+                "{} trials, {} left / {} right turns".format(
+                    len(schedule), sum(1 for t in schedule if t[1] == 'left'),
+                    sum(1 for t in schedule if t[1] == 'right')),
+                "Start arms: {}".format(', '.join(
+                    '{} {}'.format(a, sum(1 for t in schedule if t[0] == a))
+                    for a in PlusMaze.ordered_dirs if any(t[0] == a for t in schedule))),
+                "{} rotation steps ({} in a typical unoptimized schedule)".format(
+                    stats['rotation_steps'], stats['median_steps']),
+                "Rotation time {:.0f} s".format(
+                    stats['rotation_steps'] * protocol.DEFAULT_TIMING['ROTATION']/1000),
+                "Expected duration {:.0f} min".format(duration/60)]
+    status = "Generated {} candidates in {:.2f} s".format(stats['num_candidates'], stats['generate_s'])
+    if args.output:
+        write_trial_file(args.output, schedule, comments)
+        print_msg(status)
+        print_msg("Wrote {} trials to {}".format(len(schedule), args.output))
+    else:
+        # Only trial file lines on stdout, so that it can be redirected
+        # to a trial file
+        for c in comments + [status]:
+            print '# ' + c
+        for line in lines:
+            print line
@@ -0,0 +1,137 @@
+import heapq
+import itertools
+import threading
+import time
+import traceback
+
+from util import *
+
+class ScheduledAction(object):
+    '''
+    Handle to an action queued on the ActionScheduler
+    '''
+    __slots__ = ('due', 'func', 'args', 'group', 'cancelled')
+
+    def __init__(self, due, func, args, group):
+        self.due = due
+        self.func = func
+        self.args = args
+        self.group = group
+        self.cancelled = False
+
+class ActionScheduler(threading.Thread):
+    '''
+    Runs timed maze actions (rotations, doses, ...) off the GUI thread.
+    Actions are kept in a priority queue ordered by due time on the
+    monotonic clock, and run one at a time in due order. Actions can be
+    tagged with a group, so that everything pending for e.g. a trial can be
+    cancelled at once
+    '''
+    # Within this window of the next due time we stop waiting on the
+    # condition (which is coarse in Python 2) and sleep in short steps
+    FINE_WINDOW = 0.05 # s
+    FINE_STEP = 0.001 # s
+
+    def __init__(self):
+        threading.Thread.__init__(self, name='PlusMazeScheduler')
+        self.daemon = True
+
+        self._heap = []
+        self._counter = itertools.count() # Tie-breaker for equal due times
+        self._cond = threading.Condition()
+        self._busy = threading.RLock() # Held while an action runs
+        self._running = False
+
+    def schedule(self, delay, func, *args, **kw):
+        '''
+        Run func(*args) after delay seconds. Keyword `group` tags the action
+        '''
+        return self.schedule_at(monotonic() + delay, func, *args, **kw)
+
+    def schedule_at(self, due, func, *args, **kw):
+        action = ScheduledAction(due, func, args, kw.get('group'))
+        with self._cond:
+            heapq.heappush(self._heap, (due, next(self._counter), action))
+            self._cond.notify()
+        return action
+
+    def sequence(self, steps, group=None):
+        '''
+        Schedule a sequence of steps, starting now. Each step is either a
+        number (wait that many seconds), a callable, or a tuple of a callable
+        and its arguments. For example:
+            [(maze.rotate, 'center ccw'), 1.5, (maze.rotate, 'center ccw')]
+        Returns the list of scheduled actions
+        '''
+        actions = []
+        due = monotonic()
+        for step in steps:
+            if isinstance(step, (int, float)):
+                due += step
+            else:
+                if not isinstance(step, tuple):
+                    step = (step,)
+                actions.append(self.schedule_at(due, *step, group=group))
+        return actions
+
+    def cancel(self, action):
+        action.cancelled = True
+
+    def cancel_group(self, group):
+        '''
+        Cancel all pending actions of group. If an action is running, wait
+        for it to complete so that the caller sees a consistent maze state
+        '''
+        with self._cond:
+            for _, _, action in self._heap:
+                if (action.group == group):
+                    action.cancelled = True
+        with self._busy:
+            pass
+
+    def pending(self, group=None):
+        with self._cond:
+            return [a for _, _, a in self._heap
+                    if not a.cancelled and (group is None or a.group == group)]
+
+    def start(self):
+        self._running = True
+        threading.Thread.start(self)
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if self.is_alive():
+            self.join()
+
+    def run(self):
+        while True:
+            action = None
+            with self._cond:
+                while self._running and not self._heap:
+                    self._cond.wait()
+                if not self._running:
+                    return
+
+                due = self._heap[0][0]
+                remaining = due - monotonic()
+                if (remaining > ActionScheduler.FINE_WINDOW):
+                    self._cond.wait(remaining - ActionScheduler.FINE_WINDOW)
+                    continue
+                elif (remaining <= 0):
+                    action = heapq.heappop(self._heap)[2]
+                    self._busy.acquire()
+
+            if action is None:
+                time.sleep(min(remaining, ActionScheduler.FINE_STEP))
+                continue
+
+            try:
+                if not action.cancelled:
+                    action.func(*action.args)
+            except Exception:
+                print_msg("Exception in scheduled action:")
+                traceback.print_exc()
+            finally:
+                self._busy.release()
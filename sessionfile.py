@@ -0,0 +1,186 @@
+'''
+Binary session container. One file holds a session's trial table, its
+bit-packed lickometer frames and (optionally) the raw acquisition samples.
+
+Layout (all little-endian):
+    preamble    MAGIC, version (u2), reserved (u2), header offset (u8),
+                header length (u8)
+    sections    each aligned to SECTION_ALIGN bytes
+    header      UTF-8 JSON describing the session and its sections
+
+Sections are plain arrays, so a reader can memory-map each of them without
+copying (see SessionFile). Writing only needs the standard library, so the
+rig machines do not need NumPy.
+'''
+import json
+import struct
+
+try:
+    import numpy as np
+except ImportError:
+    np = None # Only needed for reading
+
+from util import *
+
+MAGIC = 'PMZS'
+VERSION = 1
+PREAMBLE = struct.Struct('<4sHHQQ')
+SECTION_ALIGN = 64
+
+# Codes used for arm and turn names in the trial tables
+ARMS = [None, 'west', 'north', 'south', 'east', 'any', 'none']
+TURNS = [None, 'left', 'right', 'straight']
+
+# Field kinds: (struct code, NumPy type string, encoder)
+_KINDS = {'arm':   ('B', '<u1', ARMS.index),
+          'turn':  ('B', '<u1', TURNS.index),
+          'float': ('d', '<f8', float),
+          'frame': ('q', '<i8', lambda f: -1 if f is None else int(f))}
+
+# Trial table of each protocol: (field name, kind)
+TRIAL_FIELDS = {
+    'semiauto': [('start', 'arm'), ('block', 'arm'), ('goal', 'arm'), ('result', 'arm'),
+                 ('time', 'float'), ('reward_delay', 'float'),
+                 ('start_frame', 'frame'), ('open_frame', 'frame'),
+                 ('close_frame', 'frame'), ('end_frame', 'frame')],
+    'ego':      [('start', 'arm'), ('end', 'arm'), ('turn', 'turn'), ('time', 'float')],
+}
+
+SAMPLE_DTYPE = [('time', '<f8'), ('raw', '<u4'), ('frame', '<u4')]
+_SAMPLE_STRUCT = struct.Struct('<dII')
+
+def _pad(f):
+    f.write('\0' * (-f.tell() % SECTION_ALIGN))
+    return f.tell()
+
+def write_session(path, protocol, trials=(), licks=None, samples=None, meta=None):
+    '''
+    Write a session container. trials are records (e.g. namedtuples) with
+    the fields of TRIAL_FIELDS[protocol], licks is a LickBuffer, and
+    samples an optional iterable of MazeState
+    '''
+    fields = TRIAL_FIELDS[protocol]
+    record = struct.Struct('<' + ''.join(_KINDS[kind][0] for _, kind in fields))
+    encoders = [(name, _KINDS[kind][2]) for name, kind in fields]
+
+    header = {'version': VERSION,
+              'created': get_time(),
+              'protocol': protocol,
+              'meta': meta or {},
+              'enums': {'arm': ARMS, 'turn': TURNS},
+              'sections': {}}
+    sections = header['sections']
+
+    f = open(path, 'wb')
+    f.write(PREAMBLE.pack(MAGIC, VERSION, 0, 0, 0))
+
+    # Trial table
+    offset = _pad(f)
+    count = 0
+    for trial in trials:
+        f.write(record.pack(*[encode(getattr(trial, name)) for name, encode in encoders]))
+        count += 1
+    sections['trials'] = {'offset': offset,
+                          'count': count,
+                          'dtype': [(name, _KINDS[kind][1]) for name, kind in fields]}
+
+    # Lickometer frames, packed 8 per byte (little-endian bit order)
+    if licks is not None:
+        offset = _pad(f)
+        data = licks.tobytes()
+        f.write(data)
+        sections['licks'] = {'offset': offset,
+                             'nbytes': len(data),
+                             'num_frames': len(licks)}
+
+    # Raw acquisition samples
+    if samples is not None:
+        offset = _pad(f)
+        count = 0
+        for state in samples:
+            f.write(_SAMPLE_STRUCT.pack(state.time, state.raw, state.frame))
+            count += 1
+        sections['samples'] = {'offset': offset,
+                               'count': count,
+                               'dtype': SAMPLE_DTYPE}
+
+    header_offset = _pad(f)
+    header_json = json.dumps(header, sort_keys=True)
+    f.write(header_json)
+    f.seek(0)
+    f.write(PREAMBLE.pack(MAGIC, VERSION, 0, header_offset, len(header_json)))
+    f.close()
+
+class SessionFile(object):
+    '''
+    Reader for session containers. Each section is exposed as a read-only
+    NumPy memory map of the file; nothing is copied until it is used
+    '''
+    def __init__(self, path):
+        if np is None:
+            raise ImportError("NumPy is required to read session files")
+
+        self.path = path
+        with open(path, 'rb') as f:
+            magic, version, _, header_offset, header_len = PREAMBLE.unpack(f.read(PREAMBLE.size))
+            if (magic != MAGIC):
+                raise ValueError("{} is not a session file".format(path))
+            if (version > VERSION):
+                raise ValueError("{} has unsupported version {}".format(path, version))
+            f.seek(header_offset)
+            self.header = json.loads(f.read(header_len))
+
+        self.protocol = self.header['protocol']
+        self.meta = self.header['meta']
+        self.sections = self.header['sections']
+
+    def _map(self, name, dtype, count):
+        section = self.sections[name]
+        if (count == 0):
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(self.path, dtype=dtype, mode='r',
+                         offset=section['offset'], shape=(count,))
+
+    def _dtype(self, name):
+        # JSON turns the (name, type) pairs into lists
+        return np.dtype([(str(n), str(t)) for n, t in self.sections[name]['dtype']])
+
+    @property
+    def trials(self):
+        # Structured array; arm and turn fields hold indices into ARMS and TURNS
+        return self._map('trials', self._dtype('trials'), self.sections['trials']['count'])
+
+    @property
+    def num_frames(self):
+        return self.sections['licks']['num_frames'] if ('licks' in self.sections) else 0
+
+    @property
+    def lick_bits(self):
+        # Packed lick frames: frame i is bit (i % 8) of byte (i // 8)
+        if 'licks' not in self.sections:
+            return None
+        return self._map('licks', 'u1', self.sections['licks']['nbytes'])
+
+    def licks(self):
+        '''
+        Lick state of each frame as a bool array (this one is a copy)
+        '''
+        bits = self.lick_bits
+        if bits is None:
+            return np.zeros(0, dtype=bool)
+        # Reverse each unpacked byte to get little-endian bit order
+        frames = np.unpackbits(bits).reshape(-1, 8)[:, ::-1].ravel()
+        return frames[:self.num_frames].astype(bool)
+
+    @property
+    def samples(self):
+        if 'samples' not in self.sections:
+            return None
+        return self._map('samples', self._dtype('samples'), self.sections['samples']['count'])
+
+    def decode(self, field, codes):
+        '''
+        Names for the codes of an arm or turn field
+        '''
+        enum = self.header['enums'][dict(TRIAL_FIELDS[self.protocol])[field]]
+        return [enum[c] for c in codes]
@@ -0,0 +1,328 @@
+'''
+In-process simulation of the plus maze FPGA, for running PlusMaze without
+the Opal Kelly board. SimFrontPanel implements the subset of ok.FrontPanel
+that PlusMaze uses, following the register map in the PlusMaze settings
+tables, and VirtualMouse provides the behavior to sense.
+'''
+import random
+import time
+
+from plusmaze import PlusMaze
+from util import *
+
+class VirtualMouse(object):
+    '''
+    Scriptable mouse. The script is a list of steps:
+        ('wait', seconds)   Stay in the current arm
+        ('goto', arm)       Run to arm, once the maze allows it
+        ('turn', turn)      Run to the arm reached by a 'left', 'right' or
+                            'straight' turn, once the maze allows it
+        ('lick', seconds)   Lick at the spout of the current arm
+    When the script runs out, the mouse wanders: it dwells in each arm for
+    a random time and then turns left or right (p_right) if it can.
+    The mouse always licks for a while after being dosed, and with
+    probability p_entry_lick also briefly after entering an arm
+    '''
+    LICK_FREQ = 7.0 # Hz
+    LICK_DUTY = 0.3
+    RETRY_PERIOD = 0.05 # s, for steps that are blocked by the maze
+    ENTRY_LICK_DURATION = 0.5 # s
+
+    def __init__(self, start='east', script=None, dwell=(1.0, 3.0), p_right=0.5,
+                 lick_latency=0.3, lick_duration=2.0, p_entry_lick=0.0, seed=None):
+        self.pos = start
+        self.script = list(script or [])
+        self.dwell = dwell
+        self.p_right = p_right
+        self.lick_latency = lick_latency
+        self.lick_duration = lick_duration
+        self.p_entry_lick = p_entry_lick
+        self.rng = random.Random(seed)
+
+        self.next_time = None
+        self.licks = [] # (start, stop) intervals of spout contact
+
+    def _lick_bout(self, t, duration):
+        period = 1.0 / VirtualMouse.LICK_FREQ
+        for k in xrange(int(duration * VirtualMouse.LICK_FREQ)):
+            t0 = t + k*period
+            self.licks.append((t0, t0 + VirtualMouse.LICK_DUTY*period))
+
+    def is_licking(self, t):
+        self.licks = [l for l in self.licks if l[1] > t - 1.0]
+        return any(t0 <= t < t1 for t0, t1 in self.licks)
+
+    def dosed(self, t, arm):
+        if (arm == self.pos) or (arm == 'all'):
+            self._lick_bout(t + self.lick_latency, self.lick_duration)
+
+    def _enter(self, sim, t, target):
+        sim.mouse_entered(t, self.pos, target)
+        self.pos = target
+        if self.p_entry_lick and (self.rng.random() < self.p_entry_lick):
+            self._lick_bout(t + self.lick_latency, VirtualMouse.ENTRY_LICK_DURATION)
+
+    def _target(self, turn):
+        for (a, b), tn in PlusMaze.pos_to_turn.iteritems():
+            if (a == self.pos) and (tn == turn):
+                return b
+
+    def update(self, sim, t):
+        '''
+        Advance the mouse to time t. Arm entries are made at the time they
+        were scheduled, provided the maze allows them then
+        '''
+        if self.next_time is None:
+            # Settle in the start arm before wandering off
+            self.next_time = t if self.script else (t + self.rng.uniform(*self.dwell))
+        while (self.next_time <= t):
+            now = self.next_time
+            if self.script:
+                step, arg = self.script[0]
+                if (step == 'wait'):
+                    self.next_time = now + arg
+                elif (step == 'lick'):
+                    self._lick_bout(now, arg)
+                    self.next_time = now + arg
+                else:
+                    target = arg if (step == 'goto') else self._target(arg)
+                    if not sim.can_move(self.pos, target):
+                        self.next_time = now + VirtualMouse.RETRY_PERIOD
+                        continue
+                    self._enter(sim, now, target)
+                self.script.pop(0)
+            else:
+                turn = 'right' if (self.rng.random() < self.p_right) else 'left'
+                target = self._target(turn)
+                if sim.can_move(self.pos, target):
+                    self._enter(sim, now, target)
+                    self.next_time = now + self.rng.uniform(*self.dwell)
+                else:
+                    self.next_time = now + VirtualMouse.RETRY_PERIOD
+
+class SimFrontPanel(object):
+    '''
+    Drop-in stand-in for ok.FrontPanel. Every USB transaction (UpdateWireIns,
+    UpdateWireOuts, ActivateTriggerIn, ReadFromPipeOut) blocks for `latency`
+    plus Gaussian `jitter` seconds; pipe reads additionally take
+    len/bandwidth. With probability p_glitch, a read of the proximity
+    detector returns a random arm. Without a mouse, a VirtualMouse licking
+    on arm entries with probability p_entry_lick is used. Maze activity is
+    recorded in `log` as (time, what, detail)
+    '''
+    NoError = 0
+    DeviceNotOpen = -8
+    Failed = -1
+
+    FRAME_RATE = 20.0 # Hz, miniscope frame clock
+    simulated = True # Kept out of the FPGA cache
+
+    def __init__(self, mouse=None, latency=250e-6, jitter=50e-6, bandwidth=30e6,
+                 serials=('SIM00001',), p_glitch=0.0, p_entry_lick=0.0, seed=None):
+        if mouse is None:
+            mouse = VirtualMouse(p_entry_lick=p_entry_lick, seed=seed)
+        self.mouse = mouse
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth # bytes/s
+        self.p_glitch = p_glitch
+        self.serials = list(serials)
+        self.rng = random.Random(seed)
+
+        self.serial = None
+        self.configured = False
+        self.num_transactions = {}
+        self.log = []
+
+        # Register file
+        self.wire_ins = {}
+        self.pending_wire_ins = {}
+        self.wire_outs = {}
+
+        # Maze state
+        self.gates = dict((arm, False) for arm in PlusMaze.ordered_dirs) # Closed?
+        self.block_pos = self.mouse.pos
+        self.last_detected = self.mouse.pos
+        self.lick = False
+
+        # Miniscope and lickometer
+        self.recording = False
+        self.frame_count = 0
+        self.next_frame_time = None
+        self.lick_bram = bytearray(PlusMaze.lick_settings['BUFFER_LENGTH_IN_BYTES'])
+        self.pipe_addr = 0
+
+        self._prox_ids = dict((name, i) for i, name in PlusMaze.prox_settings['names'].iteritems())
+        self._gate_by_epaddr = dict((g.epaddr, arm) for arm, g in PlusMaze.gate_settings.iteritems())
+
+    # Device management
+    #------------------------------------------------------------
+    def GetDeviceCount(self):
+        return len(self.serials)
+
+    def GetDeviceListSerial(self, i):
+        return self.serials[i]
+
+    def OpenBySerial(self, serial=''):
+        if serial not in self.serials:
+            return SimFrontPanel.DeviceNotOpen
+        self.serial = serial
+        return SimFrontPanel.NoError
+
+    def GetSerialNumber(self):
+        return self.serial
+
+    def LoadDefaultPLLConfiguration(self):
+        return SimFrontPanel.NoError
+
+    def ConfigureFPGA(self, bitfile):
+        self._transaction('ConfigureFPGA')
+        self.configured = True
+        self.wire_ins = {}
+        self.pending_wire_ins = {}
+        return SimFrontPanel.NoError
+
+    def IsFrontPanelEnabled(self):
+        return self.configured
+
+    # Endpoints
+    #------------------------------------------------------------
+    def SetWireInValue(self, epaddr, val, mask=0xFFFFFFFF):
+        old = self.pending_wire_ins.get(epaddr, self.wire_ins.get(epaddr, 0))
+        self.pending_wire_ins[epaddr] = (old & ~mask) | (val & mask)
+        return SimFrontPanel.NoError
+
+    def UpdateWireIns(self):
+        now = self._transaction('UpdateWireIns')
+        for epaddr, val in self.pending_wire_ins.iteritems():
+            if (self.wire_ins.get(epaddr) != val):
+                self._wire_in_changed(now, epaddr, val)
+            self.wire_ins[epaddr] = val
+        self.pending_wire_ins = dict(self.wire_ins)
+
+    def UpdateWireOuts(self):
+        now = self._transaction('UpdateWireOuts')
+        status = self._prox_ids[self.last_detected]
+        if self.p_glitch and (self.rng.random() < self.p_glitch):
+            status = self.rng.randrange(len(self._prox_ids))
+            self.log.append((now, 'glitch', PlusMaze.prox_settings['names'][status]))
+        if self.lick:
+            status |= 1 << PlusMaze.lick_settings['LICK_BIT']
+        self.wire_outs[PlusMaze.prox_settings['LASTDETECT_EPADDR']] = status
+        self.wire_outs[PlusMaze.scope_settings['FRAME_LO_EPADDR']] = self.frame_count & 0xFFFF
+        self.wire_outs[PlusMaze.scope_settings['FRAME_HI_EPADDR']] = (self.frame_count >> 16) & 0xFFFF
+
+    def GetWireOutValue(self, epaddr):
+        return self.wire_outs.get(epaddr, 0)
+
+    def ActivateTriggerIn(self, epaddr, bit):
+        now = self._transaction('ActivateTriggerIn')
+        if (epaddr == PlusMaze.dose_settings['TRIG_EPADDR']):
+            self._trigger(now, bit)
+        elif (epaddr == PlusMaze.lick_settings['TRIG_EPADDR']):
+            if (bit == PlusMaze.lick_settings['trig_map']['reset_addr']):
+                self.pipe_addr = 0
+        return SimFrontPanel.NoError
+
+    def ReadFromPipeOut(self, epaddr, data):
+        self._transaction('ReadFromPipeOut', len(data))
+        if (epaddr != PlusMaze.lick_settings['PIPE_EPADDR']):
+            return SimFrontPanel.Failed
+
+        # The read address wraps around the lickometer BRAM
+        n = len(self.lick_bram)
+        for k in xrange(len(data)):
+            data[k] = self.lick_bram[(self.pipe_addr + k) % n]
+        self.pipe_addr = (self.pipe_addr + len(data)) % n
+        return len(data)
+
+    # Simulation
+    #------------------------------------------------------------
+    def _transaction(self, name, num_bytes=0):
+        '''
+        Block for the USB latency of one transaction. The maze is sampled
+        (and commands take effect) halfway through the transaction
+        '''
+        self.num_transactions[name] = self.num_transactions.get(name, 0) + 1
+        duration = max(0.0, self.rng.gauss(self.latency, self.jitter))
+        duration += num_bytes / self.bandwidth
+        time.sleep(0.5*duration)
+        now = monotonic()
+        self.advance(now)
+        time.sleep(0.5*duration)
+        return now
+
+    def advance(self, t):
+        # Mouse first, since it determines the lick state of each frame
+        self.mouse.update(self, t)
+        if self.recording:
+            frame_period = 1.0 / SimFrontPanel.FRAME_RATE
+            while (self.next_frame_time <= t):
+                self._store_lick_bit(self.frame_count,
+                                     self.mouse.is_licking(self.next_frame_time))
+                self.frame_count = (self.frame_count + 1) & 0xFFFFFFFF
+                self.next_frame_time += frame_period
+        self.lick = self.mouse.is_licking(t)
+
+    def _store_lick_bit(self, frame, lick):
+        n = 8*len(self.lick_bram)
+        i = frame % n
+        if lick:
+            self.lick_bram[i >> 3] |= (1 << (i & 7))
+        else:
+            self.lick_bram[i >> 3] &= ~(1 << (i & 7)) & 0xFF
+
+    def can_move(self, from_arm, to_arm):
+        if (to_arm is None) or self.gates[from_arm] or self.gates[to_arm]:
+            return False
+        # The T-block closes off the arm opposite to the one it faces
+        return PlusMaze.pos_to_turn.get((self.block_pos, to_arm)) != 'straight'
+
+    def place_mouse(self, arm):
+        '''
+        Move the mouse to arm by hand, as the experimenter does between
+        semi-auto trials
+        '''
+        self.mouse.pos = arm
+        self.mouse.next_time = None
+        self.mouse_entered(monotonic(), None, arm)
+
+    def mouse_entered(self, t, from_arm, to_arm):
+        self.last_detected = to_arm
+        self.log.append((t, 'enter', to_arm))
+
+    def _wire_in_changed(self, t, epaddr, val):
+        arm = self._gate_by_epaddr.get(epaddr)
+        if arm is not None:
+            g = PlusMaze.gate_settings[arm]
+            self.gates[arm] = abs(val - g.cl) < abs(val - g.op)
+            self.log.append((t, 'gate', (arm, self.gates[arm])))
+
+    def _trigger(self, t, bit):
+        for d in ['all',] + PlusMaze.ordered_dirs:
+            if (bit == PlusMaze.dose_settings[d].trig_bit):
+                self.log.append((t, 'dose', d))
+                self.mouse.dosed(t, d)
+                return
+
+        for r, r_bit in PlusMaze.rotation_settings['trig_map'].iteritems():
+            if (bit == r_bit) and r.startswith('center'):
+                self.block_pos = _rotate_block(self.block_pos, r)
+                self.log.append((t, 'rotate', r))
+                return
+
+        scope = PlusMaze.scope_settings['trig_map']
+        if (bit == scope['start']):
+            self.recording = True
+            self.next_frame_time = t
+        elif (bit == scope['stop']):
+            self.recording = False
+        elif (bit == scope['reset']):
+            self.frame_count = 0
+
+# Order of the arms as the block turns clockwise
+_CW_ORDER = ['south', 'west', 'north', 'east']
+
+def _rotate_block(pos, r):
+    step = 1 if (r == 'center cw') else -1
+    return _CW_ORDER[(_CW_ORDER.index(pos) + step) % 4]
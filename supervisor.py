@@ -0,0 +1,286 @@
+'''
+Runs several mazes from one host, one worker process per FPGA. Each worker
+opens its board by serial, with the rig's own gate and dose calibration,
+and runs its own acquisition loop and protocol (see plusmaze_cli.py), so
+rigs do not share a GIL or a USB handle. The supervisor collects the status
+of every rig into one table.
+
+Rigs are described in a JSON file:
+
+    {"rigs": [{"name": "rig1",
+               "serial": "1739000ABC",
+               "gates": {"north": {"cl": 510, "op": 1120}},
+               "doses": {"east": {"dose_vol": 15500}},
+               "protocol": ["semiauto", "trials1.txt", "-o", "rig1.txt"]},
+              {"name": "rig2",
+               "serial": "1739000DEF",
+               "protocol": ["ego", "--turn", "right", "-o", "rig2.txt"]}]}
+
+"gates" and "doses" are optional, and override fields of the calibration
+profile of the board (see calibration.py) for this run. "protocol" is a
+plusmaze_cli.py command line, run with --rig NAME so that the journals,
+lick streams and default result files of the rigs carry their names. The
+messages of each rig are prefixed with its name, and with --log-dir DIR
+also written to DIR/<name>.log (see logwriter.py).
+
+Usage: python supervisor.py rigs.json [--sim] [--force-reprogram] [--log-dir DIR]
+       python supervisor.py --list
+'''
+import argparse
+import collections
+import json
+import multiprocessing
+import os
+import Queue
+
+import calibration
+import plusmaze_cli
+from logwriter import start_logging, stop_logging
+from plusmaze import PlusMaze, DeviceError
+from util import *
+
+# gates and doses are the calibration overrides of the rig, {arm: {field: value}}
+Rig = collections.namedtuple('Rig', 'name serial gates doses protocol')
+
+def load_rigs(path):
+    '''
+    Reads the rigs file, and checks that every rig has its own name and
+    serial, and a valid protocol command line
+    '''
+    with open(path, 'r') as f:
+        config = json.load(f)
+
+    rigs = []
+    parser = plusmaze_cli.make_parser()
+    for i, r in enumerate(config['rigs']):
+        name = r.get('name', 'rig{}'.format(i+1))
+        if 'protocol' not in r:
+            raise ValueError("{}: no protocol".format(name))
+        protocol = [str(a) for a in r['protocol']]
+        args = parser.parse_args(protocol)
+        plusmaze_cli.check_args(parser, args)
+
+        rig = Rig(name=name, serial=r.get('serial'), gates=r.get('gates', {}),
+                  doses=r.get('doses', {}), protocol=protocol)
+        calibration.calibrated(PlusMaze.gate_settings, rig.gates, name + ' gate')
+        calibration.calibrated(PlusMaze.dose_settings, rig.doses, name + ' dose')
+        rigs.append(rig)
+
+    for field in ('name', 'serial'):
+        values = [getattr(rig, field) for rig in rigs if getattr(rig, field) is not None]
+        duplicates = set(v for v in values if values.count(v) > 1)
+        if duplicates:
+            raise ValueError("rigs share the {} {}".format(field, ', '.join(sorted(duplicates))))
+    return rigs
+
+def describe(engine):
+    '''
+    One-line progress of a protocol engine
+    '''
+    if hasattr(engine, 'num_correct'):
+        return 'trial {}/{}, {} correct'.format(
+                    engine.trial_index, engine.num_trials, engine.num_correct)
+    elif hasattr(engine, 'num_left'):
+        return 'trial {}/{}, {} left, {} right'.format(
+                    engine.trial_index, engine.num_trials, engine.num_left, engine.num_right)
+    elif hasattr(engine, 'mode'):
+        return 'autoreward ({})'.format(engine.mode or 'off')
+    return ''
+
+def _run_rig(rig, argv, status_queue, log_file=None):
+    # Entry point of a worker process
+    start_logging(log_file, rig=rig.name)
+    def send(state, **status):
+        status.update(rig=rig.name, pid=os.getpid(), state=state, time=get_time())
+        status_queue.put(status)
+
+    last_report = [0]
+    engines = []
+    def report(engine):
+        engines[:] = [engine]
+        t = monotonic()
+        if (t - last_report[0] < Supervisor.REPORT_PERIOD):
+            return
+        last_report[0] = t
+        state = engine.acq.latest()
+        send(engine.state, progress=describe(engine), pos=state.pos,
+             samples=engine.acq.ring.count, overruns=engine.acq.num_overruns)
+
+    send('starting')
+    try:
+        parser = plusmaze_cli.make_parser()
+        args = parser.parse_args(argv)
+        plusmaze_cli.run(args, report, calibration={'gates': rig.gates, 'doses': rig.doses})
+    except SystemExit, e:
+        send('failed', progress=str(e))
+    except Exception, e:
+        send('failed', progress='{}: {}'.format(type(e).__name__, e))
+        raise
+    else:
+        send('finished', **({'progress': describe(engines[0])} if engines else {}))
+    finally:
+        # Worker processes exit without running atexit
+        stop_logging()
+
+class Supervisor(object):
+    '''
+    Starts a worker process per rig and keeps the latest status of each
+    '''
+    REPORT_PERIOD = 1.0 # s, between status reports of a worker
+    STATUS_PERIOD = 10.0 # s, between status tables
+    STOP_TIMEOUT = 10.0 # s, for workers to save their results on Ctrl-C
+
+    def __init__(self, rigs, sim=False, force_reprogram=False, seed=None, log_dir=None):
+        self.rigs = rigs
+        self.sim = sim
+        self.force_reprogram = force_reprogram
+        self.seed = seed
+        self.log_dir = log_dir
+
+        self.status_queue = multiprocessing.Queue()
+        self.workers = {}
+        self.status = collections.OrderedDict((rig.name, {'state': 'idle'}) for rig in rigs)
+
+    def _check_devices(self):
+        if self.sim:
+            return
+        serials = PlusMaze.list_serials()
+        print_msg("Devices on this host: {}".format(', '.join(serials) or 'none'))
+        configured = set(rig.serial for rig in self.rigs)
+        for serial in serials:
+            if serial not in configured:
+                print_msg("Warning! Device {} is not assigned to a rig".format(serial), 'warning')
+        for rig in self.rigs:
+            if rig.serial is None:
+                raise DeviceError("{} needs a serial to run alongside other rigs".format(rig.name))
+            if rig.serial not in serials:
+                raise DeviceError("Device {} of {} is not attached".format(rig.serial, rig.name))
+
+    def _argv(self, i, rig):
+        # The rig name keeps the session files of the rigs apart
+        argv = ['--rig', rig.name]
+        if self.sim:
+            argv += ['--sim', '--serial', rig.serial or 'SIM{:05d}'.format(i+1)]
+            if self.seed is not None:
+                argv += ['--seed', str(self.seed + i)]
+        else:
+            argv += ['--serial', rig.serial]
+        if self.force_reprogram:
+            argv.append('--force-reprogram')
+        return argv + rig.protocol
+
+    def start(self):
+        self._check_devices()
+        if self.log_dir and not os.path.isdir(self.log_dir):
+            os.makedirs(self.log_dir)
+        for i, rig in enumerate(self.rigs):
+            log_file = os.path.join(self.log_dir, rig.name + '.log') if self.log_dir else None
+            p = multiprocessing.Process(target=_run_rig, name=rig.name,
+                                        args=(rig, self._argv(i, rig), self.status_queue, log_file))
+            p.start()
+            self.workers[rig.name] = p
+            print_msg("Started {} (pid {})".format(rig.name, p.pid))
+
+    def poll(self, timeout=0):
+        '''
+        Collects the status reports of the workers, waiting up to timeout
+        for the first one
+        '''
+        try:
+            while True:
+                status = self.status_queue.get(timeout=timeout)
+                self.status[status['rig']].update(status)
+                timeout = 0
+        except Queue.Empty:
+            pass
+
+        for name, p in self.workers.iteritems():
+            status = self.status[name]
+            if not p.is_alive() and (status['state'] not in ('finished', 'failed')):
+                status.update(state='failed', progress='exit code {}'.format(p.exitcode))
+
+    def is_running(self):
+        return any(p.is_alive() for p in self.workers.itervalues())
+
+    def status_table(self):
+        lines = []
+        for rig in self.rigs:
+            s = self.status[rig.name]
+            line = '{:<10} {:<12} {:<12} {}'.format(
+                        rig.name, rig.serial or '-', s['state'], s.get('progress', ''))
+            if 'pos' in s:
+                line += '  (mouse at {}, {} samples, {} overruns)'.format(
+                            s['pos'], s['samples'], s['overruns'])
+            lines.append(line)
+        return lines
+
+    def print_status(self):
+        print_msg("Status of {} rigs".format(len(self.rigs)))
+        for line in self.status_table():
+            print '    ' + line
+
+    def run(self):
+        '''
+        Reports the status of the rigs until every worker has exited
+        '''
+        next_table = monotonic()
+        try:
+            while self.is_running():
+                self.poll(timeout=Supervisor.REPORT_PERIOD)
+                if (monotonic() >= next_table):
+                    self.print_status()
+                    next_table += Supervisor.STATUS_PERIOD
+        except KeyboardInterrupt:
+            # The workers get the Ctrl-C too; give them time to save results
+            print_msg("Interrupted, waiting for the rigs to stop")
+            self.stop()
+        self.poll()
+        self.print_status()
+
+    def stop(self):
+        deadline = monotonic() + Supervisor.STOP_TIMEOUT
+        while self.is_running() and (monotonic() < deadline):
+            self.poll(timeout=0.1)
+        for name, p in self.workers.iteritems():
+            if p.is_alive():
+                print_msg("Terminating {}".format(name))
+                p.terminate()
+            p.join()
+
+if (__name__ == '__main__'):
+    parser = argparse.ArgumentParser(description='Run several plus mazes from one host')
+    parser.add_argument('rigs_file', nargs='?', help='JSON description of the rigs')
+    parser.add_argument('--list', action='store_true',
+                        help='list the FrontPanel devices attached to this host')
+    parser.add_argument('--sim', action='store_true',
+                        help='run every rig against a simulated maze')
+    parser.add_argument('--force-reprogram', action='store_true',
+                        help='load the bitfile even if the FPGAs are already running it')
+    parser.add_argument('--seed', type=int, default=None, help='seed of the simulations')
+    parser.add_argument('--log-dir', default=None,
+                        help='write the messages of each rig to LOG_DIR/<name>.log')
+    args = parser.parse_args()
+
+    if args.list:
+        try:
+            for serial in PlusMaze.list_serials():
+                print serial
+        except DeviceError:
+            raise SystemExit("Could not enumerate the FrontPanel devices")
+        raise SystemExit
+    if not args.rigs_file:
+        parser.error('a rigs file is needed')
+
+    try:
+        rigs = load_rigs(args.rigs_file)
+    except (IOError, ValueError, KeyError), e:
+        raise SystemExit("Error in {}: {}".format(args.rigs_file, e))
+
+    supervisor = Supervisor(rigs, sim=args.sim, force_reprogram=args.force_reprogram,
+                            seed=args.seed, log_dir=args.log_dir)
+    try:
+        supervisor.start()
+    except DeviceError, e:
+        supervisor.stop()
+        raise SystemExit(str(e))
+    supervisor.run()
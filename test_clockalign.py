@@ -0,0 +1,91 @@
+'''
+Tests of the frame clock (clockalign.py), fed with the samples of a
+simulated miniscope.
+
+Usage: python -m unittest test_clockalign
+'''
+from __future__ import division
+
+import math
+import unittest
+
+from clockalign import FrameClock
+from events import FRAME_COUNTER_MODULUS
+
+PERIOD = 0.001 # s, between samples
+RATE = 20.3 # Hz, of the miniscope clock
+
+def record(clock, t0, duration, first_frame=0):
+    '''
+    Feed the samples of a recording that starts at t0 with first_frame.
+    Returns the time after the last sample
+    '''
+    n = int(round(duration/PERIOD))
+    for i in xrange(n):
+        t = t0 + i*PERIOD
+        frame = first_frame + int(math.floor((t - t0)*RATE)) + 1
+        clock.update(t, frame % FRAME_COUNTER_MODULUS)
+    return t0 + n*PERIOD
+
+def pause(clock, t0, duration):
+    # Samples go on while the miniscope does not record
+    n = int(round(duration/PERIOD))
+    for i in xrange(n):
+        clock.update(t0 + i*PERIOD, clock.prev_frame)
+    return t0 + n*PERIOD
+
+class FrameClockTest(unittest.TestCase):
+    def test_fit(self):
+        clock = FrameClock()
+        self.assertIsNone(clock.frame_at(0.0))
+        end = record(clock, 100.0, 10.0)
+        self.assertAlmostEqual(clock.rate, RATE, delta=0.01*RATE)
+        for t in (101.0, 104.52, 109.9):
+            self.assertAlmostEqual(clock.frame_at(t), (t - 100.0)*RATE + 1, delta=0.5)
+            self.assertAlmostEqual(clock.time_of(int(clock.frame_at(t))), t, delta=1/RATE)
+        self.assertEqual(clock.counter_at(105.0), int(math.floor(clock.frame_at(105.0))))
+
+        # The counter stops with the recording
+        last = clock.prev_frame
+        end = pause(clock, end, 2.0)
+        self.assertEqual(clock.frame_at(end - 0.5), last)
+
+    def test_segments(self):
+        # Recordings separated by pauses are fitted separately, with a
+        # pooled rate
+        clock = FrameClock()
+        end = record(clock, 0.0, 5.0)
+        frame = clock.prev_frame
+        start = pause(clock, end, 3.0)
+        record(clock, start, 5.0, first_frame=frame)
+        summary = clock.summary()
+        self.assertEqual(len(summary['segments']), 2)
+        self.assertAlmostEqual(summary['rate'], RATE, delta=0.01*RATE)
+        self.assertAlmostEqual(clock.frame_at(start + 2.0), frame + 2.0*RATE + 1, delta=0.5)
+        self.assertEqual(clock.frame_at(end + 1.0), frame) # Between the recordings
+
+    def test_wrap(self):
+        clock = FrameClock()
+        first = FRAME_COUNTER_MODULUS - 50
+        record(clock, 0.0, 5.0, first_frame=first)
+        self.assertEqual(clock.wraps, 1)
+        self.assertAlmostEqual(clock.frame_at(4.0), first + 4.0*RATE + 1, delta=0.5)
+        self.assertEqual(clock.counter_at(4.0), int(math.floor(first + 4.0*RATE + 1)) % FRAME_COUNTER_MODULUS)
+        self.assertEqual(clock.unwrap(10), FRAME_COUNTER_MODULUS + 10)
+
+    def test_reset(self):
+        # A counter reset forgets the segments, but not the rate
+        clock = FrameClock()
+        end = record(clock, 0.0, 5.0, first_frame=1000)
+        record(clock, end, 5.0)
+        self.assertEqual(clock.wraps, 0)
+        self.assertEqual(len(clock.summary()['segments']), 1)
+        self.assertAlmostEqual(clock.frame_at(end + 2.0), 2.0*RATE + 1, delta=0.5)
+        self.assertIsNone(clock.time_of(1100))
+
+        rate = clock.rate
+        clock.reset()
+        self.assertEqual(clock.summary(), {'rate': rate, 'segments': []})
+
+if (__name__ == '__main__'):
+    unittest.main()
@@ -0,0 +1,206 @@
+'''
+Tests of the protocol engines (engine.py): short sessions against the
+simulated maze (simdevice.py), with the holds and rotations of the trial
+files cut to a fraction of a second.
+
+Usage: python -m unittest test_engine
+'''
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import protocol
+from acquisition import Acquisition
+from engine import AutoReward, EgoTraining, ResumeError, open_semiauto, read_semiauto_journal
+from plusmaze import PlusMaze
+from scheduler import ActionScheduler
+from simdevice import SimFrontPanel, VirtualMouse
+
+TIMEOUT = 30.0 # s, for a whole session
+
+TRIAL_LINES = ['set START 100',
+               'set FINISH 200',
+               'set ROTATION 50',
+               'set REWARD_DELAY 50',
+               'east north',
+               'west-south any',
+               'south none']
+
+def wait_for(condition, timeout=TIMEOUT, period=0.01):
+    end_time = time.time() + timeout
+    while not condition():
+        if (time.time() > end_time):
+            return False
+        time.sleep(period)
+    return True
+
+class SimMazeTest(unittest.TestCase):
+    '''
+    Opens the simulated maze in a scratch directory, where the session
+    files go
+    '''
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+        self.open_maze()
+
+    def open_maze(self, p_entry_lick=0.0):
+        mouse = VirtualMouse(dwell=(0.05, 0.1), p_entry_lick=p_entry_lick, seed=1)
+        self.sim = SimFrontPanel(mouse=mouse, latency=50e-6, jitter=0.0, seed=1)
+        self.maze = PlusMaze(xem=self.sim)
+        self.acq = Acquisition(self.maze)
+        self.acq.start()
+        self.scheduler = ActionScheduler()
+        self.scheduler.start()
+
+    def close_maze(self):
+        self.scheduler.stop()
+        self.acq.stop()
+
+    def tearDown(self):
+        self.close_maze()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def doses(self):
+        return [detail for t, what, detail in self.sim.log if what == 'dose']
+
+class SemiAutoTest(SimMazeTest):
+    def run_session(self, engine):
+        # Hand the mouse back to the start arm between trials, as the
+        # experimenter does
+        engine.begin()
+        end_time = time.time() + TIMEOUT
+        while not engine.done.wait(0.01):
+            self.assertLess(time.time(), end_time, "session stuck in state " + engine.state)
+            if (engine.state == 'ready'):
+                start = engine.trials[engine.trial_index].start
+                if (self.acq.position() != start):
+                    with self.maze.lock:
+                        self.sim.place_mouse(start)
+        engine.close()
+        engine.save_result('results.txt')
+
+    def write_trials(self):
+        with open('trials.txt', 'w') as f:
+            f.write('\n'.join(TRIAL_LINES) + '\n')
+        return 'trials.txt'
+
+    def test_session(self):
+        trial_file = self.write_trials()
+        engine = open_semiauto(self.maze, self.acq, self.scheduler, trial_file,
+                               self.acq.position(), auto=True, rig='sim')
+        self.run_session(engine)
+        plan = protocol.compile_protocol(trial_file)
+
+        self.assertEqual(engine.state, 'done')
+        self.assertEqual(engine.trial_index, len(plan))
+        for trial, p in zip(engine.trials, plan):
+            self.assertIn(trial.result, protocol.reachable_arms(p.start, p.block))
+            self.assertTrue(trial.start_frame <= trial.open_frame <= trial.close_frame <= trial.end_frame)
+        self.assertEqual(engine.num_correct, sum(1 for t, p in zip(engine.trials, plan)
+                                                 if t.result in p.rewarded))
+        self.assertEqual(len(self.doses()), engine.num_correct) # None in the probe
+
+        # Everything was journaled, and the stream lies next to the journal
+        journal_file = engine.journal.path
+        header, records = read_semiauto_journal(journal_file)
+        self.assertEqual([r['index'] for r in records], range(len(plan)))
+        self.assertTrue(os.path.exists(os.path.join(os.path.dirname(journal_file), header['lick_stream'])))
+        for name in ('results.txt', 'results-lick.txt', 'results.pmz'):
+            self.assertTrue(os.path.exists(name))
+
+        # A finished session resumes as done, with the journaled results
+        resumed = open_semiauto(self.maze, self.acq, self.scheduler, None,
+                                self.acq.position(), resume_file=journal_file, auto=True)
+        resumed.begin()
+        self.assertEqual(resumed.state, 'done')
+        self.assertEqual(resumed.trials, engine.trials)
+        self.assertEqual(resumed.num_correct, engine.num_correct)
+        resumed.close()
+        resumed.lick_drain.stop()
+
+    def test_resume_checks(self):
+        trial_file = self.write_trials()
+        engine = open_semiauto(self.maze, self.acq, self.scheduler, trial_file,
+                               self.acq.position(), auto=True)
+        self.run_session(engine)
+        journal_file = engine.journal.path
+        header, records = read_semiauto_journal(journal_file)
+
+        # The lick stream is missing
+        stream_file = header['lick_stream']
+        os.rename(stream_file, stream_file + '.bak')
+        self.assertRaises(ResumeError, open_semiauto, self.maze, self.acq, self.scheduler,
+                          None, self.acq.position(), resume_file=journal_file)
+        os.rename(stream_file + '.bak', stream_file)
+
+        # The frame counter was reset since
+        self.maze.reset_scope_counter()
+        self.assertRaises(ResumeError, open_semiauto, self.maze, self.acq, self.scheduler,
+                          None, self.acq.position(), resume_file=journal_file)
+
+    def test_protocol_error(self):
+        with open('bad.txt', 'w') as f:
+            f.write('east east\n')
+        self.assertRaises(protocol.ProtocolError, open_semiauto, self.maze, self.acq,
+                          self.scheduler, 'bad.txt', self.acq.position())
+        self.assertEqual(self.sim.log, []) # Nothing moved
+
+class EgoTrainingTest(SimMazeTest):
+    def test_session(self):
+        engine = EgoTraining(self.maze, self.acq, self.acq.position(), turn='left', num_trials=5,
+                             journal_file='ego.journal')
+        engine.start()
+        self.assertTrue(engine.done.wait(TIMEOUT))
+        engine.close()
+
+        self.assertEqual(engine.state, 'completed')
+        self.assertEqual(len(engine.trials), 5)
+        self.assertEqual(engine.num_left + engine.num_right, 5)
+        self.assertEqual(len(self.doses()), engine.num_left)
+        for trial in engine.trials:
+            self.assertEqual(PlusMaze.pos_to_turn[(trial.start, trial.end)], trial.turn)
+
+        engine.save_result('ego.txt')
+        self.assertTrue(os.path.exists('ego.pmz'))
+
+class AutoRewardTest(SimMazeTest):
+    def test_no_reward(self):
+        engine = AutoReward(self.maze, self.acq, self.scheduler)
+        engine.start()
+        self.assertTrue(wait_for(lambda: engine.num_entries >= 3))
+        engine.close()
+        self.assertEqual(self.doses(), [])
+
+    def test_lick_window(self):
+        # Sampled fast only while a lick window is open
+        self.close_maze()
+        self.open_maze(p_entry_lick=0.5)
+        fast, slow = AutoReward.POLL_PERIODS
+        engine = AutoReward(self.maze, self.acq, self.scheduler, mode='every', lick_window=0.3)
+        engine.start()
+        self.assertEqual(engine.state, 'running')
+        self.assertEqual(self.acq.period, slow)
+
+        for n in xrange(4):
+            self.assertTrue(wait_for(lambda: engine.licks.active))
+            with engine.lock:
+                self.assertEqual(self.acq.period, fast if engine.licks.active else slow)
+            self.assertTrue(wait_for(lambda: not engine.licks.active))
+            with engine.lock:
+                self.assertEqual(self.acq.period, fast if engine.licks.active else slow)
+        self.assertGreaterEqual(len(engine.licks.rewards), 4)
+        engine.close()
+        self.assertEqual(self.acq.period, slow)
+
+        rewarded = [r for r in engine.licks.rewards if r.lick_delay is not None]
+        self.assertEqual(len(self.doses()), len(rewarded))
+        for r in rewarded:
+            self.assertLessEqual(r.lick_delay, r.window)
+
+if (__name__ == '__main__'):
+    unittest.main()
@@ -0,0 +1,96 @@
+'''
+Tests of the maze events (events.py): the proximity filter and the
+diffing of samples into events.
+
+Usage: python -m unittest test_events
+'''
+import unittest
+
+from events import (ArmEntered, EventStream, FrameCounterWrapped, LickOffset, LickOnset,
+                    ProximityFilter, diff_states, FRAME_COUNTER_MODULUS)
+from plusmaze import MazeState
+
+PERIOD = 0.001 # s
+
+def samples(arms, t0=0.0, frame=0):
+    return [MazeState(time=t0 + i*PERIOD, pos=arm, lick=False, frame=frame, raw=0)
+            for i, arm in enumerate(arms)]
+
+def entries(prox_filter, arms):
+    found = []
+    for state in samples(arms):
+        entry = prox_filter.update(state)
+        if entry is not None:
+            found.append((state.time, entry))
+    return found
+
+class ProximityFilterTest(unittest.TestCase):
+    def test_glitch(self):
+        f = ProximityFilter()
+        self.assertEqual(entries(f, ['east']*5 + ['north'] + ['east']*10), [])
+        self.assertEqual(f.pos, 'east')
+        self.assertEqual(f.num_glitches, 1)
+
+    def test_votes(self):
+        # Accepted at the third of the last five samples that read the arm
+        f = ProximityFilter()
+        found = entries(f, ['east']*5 + ['north', 'east', 'north', 'north'] + ['north']*5)
+        self.assertEqual(len(found), 1)
+        t, (from_arm, to_arm, turn, confidence, num_samples) = found[0]
+        self.assertEqual((from_arm, to_arm, turn), ('east', 'north', 'right'))
+        self.assertAlmostEqual(t, 8*PERIOD)
+        self.assertEqual(num_samples, 3)
+        self.assertAlmostEqual(confidence, 0.75)
+        self.assertEqual(f.pos, 'north')
+
+    def test_dwell(self):
+        f = ProximityFilter(votes=1, min_dwell=0.0045)
+        found = entries(f, ['east'] + ['north']*10)
+        self.assertEqual(len(found), 1)
+        self.assertAlmostEqual(found[0][0], 6*PERIOD) # First read at 1 ms
+
+    def test_relocation(self):
+        # A straight run is held back, then accepted as a relocation
+        f = ProximityFilter(relocate_after=0.0045)
+        f.allowed_turns = frozenset(['left', 'right'])
+        found = entries(f, ['east']*3 + ['west']*10)
+        self.assertEqual(f.num_rejected, 1)
+        self.assertEqual(len(found), 1)
+        t, (from_arm, to_arm, turn, confidence, num_samples) = found[0]
+        self.assertEqual((from_arm, to_arm, turn), ('east', 'west', None))
+        self.assertAlmostEqual(t, 8*PERIOD)
+
+        # Allowed turns are not held back
+        f = ProximityFilter()
+        f.allowed_turns = frozenset(['left', 'right'])
+        self.assertEqual(len(entries(f, ['east']*3 + ['south']*3)), 1)
+        self.assertEqual(f.num_rejected, 0)
+
+class DiffTest(unittest.TestCase):
+    def test_events(self):
+        prev = MazeState(time=0.0, pos='east', lick=False, frame=10, raw=0)
+        state = prev._replace(time=0.001, pos='south', lick=True)
+        events = diff_states(prev, state)
+        self.assertEqual([type(e) for e in events], [ArmEntered, LickOnset])
+        self.assertEqual(events[0].turn, 'left')
+        self.assertEqual([type(e) for e in diff_states(state, prev)], [ArmEntered, LickOffset])
+
+    def test_wrap(self):
+        prev = MazeState(time=0.0, pos='east', lick=False, frame=FRAME_COUNTER_MODULUS - 1, raw=0)
+        events = diff_states(prev, prev._replace(frame=0))
+        self.assertEqual([type(e) for e in events], [FrameCounterWrapped])
+        # A reset of the counter is not a wrap
+        prev = prev._replace(frame=1000)
+        self.assertEqual(diff_states(prev, prev._replace(frame=0)), [])
+
+    def test_stream(self):
+        stream = EventStream(ProximityFilter())
+        received = []
+        stream.subscribe(received.append, ArmEntered)
+        events = list(stream.feed(samples(['east']*5 + ['north'] + ['east']*5 + ['north']*5)))
+        self.assertEqual(received, events)
+        self.assertEqual([(e.from_arm, e.to_arm) for e in events], [('east', 'north')])
+        self.assertEqual(stream.prev.pos, 'north')
+
+if (__name__ == '__main__'):
+    unittest.main()
@@ -0,0 +1,100 @@
+'''
+Tests of the lick metrics (lickanalysis.py) on hand-made sessions.
+
+Usage: python -m unittest test_lickanalysis
+'''
+from __future__ import division
+
+import unittest
+
+import numpy as np
+
+from lickanalysis import TRIAL_DTYPE, find_bouts, lick_edges, trial_metrics
+
+RATE = 10.0 # Frames per s, to keep the numbers round
+
+def make_licks(num_frames, runs):
+    # runs are (first frame, number of frames) of each lick
+    licks = np.zeros(num_frames, dtype=bool)
+    for first, n in runs:
+        licks[first:first+n] = True
+    return licks
+
+def make_trials(rows):
+    # rows are (start_frame, open_frame, close_frame, end_frame, reward_delay)
+    return np.array(rows, dtype=TRIAL_DTYPE)
+
+class EdgesTest(unittest.TestCase):
+    def test_edges(self):
+        onsets, offsets = lick_edges(make_licks(10, [(0, 2), (5, 1), (9, 1)]))
+        self.assertEqual(onsets.tolist(), [0, 5, 9])
+        self.assertEqual(offsets.tolist(), [2, 6, 10])
+        onsets, offsets = lick_edges([])
+        self.assertEqual((len(onsets), len(offsets)), (0, 0))
+
+    def test_bouts(self):
+        onsets, offsets = lick_edges(make_licks(40, [(0, 1), (3, 1), (6, 1), (20, 2), (30, 1)]))
+        bouts = find_bouts(onsets, offsets, 3)
+        self.assertEqual(bouts['start'].tolist(), [0, 20, 30])
+        self.assertEqual(bouts['end'].tolist(), [7, 22, 31])
+        self.assertEqual(bouts['num_licks'].tolist(), [3, 1, 1])
+        self.assertEqual(len(find_bouts(onsets[:0], offsets[:0], 3)), 0)
+
+class MetricsTest(unittest.TestCase):
+    def test_trial(self):
+        # Entry at frame 50, reward 1 s later at frame 60. Licks at 55 and
+        # 60 make a bout (0.5 s gaps at most), 100 another, and 5 is before
+        # the trial
+        licks = make_licks(200, [(5, 1), (55, 2), (60, 2), (100, 1)])
+        m = trial_metrics(licks, make_trials([(10, 20, 50, 150, 1.0)]), frame_rate=RATE)[0]
+        self.assertEqual(m['num_licks'], 3)
+        self.assertAlmostEqual(m['first_lick_latency'], 0.5)
+        self.assertAlmostEqual(m['pre_reward_rate'], 1/2.0) # 55, within 2 s before
+        self.assertAlmostEqual(m['post_reward_rate'], 1/2.0) # 60, within 2 s after
+        self.assertEqual(m['num_bouts'], 2)
+        self.assertAlmostEqual(m['bout_licks'], 1.5)
+        self.assertAlmostEqual(m['bout_duration'], ((62 - 55) + (101 - 100))/2/RATE)
+
+    def test_no_licks(self):
+        m = trial_metrics(np.zeros(200, dtype=bool), make_trials([(10, 20, 50, 150, 1.0)]),
+                          frame_rate=RATE)[0]
+        self.assertEqual(m['num_licks'], 0)
+        self.assertEqual(m['num_bouts'], 0)
+        for field in ('first_lick_latency', 'bout_licks', 'bout_duration'):
+            self.assertTrue(np.isnan(m[field]))
+        self.assertEqual(m['pre_reward_rate'], 0)
+
+        m = trial_metrics(np.zeros(0, dtype=bool), make_trials([(10, 20, 50, 150, 1.0)]),
+                          frame_rate=RATE)[0]
+        self.assertEqual(m['num_licks'], 0)
+        self.assertTrue(np.isnan(m['first_lick_latency']))
+
+    def test_not_recorded(self):
+        # Frames of -1 were not recorded; probes (no reward) have no reward rates
+        licks = make_licks(200, [(55, 1), (120, 1)])
+        trials = make_trials([(-1, -1, -1, -1, 1.0),
+                              (10, 20, -1, 150, 0.0),
+                              (10, 20, 50, 150, 0.0)])
+        m = trial_metrics(licks, trials, frame_rate=RATE)
+        self.assertEqual(m['num_licks'].tolist(), [0, 2, 2])
+        self.assertEqual(m['num_bouts'].tolist(), [0, 2, 2])
+        self.assertTrue(np.isnan(m['first_lick_latency'][:2]).all())
+        self.assertAlmostEqual(m['first_lick_latency'][2], 0.5)
+        self.assertTrue(np.isnan(m['pre_reward_rate']).all())
+        self.assertTrue(np.isnan(m['post_reward_rate']).all())
+
+    def test_boundaries(self):
+        # A lick at end_frame belongs to the next trial; a lick after the
+        # trial gives no first-lick latency
+        licks = make_licks(200, [(50, 1), (100, 1), (180, 1)])
+        trials = make_trials([(0, 10, 50, 100, 0.0), (100, 110, 120, 150, 0.0)])
+        m = trial_metrics(licks, trials, frame_rate=RATE)
+        self.assertEqual(m['num_licks'].tolist(), [1, 1])
+        self.assertAlmostEqual(m['first_lick_latency'][0], 0.0)
+        self.assertTrue(np.isnan(m['first_lick_latency'][1]))
+
+    def test_no_trials(self):
+        self.assertEqual(len(trial_metrics(make_licks(10, [(1, 1)]), make_trials([]))), 0)
+
+if (__name__ == '__main__'):
+    unittest.main()
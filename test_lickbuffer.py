@@ -0,0 +1,60 @@
+'''
+Tests of the bit-packed lick buffer (lickbuffer.py), against a plain list
+of bools.
+
+Usage: python -m unittest test_lickbuffer
+'''
+import random
+import StringIO
+import unittest
+
+from lickbuffer import LickBuffer
+
+def pack(bits):
+    data = bytearray((len(bits) + 7)//8)
+    for i, bit in enumerate(bits):
+        if bit:
+            data[i >> 3] |= 1 << (i & 7)
+    return data
+
+class LickBufferTest(unittest.TestCase):
+    def setUp(self):
+        rng = random.Random(1)
+        self.bits = [rng.random() < 0.3 for i in xrange(203)]
+        self.buf = LickBuffer(pack(self.bits), len(self.bits))
+
+    def test_decoding(self):
+        # Frame i is bit (i % 8) of byte (i // 8)
+        buf = LickBuffer(bytearray([0x01, 0x80]))
+        self.assertEqual(buf.to_list(), [True] + [False]*14 + [True])
+        self.assertEqual(len(LickBuffer(bytearray(2), 12)), 12)
+
+    def test_index(self):
+        self.assertEqual(list(self.buf), self.bits)
+        self.assertEqual(self.buf[5], self.bits[5])
+        self.assertEqual(self.buf[-1], self.bits[-1])
+        self.assertRaises(IndexError, lambda: self.buf[len(self.bits)])
+
+    def test_slices(self):
+        for start, stop in [(0, 203), (3, 5), (3, 150), (8, 16), (13, 200), (100, 100), (7, 9), (190, 500)]:
+            part = self.buf[start:stop]
+            expected = self.bits[start:stop]
+            self.assertEqual(len(part), len(expected))
+            self.assertEqual(list(part), expected)
+            self.assertEqual(part.count(), sum(expected))
+            self.assertEqual(part.count(False), len(expected) - sum(expected))
+            self.assertEqual(part.tobytes(), str(pack(expected)))
+            self.assertIs(part.data, self.buf.data) # No copy
+        self.assertEqual(self.buf[1:50:3], self.bits[1:50:3])
+
+    def test_write_text(self):
+        f = StringIO.StringIO()
+        self.buf[5:120].write_text(f)
+        self.assertEqual(f.getvalue(), ''.join('1\n' if b else '0\n' for b in self.bits[5:120]))
+
+        f = StringIO.StringIO()
+        self.buf.write_text(f, num_frames=10)
+        self.assertEqual(f.getvalue().split(), ['1' if b else '0' for b in self.bits[:10]])
+
+if (__name__ == '__main__'):
+    unittest.main()
@@ -0,0 +1,116 @@
+'''
+Tests of the protocol compiler (protocol.py) and of the schedules of
+schedgen.py, which must compile.
+
+Usage: python -m unittest test_protocol
+'''
+import collections
+import unittest
+
+import protocol
+import schedgen
+from protocol import ProtocolError, compile_lines
+
+class CompileTest(unittest.TestCase):
+    def test_trials(self):
+        plan = compile_lines(['set START 200   # ms',
+                              'set REWARD_DELAY 100',
+                              'east north',
+                              '',
+                              'west-south any'], block_pos='north')
+        self.assertEqual(len(plan), 2)
+        first, second = plan
+
+        self.assertEqual((first.line, first.start, first.block, first.goal), (3, 'east', 'east', 'north'))
+        self.assertEqual(first.rewarded, frozenset(['north']))
+        self.assertEqual(first.start_hold, 0.2)
+        self.assertEqual(first.finish_hold, protocol.DEFAULT_TIMING['FINISH']/1000.0)
+        self.assertEqual(first.reward_delay, (0.1, 0.1))
+        self.assertEqual(first.from_block, 'north')
+        self.assertEqual(first.rotations, protocol.rotation_plan('north', 'east'))
+        self.assertTrue(first.gates['east'])
+        self.assertFalse(any(closed for arm, closed in first.gates.iteritems() if arm != 'east'))
+
+        self.assertEqual(second.from_block, 'east')
+        self.assertEqual(second.rewarded, protocol.reachable_arms('west', 'south'))
+        self.assertNotIn('north', second.rewarded) # Closed off by the block
+
+    def test_unknown_block(self):
+        plan = compile_lines(['east north'])
+        self.assertIsNone(plan[0].from_block)
+        self.assertIsNone(plan[0].rotations)
+
+    def test_timing(self):
+        plan = compile_lines(['set LICK_WINDOW 1000',
+                              'set FAST_POLL 2',
+                              'set SLOW_POLL 10',
+                              'east north'])
+        self.assertEqual(plan[0].lick_window, 1.0)
+        self.assertEqual(plan[0].poll_periods, (0.002, 0.01))
+        self.assertIsNone(compile_lines(['east north'])[0].lick_window)
+
+    def test_errors(self):
+        # Every problem is reported, with its line
+        with self.assertRaises(ProtocolError) as cm:
+            compile_lines(['east up',
+                           'east east',
+                           'set START -1',
+                           'set BOGUS 1',
+                           'set FAST_POLL 0',
+                           'set REWARD_DELAY 3 2',
+                           'east-west-north south',
+                           'north south extra',
+                           'west north'], source='p.txt')
+        lines = str(cm.exception).split('\n')
+        self.assertEqual([l.split(':')[1] for l in lines], [str(i) for i in xrange(1, 9)])
+        self.assertIn("unknown goal 'up'", lines[0])
+        self.assertIn("goal is the start arm", lines[1])
+
+    def test_lick_window_longer_than_finish(self):
+        with self.assertRaises(ProtocolError):
+            compile_lines(['set FINISH 1000', 'set LICK_WINDOW 2000', 'east north'])
+
+    def test_no_trials(self):
+        with self.assertRaises(ProtocolError):
+            compile_lines(['# nothing', 'set START 100'])
+
+    def test_probes(self):
+        # 'none' is an explicit probe, and a goal closed off by the block
+        # runs as one
+        plan = compile_lines(['east none', 'east-east west', 'east-north west'])
+        self.assertEqual(plan[0].rewarded, frozenset())
+        self.assertEqual(plan[1].rewarded, frozenset())
+        self.assertEqual(plan[2].rewarded, frozenset(['west']))
+
+    def test_rotation_plan(self):
+        for (a, b), (r, n) in protocol.block_mappings.iteritems():
+            pos = a
+            for step in protocol.rotation_plan(a, b):
+                pos = protocol.block_steps[(step, pos)]
+            self.assertEqual(pos, b)
+        self.assertEqual(protocol.rotation_plan('east', 'east'), ())
+
+class ScheduleTest(unittest.TestCase):
+    def check(self, n, **kw):
+        schedule, stats = schedgen.generate(n, seed=1, num_candidates=50, **kw)
+        self.assertEqual(len(schedule), n)
+        turns = [t[1] for t in schedule]
+        self.assertTrue(schedgen.is_gellermann(turns))
+        starts = collections.Counter(t[0] for t in schedule)
+        self.assertLessEqual(max(starts.values()) - min(starts.values()), 1)
+        compile_lines(['{} {}'.format(start, goal) for start, turn, goal in schedule],
+                      block_pos=kw.get('block_pos'))
+        return schedule
+
+    def test_balanced(self):
+        for n in (22, 30, 40):
+            self.check(n)
+            self.check(n, starts=['east', 'west'], block_pos='south')
+            self.check(n, starts=['east', 'west', 'north'])
+
+    def test_fixed_goal(self):
+        schedule = self.check(20, goal='north')
+        self.assertEqual(set(t[2] for t in schedule), set(['north']))
+
+if (__name__ == '__main__'):
+    unittest.main()
@@ -0,0 +1,125 @@
+'''
+Round trips of the session files: the binary container (sessionfile.py)
+and the trial journal (journal.py), including the recovery of an entry
+torn by a crash.
+
+Usage: python -m unittest test_sessionfile
+'''
+import os
+import shutil
+import tempfile
+import unittest
+
+import lickanalysis
+import sessionfile
+from journal import TrialJournal, read_journal
+from lickbuffer import LickBuffer
+from plusmaze import MazeState
+from results import EgoTrial, Trial
+
+TRIALS = [Trial(start='east', block='east', goal='north', result='north', time=12.5,
+                reward_delay=1.8, start_frame=1, open_frame=101, close_frame=180, end_frame=300),
+          Trial(start='west', block='west', goal='south', result=None, time=0.0,
+                reward_delay=0.0, start_frame=None, open_frame=None, close_frame=None, end_frame=None)]
+
+class SessionFileTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'session.pmz')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_semiauto(self):
+        data = bytearray(range(0, 250, 7))
+        licks = LickBuffer(data, 8*len(data) - 3)
+        samples = [MazeState(time=0.5*i, pos='east', lick=bool(i % 2), frame=i, raw=0x20*(i % 2) + 4)
+                   for i in xrange(10)]
+        sessionfile.write_session(self.path, 'semiauto', TRIALS, licks=licks, samples=samples,
+                                  meta={'trial_file': 'trials.txt', 'frame_clock': {'rate': 20.0}})
+
+        session = sessionfile.SessionFile(self.path)
+        self.assertEqual(session.protocol, 'semiauto')
+        self.assertEqual(session.meta['trial_file'], 'trials.txt')
+
+        trials = session.trials
+        self.assertEqual(len(trials), 2)
+        self.assertEqual(session.decode('start', trials['start']), ['east', 'west'])
+        self.assertEqual(session.decode('result', trials['result']), ['north', None])
+        self.assertEqual(trials['end_frame'].tolist(), [300, -1])
+        self.assertEqual(trials['reward_delay'].tolist(), [1.8, 0.0])
+
+        self.assertEqual(session.num_frames, len(licks))
+        self.assertEqual(session.licks().tolist(), licks.to_list())
+        self.assertEqual(session.samples['frame'].tolist(), range(10))
+        self.assertEqual(session.samples['raw'].tolist(), [s.raw for s in samples])
+
+        # As read for analysis
+        lick_frames, trials, rate = lickanalysis.load_session(self.path)
+        self.assertEqual(rate, 20.0)
+        self.assertEqual(len(lickanalysis.trial_metrics(lick_frames, trials, rate)), 2)
+
+    def test_ego(self):
+        trials = [EgoTrial(start='east', end='south', turn='left', time=3.0),
+                  EgoTrial(start='south', end='east', turn=None, time=5.5)]
+        sessionfile.write_session(self.path, 'ego', trials)
+        session = sessionfile.SessionFile(self.path)
+        self.assertEqual(session.decode('turn', session.trials['turn']), ['left', None])
+        self.assertIsNone(session.lick_bits)
+        self.assertEqual(len(session.licks()), 0)
+        self.assertIsNone(session.samples)
+
+    def test_not_a_session(self):
+        with open(self.path, 'wb') as f:
+            f.write('\0' * 64)
+        self.assertRaises(ValueError, sessionfile.SessionFile, self.path)
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'trials.journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_round_trip(self):
+        journal = TrialJournal(self.path, 'semiauto', trial_file='trials.txt', num_trials=2)
+        journal.append(0, TRIALS[0], block_pos='east')
+        journal.close()
+
+        # Reopening does not write the header again
+        journal = TrialJournal(self.path, 'semiauto', trial_file='other.txt')
+        journal.append(1, TRIALS[1], block_pos='west')
+        journal.close()
+
+        header, records = read_journal(self.path)
+        self.assertEqual((header['protocol'], header['trial_file'], header['num_trials']),
+                         ('semiauto', 'trials.txt', 2))
+        self.assertEqual([r['index'] for r in records], [0, 1])
+        self.assertEqual([Trial(**r['trial']) for r in records], TRIALS)
+        self.assertEqual(records[1]['block_pos'], 'west')
+
+    def test_torn_entry(self):
+        journal = TrialJournal(self.path, 'semiauto', trial_file='trials.txt')
+        journal.append(0, TRIALS[0], block_pos='east')
+        journal.close()
+        with open(self.path, 'a') as f:
+            f.write('{"index": 1, "trial": {"start": "we') # Crashed mid-entry
+
+        header, records = read_journal(self.path)
+        self.assertEqual([r['index'] for r in records], [0])
+
+        # The torn entry is terminated, so that the next one stays readable
+        journal = TrialJournal(self.path, 'semiauto')
+        journal.append(1, TRIALS[1], block_pos='west')
+        journal.close()
+        header, records = read_journal(self.path)
+        self.assertEqual([r['index'] for r in records], [0, 1])
+        self.assertEqual(Trial(**records[1]['trial']), TRIALS[1])
+
+    def test_not_a_journal(self):
+        open(self.path, 'w').close()
+        self.assertRaises(ValueError, read_journal, self.path)
+
+if (__name__ == '__main__'):
+    unittest.main()
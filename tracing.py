@@ -0,0 +1,186 @@
+'''
+Opt-in profiler of the USB transactions made by PlusMaze. TracedDevice
+wraps a FrontPanel (real or simulated) and records every transaction into
+preallocated arrays: the call, its endpoint, host monotonic start and end
+times, the calling thread and the calling step (the first function outside
+plusmaze.py, e.g. engine.open or acquisition.run). At the end of a session
+the record is written out as a Chrome trace (chrome://tracing, or
+ui.perfetto.dev) and as latency histograms per call:
+
+    python plusmaze_cli.py --sim --trace session semiauto trials.txt
+        -> session.trace.json, session.latency.txt
+'''
+from __future__ import division
+
+import array
+import json
+import sys
+import threading
+
+from util import *
+
+# FrontPanel calls that are USB transactions, and whether their first
+# argument is an endpoint address
+TRACED_CALLS = [('UpdateWireOuts', False),
+                ('UpdateWireIns', False),
+                ('ActivateTriggerIn', True),
+                ('ReadFromPipeOut', True),
+                ('WriteToPipeIn', True),
+                ('ConfigureFPGA', False)]
+
+# Modules between a protocol step and the xem. contextlib runs the end
+# of PlusMaze.batch, where UpdateWireIns is sent
+UNTRACED_MODULES = frozenset(['plusmaze', 'contextlib', 'tracing'])
+
+# Latency histogram bins, in us
+HISTOGRAM_EDGES = [0, 100, 200, 300, 500, 1000, 2000, 5000, 10000, 20000, 50000, 100000]
+
+class TracedDevice(object):
+    '''
+    Stand-in for the FrontPanel xem that records its USB transactions. The
+    buffer holds the last `capacity` transactions. Calls must be serialized
+    by the caller, as PlusMaze does with its lock
+    '''
+    DEFAULT_CAPACITY = 1 << 20 # Transactions (~25 MB, 15 min of polling at 1 kHz)
+
+    def __init__(self, xem, capacity=DEFAULT_CAPACITY):
+        self.xem = xem
+        self.capacity = capacity
+        self.count = 0 # Total number of transactions
+
+        self.calls = array.array('B', [0]) * capacity
+        self.epaddrs = array.array('h', [0]) * capacity # -1 if none
+        self.starts = array.array('d', [0.0]) * capacity
+        self.ends = array.array('d', [0.0]) * capacity
+        self.threads = array.array('H', [0]) * capacity
+        self.steps = array.array('H', [0]) * capacity
+
+        # Names of the threads and steps (index in the arrays above)
+        self.thread_names = []
+        self.step_names = []
+        self._thread_ids = {}
+        self._step_ids = {}
+
+        for code, (name, has_epaddr) in enumerate(TRACED_CALLS):
+            if hasattr(xem, name):
+                setattr(self, name, self._traced(code, getattr(xem, name), has_epaddr))
+
+    def __getattr__(self, name):
+        # Everything else (GetWireOutValue, SetWireInValue, ...) is local
+        # to the host, and is passed through untraced
+        return getattr(self.xem, name)
+
+    def _thread_id(self):
+        ident = threading.current_thread().ident
+        i = self._thread_ids.get(ident)
+        if i is None:
+            i = self._thread_ids[ident] = len(self.thread_names)
+            self.thread_names.append(threading.current_thread().name)
+        return i
+
+    def _step_id(self):
+        # The innermost caller outside of the maze driver
+        frame = sys._getframe(2)
+        while (frame.f_back is not None) and (frame.f_globals.get('__name__') in UNTRACED_MODULES):
+            frame = frame.f_back
+        code = frame.f_code
+        i = self._step_ids.get(code)
+        if i is None:
+            i = self._step_ids[code] = len(self.step_names)
+            self.step_names.append('{}.{}'.format(frame.f_globals.get('__name__'), code.co_name))
+        return i
+
+    def _traced(self, code, func, has_epaddr):
+        def traced(*args):
+            t0 = monotonic()
+            ret = func(*args)
+            t1 = monotonic()
+            i = self.count % self.capacity
+            self.calls[i] = code
+            self.epaddrs[i] = args[0] if has_epaddr else -1
+            self.starts[i] = t0
+            self.ends[i] = t1
+            self.threads[i] = self._thread_id()
+            self.steps[i] = self._step_id()
+            self.count += 1
+            return ret
+        traced.__name__ = TRACED_CALLS[code][0]
+        return traced
+
+    def _positions(self):
+        # Buffer positions of the transactions, oldest first
+        first = max(0, self.count - self.capacity)
+        return (seq % self.capacity for seq in xrange(first, self.count))
+
+    def chrome_trace(self):
+        '''
+        The transactions as Chrome trace events (complete events, with
+        times in us from the first transaction)
+        '''
+        events = [{'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid,
+                   'args': {'name': name}} for tid, name in enumerate(self.thread_names)]
+        t0 = None
+        for i in self._positions():
+            if t0 is None:
+                t0 = self.starts[i]
+            args = {'step': self.step_names[self.steps[i]]}
+            if (self.epaddrs[i] >= 0):
+                args['epaddr'] = '0x{:02X}'.format(self.epaddrs[i])
+            events.append({'name': TRACED_CALLS[self.calls[i]][0], 'cat': 'usb', 'ph': 'X',
+                           'pid': 1, 'tid': self.threads[i],
+                           'ts': round((self.starts[i] - t0)*1e6, 1),
+                           'dur': round((self.ends[i] - self.starts[i])*1e6, 1),
+                           'args': args})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def latencies(self):
+        '''
+        {call: sorted durations in us}
+        '''
+        durations = {}
+        for i in self._positions():
+            durations.setdefault(TRACED_CALLS[self.calls[i]][0], []).append(
+                (self.ends[i] - self.starts[i])*1e6)
+        for values in durations.itervalues():
+            values.sort()
+        return durations
+
+    def latency_report(self):
+        '''
+        Text histograms of the latency of each call
+        '''
+        lines = []
+        for call, values in sorted(self.latencies().iteritems()):
+            pct = lambda p: values[min(len(values)-1, int(p*len(values)))]
+            lines.append('{}: {} calls, median {:.0f} us, p90 {:.0f} us, '
+                         'p99 {:.0f} us, max {:.0f} us'.format(
+                            call, len(values), pct(0.5), pct(0.9), pct(0.99), values[-1]))
+            counts = [0] * len(HISTOGRAM_EDGES)
+            for v in values:
+                k = len(HISTOGRAM_EDGES) - 1
+                while (v < HISTOGRAM_EDGES[k]):
+                    k -= 1
+                counts[k] += 1
+            peak = max(counts)
+            for k, n in enumerate(counts):
+                if (n == 0):
+                    continue
+                hi = HISTOGRAM_EDGES[k+1] if (k+1 < len(HISTOGRAM_EDGES)) else None
+                label = '{:>6}-{:<6}'.format(HISTOGRAM_EDGES[k], hi if hi else '')
+                lines.append('  {} us {:>8} {}'.format(label, n, '#' * int(round(40*n/peak))))
+        return lines
+
+    def save(self, base):
+        '''
+        Writes base.trace.json and base.latency.txt
+        '''
+        if (self.count > self.capacity):
+            print_msg("Trace buffer wrapped; only the last {} of {} transactions are kept".format(
+                        self.capacity, self.count))
+        with open(base + '.trace.json', 'w') as f:
+            json.dump(self.chrome_trace(), f)
+        with open(base + '.latency.txt', 'w') as f:
+            for line in self.latency_report():
+                f.write(line + '\n')
+        print_msg("Wrote trace of {} USB transactions to {}.trace.json".format(
+                    min(self.count, self.capacity), base))
@@ -1,7 +1,62 @@
+import ctypes
+import ctypes.util
 import datetime
+import os
+import sys
+import time
 
-def print_msg(msg):
-    print "{}: {}".format(get_time(), msg)
+class _timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+def _clock_gettime_monotonic():
+    '''
+    monotonic() from clock_gettime(CLOCK_MONOTONIC), or None if the C
+    library does not have it
+    '''
+    clock_id = 6 if (sys.platform == 'darwin') else 1 # CLOCK_MONOTONIC
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'),
+                           use_errno=True)
+        clock_gettime = libc.clock_gettime
+    except (OSError, AttributeError):
+        return None
+
+    # No argtypes, which make the call about twice as slow
+    def monotonic(clock_gettime=clock_gettime, byref=ctypes.byref):
+        t = _timespec() # Per call, as the clock is read from several threads
+        if (clock_gettime(clock_id, byref(t)) != 0):
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return t.tv_sec + t.tv_nsec*1e-9
+    try:
+        monotonic()
+    except OSError:
+        return None
+    return monotonic
+
+# Host monotonic clock, in seconds, for the scheduler, the acquisition
+# pacing, the frame clock and the logger, which must not jump with the
+# time of day (e.g. an NTP step). On Windows, time.clock is backed by the
+# high resolution performance counter. time.time is only the last resort,
+# on a host with neither
+if hasattr(time, 'monotonic'):
+    monotonic = time.monotonic
+elif (sys.platform == 'win32'):
+    monotonic = time.clock
+else:
+    monotonic = _clock_gettime_monotonic() or time.time
+
+LOG_LEVELS = {'debug': 10, 'info': 20, 'warning': 30, 'error': 40}
+
+# The background writer, once logwriter.start_logging was called. Until
+# then messages are printed right away, from level 'info' up
+_logger = None
+
+def print_msg(msg, level='info'):
+    if _logger is not None:
+        _logger.log(msg, level)
+    elif (LOG_LEVELS.get(level, 0) >= LOG_LEVELS['info']):
+        print "{}: {}".format(get_time(), msg)
 
 def get_time():
     return datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')